@@ -0,0 +1,258 @@
+# benchmark_load.py - Load test serverllm against a fake Ollama and a mock-mode Pi client
+#
+# Everything runs in one process on one machine, no GPU, Ollama or Raspberry Pi needed:
+#   - a fake Ollama that streams scripted tokens (including a <think> block) with fixed timing
+#   - the real clientllmpi Flask app on the hardware simulator (hardware_sim.py)
+#   - the real serverllm Flask app pointed at both
+#
+# Usage:
+#   python benchmark_load.py --concurrency 8 --requests 200 --output results.json
+#   python benchmark_load.py --baseline results.json  # exit 1 if p95 regressed
+#
+# The Pi app listens on port 5001 because the server always calls clients there.
+
+import argparse
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+import requests
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+SCENARIOS = ["chat", "chat_tool", "users", "system_status", "function_servo", "function_distance"]
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+def create_fake_ollama(first_token_ms, token_ms, answer_tokens, think_tokens):
+    """Flask app speaking enough of the Ollama API for serverllm"""
+    app = Flask("fake_ollama")
+    models = [{"name": "deepseek-r1:8b"}, {"name": "qwen2.5:1.5b"}]
+
+    def scripted_tokens():
+        tokens = ["<think>"] + [f"reason{i} " for i in range(think_tokens)] + ["</think>", "\n\n"]
+        tokens += [f"word{i} " for i in range(answer_tokens)]
+        return tokens
+
+    @app.route("/api/tags")
+    def tags():
+        return jsonify({"models": models})
+
+    @app.route("/api/ps")
+    def ps():
+        return jsonify({"models": models})
+
+    @app.route("/api/generate", methods=["POST"])
+    def generate():
+        data = request.get_json()
+        num_predict = data.get("options", {}).get("num_predict")
+        tokens = scripted_tokens()[:num_predict] if num_predict else scripted_tokens()
+
+        if not data.get("stream", True):
+            time.sleep((first_token_ms + token_ms * len(tokens)) / 1000)
+            return jsonify({"model": data.get("model"), "response": "".join(tokens), "done": True})
+
+        def stream():
+            time.sleep(first_token_ms / 1000)
+            for token in tokens:
+                yield json.dumps({"model": data.get("model"), "response": token, "done": False}) + "\n"
+                time.sleep(token_ms / 1000)
+            yield json.dumps({"model": data.get("model"), "response": "", "done": True, "eval_count": len(tokens)}) + "\n"
+        return Response(stream(), mimetype="application/x-ndjson")
+
+    @app.route("/api/chat", methods=["POST"])
+    def chat():
+        data = request.get_json()
+        tokens = scripted_tokens()
+        time.sleep((first_token_ms + token_ms * len(tokens)) / 1000)
+        last = data["messages"][-1]
+        if data.get("tools") and last["role"] == "user" and "servo" in last["content"].lower():
+            message = {"role": "assistant", "content": "", "tool_calls": [
+                {"function": {"name": "rotate_servo_90_degrees", "arguments": {"servo_num": 1, "direction": "clockwise"}}}]}
+        else:
+            message = {"role": "assistant", "content": "".join(tokens)}
+        return jsonify({"model": data.get("model"), "message": message, "done": True})
+
+    return app
+
+def start_server(app, port):
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def seed_users(users_dir, count):
+    for i in range(1, count + 1):
+        with open(os.path.join(users_dir, f"{i}.json"), "w") as f:
+            json.dump({
+                "id": str(i),
+                "personal": {"name": f"Patient {i}", "age": 70, "gender": "Unknown"},
+                "medical_history": {"conditions": ["Hypertension"], "allergies": []},
+                "medications": [
+                    {"name": "Paracetamol", "dosage": "500mg", "schedule": "As needed", "slot": 1},
+                    {"name": "Antibiotic", "dosage": "250mg", "schedule": "Every 8 hours", "slot": 2}
+                ]
+            }, f)
+
+def build_request(scenario, server_url, worker_index, user_count):
+    user_id = str(worker_index % user_count + 1)
+    if scenario == "chat":
+        return "POST", f"{server_url}/api/chat", {"message": "What is paracetamol used for?", "user_id": user_id}
+    if scenario == "chat_tool":
+        return "POST", f"{server_url}/api/chat", {"message": "rotate servo 1 clockwise", "user_id": user_id}
+    if scenario == "users":
+        return "GET", f"{server_url}/api/users", None
+    if scenario == "system_status":
+        return "GET", f"{server_url}/api/system_status", None
+    if scenario == "function_servo":
+        return "POST", f"{server_url}/api/execute_function", {
+            "function_name": "rotate_servo_90_degrees", "args": {"servo_num": 1, "direction": "clockwise"},
+            "client_ip": "127.0.0.1"}
+    if scenario == "function_distance":
+        return "POST", f"{server_url}/api/execute_function", {
+            "function_name": "measure_distance", "args": {}, "client_ip": "127.0.0.1"}
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+def run_scenario(scenario, server_url, concurrency, total_requests, user_count):
+    latencies = []
+    status_counts = {}
+    lock = threading.Lock()
+    session_local = threading.local()
+
+    def one_request(index):
+        if not hasattr(session_local, "session"):
+            session_local.session = requests.Session()
+        method, url, body = build_request(scenario, server_url, index % concurrency, user_count)
+        start = time.perf_counter()
+        try:
+            response = session_local.session.request(method, url, json=body, timeout=300)
+            status = str(response.status_code)
+        except requests.exceptions.RequestException as e:
+            status = e.__class__.__name__
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed_ms)
+            status_counts[status] = status_counts.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(total_requests)))
+    wall_s = time.perf_counter() - start
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "throughput_rps": round(total_requests / wall_s, 2),
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": round(max(latencies), 2)
+        },
+        "status_counts": status_counts
+    }
+
+def compare_with_baseline(results, baseline_path, max_regression):
+    """Return the scenarios whose p95 got worse than the baseline by more than max_regression"""
+    with open(baseline_path) as f:
+        baseline = {entry["scenario"]: entry for entry in json.load(f)["scenarios"]}
+    regressions = []
+    for entry in results["scenarios"]:
+        previous = baseline.get(entry["scenario"])
+        if not previous or not previous["latency_ms"]["p95"]:
+            continue
+        ratio = entry["latency_ms"]["p95"] / previous["latency_ms"]["p95"]
+        if ratio > 1 + max_regression:
+            regressions.append({"scenario": entry["scenario"], "baseline_p95": previous["latency_ms"]["p95"],
+                                "p95": entry["latency_ms"]["p95"], "ratio": round(ratio, 2)})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test serverllm with fake Ollama and Pi stand-ins")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=40, help="Requests per scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated subset of " + ",".join(SCENARIOS))
+    parser.add_argument("--users", type=int, default=50, help="User profiles to seed")
+    parser.add_argument("--first-token-ms", type=float, default=150, help="Fake Ollama time to first token")
+    parser.add_argument("--token-ms", type=float, default=15, help="Fake Ollama time per token")
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--think-tokens", type=int, default=40)
+    parser.add_argument("--sim-speed", type=float, default=1.0, help="Hardware simulator speed (1 = real servo and sensor timing)")
+    parser.add_argument("--sim-failures", default="", help="Simulator failure rates, e.g. servo_stall=0.05,echo_timeout=0.02")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument("--baseline", help="Previous results JSON to compare p95 latency against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed p95 slowdown vs baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="zima_bench_")
+    users_dir = os.path.join(data_dir, "users")
+    os.makedirs(users_dir)
+    seed_users(users_dir, args.users)
+
+    ollama_port = free_port()
+    server_port = free_port()
+    start_server(create_fake_ollama(args.first_token_ms, args.token_ms, args.answer_tokens, args.think_tokens), ollama_port)
+
+    # Read when the scripts are imported, before they build their stores, journals and HardwareController
+    os.environ["ZIMA_HARDWARE_BACKEND"] = "sim"
+    os.environ["ZIMA_SIM_SPEED"] = str(args.sim_speed)
+    os.environ["ZIMA_SIM_FAILURES"] = args.sim_failures
+    os.environ["ZIMA_DATA_DIR"] = data_dir
+    os.environ["ZIMA_COMMAND_LOG"] = os.path.join(data_dir, "pi_commands.jsonl")
+    os.environ["ZIMA_TELEMETRY_STATE"] = os.path.join(data_dir, "pi_telemetry.json")
+    os.environ["ZIMA_TTS_CACHE"] = os.path.join(data_dir, "tts_cache")
+    os.environ["ZIMA_CONFIG"] = os.path.join(data_dir, "config.json")  # Absent: defaults, not the real config files
+    os.environ["ZIMA_OLLAMA_HOST"] = f"http://127.0.0.1:{ollama_port}"
+    os.environ["ZIMA_LLM_SERVER_URL"] = f"http://127.0.0.1:{server_port}"
+    import clientllmpi
+    import serverllm
+    # Keep request logging out of the measurements
+    for name in ("serverllm", "clientllmpi", "werkzeug"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    start_server(clientllmpi.app, 5001)
+    start_server(serverllm.app, server_port)
+    server_url = f"http://127.0.0.1:{server_port}"
+    registration = requests.post(f"{server_url}/api/register_client", json={
+        "client_type": "raspberry_pi", "client_ip": "127.0.0.1", "client_version": "bench", "hardware_mode": "sim"
+    }, timeout=10)
+    registration.raise_for_status()
+    clientllmpi.connection_status["connected"] = True
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "scenarios": []
+    }
+    for scenario in [name.strip() for name in args.scenarios.split(",") if name.strip()]:
+        results["scenarios"].append(run_scenario(scenario, server_url, args.concurrency, args.requests, args.users))
+
+    exit_code = 0
+    if args.baseline:
+        results["regressions"] = compare_with_baseline(results, args.baseline, args.max_regression)
+        exit_code = 1 if results["regressions"] else 0
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    raise SystemExit(exit_code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# benchmark_retrieval.py - Query latency and recall of the drug monograph index
+#
+# Builds synthetic indexes of increasing size (clustered random vectors with the
+# embedding model's dimension), memory-maps them the way the server does and
+# times exact and IVF search plus the per-medication filtered search used for
+# prompts. IVF recall@k is measured against exact search.
+#   python benchmark_retrieval.py --rows 1000 10000 100000 --output retrieval_results.json
+#
+# With a real corpus and Ollama running it also times embedding and end to end
+# retrieval through DrugRetriever:
+#   python benchmark_retrieval.py --rows 10000 --corpus ~/zima_data/drug_corpus
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import drug_index
+
+def percentiles(samples_ms):
+    ordered = sorted(samples_ms)
+    pick = lambda p: round(ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))], 3)
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99), "mean": round(sum(ordered) / len(ordered), 3)}
+
+def synthetic_index(directory, rows, dim, drugs, seed):
+    """Clustered unit vectors so IVF recall behaves like it does on real embeddings"""
+    rng = np.random.default_rng(seed)
+    centers = drug_index.normalize(rng.standard_normal((max(8, rows // 200), dim)))
+    vectors = drug_index.normalize(centers[rng.integers(0, len(centers), rows)] + 0.35 * rng.standard_normal((rows, dim)) / np.sqrt(dim) * 4)
+    chunks = [{"drug": f"Drug {i % drugs}", "section": "Synthetic", "source": f"drug_{i % drugs}.md",
+               "text": f"passage {i}", "sha1": str(i)} for i in range(rows)]
+    start = time.perf_counter()
+    manifest = drug_index.write_index(directory, vectors, chunks, {}, "synthetic")
+    build_s = time.perf_counter() - start
+    return centers, manifest, build_s
+
+def time_queries(search, queries):
+    samples, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        samples.append((time.perf_counter() - start) * 1000)
+    return percentiles(samples), results
+
+def bench_size(rows, args):
+    directory = tempfile.mkdtemp(prefix="zima_index_")
+    try:
+        centers, manifest, build_s = synthetic_index(directory, rows, args.dim, args.drugs, args.seed)
+        start = time.perf_counter()
+        index = drug_index.DrugIndex.open(directory)
+        open_ms = (time.perf_counter() - start) * 1000
+        rng = np.random.default_rng(args.seed + 1)
+        queries = drug_index.normalize(centers[rng.integers(0, len(centers), args.queries)]
+                                       + 0.5 * rng.standard_normal((args.queries, args.dim)) / np.sqrt(args.dim) * 4)
+
+        exact_latency, exact_hits = time_queries(lambda q: index.search(q, args.k, mode="exact"), queries)
+        result = {
+            "rows": rows,
+            "index_mb": round(os.path.getsize(os.path.join(directory, manifest["generation"], "vectors.npy")) / 1e6, 1),
+            "build_s": round(build_s, 2),
+            "open_ms": round(open_ms, 2),
+            "exact_ms": exact_latency,
+            "filtered_ms": time_queries(lambda q: index.search(q, args.k, drugs=["Drug 0", "Drug 1"]), queries)[0]
+        }
+        if manifest["ivf"]:
+            result["ivf"] = {"nlist": manifest["ivf"]["nlist"]}
+            for nprobe in args.nprobe:
+                ivf_latency, ivf_hits = time_queries(lambda q: index.search(q, args.k, mode="ivf", nprobe=nprobe), queries)
+                recall = np.mean([len({row for _, row in a} & {row for _, row in b}) / args.k
+                                  for a, b in zip(exact_hits, ivf_hits)])
+                result["ivf"][f"nprobe_{nprobe}"] = {"latency_ms": ivf_latency, f"recall_at_{args.k}": round(float(recall), 4)}
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def bench_corpus(args):
+    """Build a real index from --corpus and time DrugRetriever end to end"""
+    directory = tempfile.mkdtemp(prefix="zima_index_")
+    try:
+        embedder = drug_index.OllamaEmbedder(host=args.host, model=args.model)
+        summary = drug_index.build_index(args.corpus, directory, embedder, incremental=False)
+        update = drug_index.build_index(args.corpus, directory, embedder, incremental=True)
+        retriever = drug_index.DrugRetriever(directory, embedder, min_score=0)
+        questions = ["Can I take this with alcohol?", "What is the maximum daily dose?",
+                     "Should I take it with food?", "What are the common side effects?"]
+        drugs = sorted({chunk["drug"] for chunk in retriever.current_index().chunks})[:2]
+        cold, warm = [], []
+        for question in questions:
+            for samples in (cold, warm):  # Second pass hits the query embedding cache
+                start = time.perf_counter()
+                retriever.retrieve(question, drugs=drugs)
+                samples.append((time.perf_counter() - start) * 1000)
+        return {"build": summary, "noop_update_s": update["seconds"], "model": args.model,
+                "retrieve_ms": percentiles(cold), "retrieve_cached_ms": percentiles(warm),
+                "embed_ms": retriever.status()["embed_ms"]}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark drug index query latency")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 50000], help="Index sizes to test")
+    parser.add_argument("--dim", type=int, default=768, help="Embedding dimension (nomic-embed-text is 768)")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per measurement")
+    parser.add_argument("--k", type=int, default=drug_index.RAG_TOP_K, help="Passages per query")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, drug_index.IVF_NPROBE, 16], help="IVF lists scanned")
+    parser.add_argument("--drugs", type=int, default=50, help="Distinct drugs in the synthetic index")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--corpus", help="Also build and query a real corpus through Ollama")
+    parser.add_argument("--host", default=drug_index.EMBED_HOST, help="Ollama base URL for --corpus")
+    parser.add_argument("--model", default=drug_index.EMBED_MODEL, help="Embedding model for --corpus")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = {
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "dim": args.dim,
+        "k": args.k,
+        "queries": args.queries,
+        "ivf_min_rows": drug_index.IVF_MIN_ROWS,
+        "sizes": [bench_size(rows, args) for rows in args.rows]
+    }
+    if args.corpus:
+        results["corpus"] = bench_corpus(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# benchmark_tool_calling.py - Compare keyword and native Ollama function calling
+#
+# Usage:
+#   python benchmark_tool_calling.py                 # both modes, needs Ollama running
+#   python benchmark_tool_calling.py --keyword-only  # heuristics only, no Ollama needed
+#   python benchmark_tool_calling.py --output results.json
+
+import argparse
+import json
+import statistics
+import time
+
+import requests
+
+import serverllm
+
+# Fixed corpus: user message and the set of functions that should be called
+CORPUS = [
+    ("What's the weather like in Paris?", ["get_weather_data"]),
+    ("Is it going to rain in Tokyo today?", ["get_weather_data"]),
+    ("Rotate servo 1 clockwise", ["rotate_servo_90_degrees"]),
+    ("Turn servo two counterclockwise please", ["rotate_servo_90_degrees"]),
+    ("Dispense the paracetamol from slot 1", ["dispense_pill"]),
+    ("Please dispense my antibiotic", ["dispense_pill"]),
+    ("Did I pick up my pill? Check pill pickup", ["measure_distance"]),
+    ("Measure the distance sensor", ["measure_distance"]),
+    ("I have a headache, what should I take?", []),
+    ("Can I take paracetamol with food?", []),
+    ("What are the side effects of antibiotics?", []),
+    ("Hello, how are you today?", []),
+    ("I feel dizzy after taking my medication", []),
+    ("Give me the pill from compartment 2 and tell me the weather in Berlin", ["dispense_pill", "get_weather_data"]),
+]
+
+# Canned tool results so both paths can finish a turn without a Raspberry Pi client
+SIMULATED_RESULTS = {
+    "get_weather_data": {"success": True, "city": "Paris", "temperature": 18.5, "description": "light rain", "humidity": 71, "units": "metric"},
+    "rotate_servo_90_degrees": {"success": True, "servo": 1, "direction": "clockwise", "new_position": 90},
+    "dispense_pill": {"status": "Paracetamol dispensed from compartment 1"},
+    "measure_distance": {"distance_cm": 7.4},
+}
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def score(expected, predicted):
+    """Exact-match on the set of function names"""
+    return set(expected) == set(predicted)
+
+def run_keyword(message, with_generation):
+    start = time.perf_counter()
+    calls = serverllm.detect_function_calls(message)
+    detect_ms = (time.perf_counter() - start) * 1000
+
+    if with_generation:
+        prompt = f"User request: {message}"
+        if calls:
+            prompt += "\n\nFunction execution results:\n"
+            for call in calls:
+                prompt += f"- {call['function']}({call['args']}): {SIMULATED_RESULTS[call['function']]}\n"
+            prompt += "\n\nPlease respond based on the function results above."
+        requests.post(f"{serverllm.OLLAMA_HOST}/api/generate", json={
+            "model": serverllm.OLLAMA_MODEL,
+            "prompt": prompt,
+            "system": serverllm.SYSTEM_PROMPT,
+            "stream": False
+        })
+
+    total_ms = (time.perf_counter() - start) * 1000
+    return [c["function"] for c in calls], detect_ms, total_ms
+
+def run_native(message, with_generation):
+    messages = [
+        {"role": "system", "content": serverllm.SYSTEM_PROMPT},
+        {"role": "user", "content": message}
+    ]
+    start = time.perf_counter()
+    reply = serverllm.request_ollama_chat(messages, tools=serverllm.OLLAMA_TOOLS)
+    detect_ms = (time.perf_counter() - start) * 1000
+    calls = serverllm.parse_tool_calls(reply)
+
+    if with_generation and calls:
+        messages.append(reply)
+        for call in calls:
+            messages.append({
+                "role": "tool",
+                "tool_name": call["function"],
+                "content": json.dumps(SIMULATED_RESULTS[call["function"]])
+            })
+        serverllm.request_ollama_chat(messages)
+
+    total_ms = (time.perf_counter() - start) * 1000
+    return [c["function"] for c in calls], detect_ms, total_ms
+
+def run_mode(name, runner, repeat, with_generation):
+    correct = 0
+    detect_times = []
+    total_times = []
+    failures = []
+    for message, expected in CORPUS:
+        for _ in range(repeat):
+            predicted, detect_ms, total_ms = runner(message, with_generation)
+            detect_times.append(detect_ms)
+            total_times.append(total_ms)
+            if score(expected, predicted):
+                correct += 1
+            else:
+                failures.append({"message": message, "expected": expected, "predicted": predicted})
+
+    runs = len(CORPUS) * repeat
+    return {
+        "mode": name,
+        "runs": runs,
+        "accuracy": correct / runs,
+        "decision_ms": {
+            "p50": percentile(detect_times, 50),
+            "p95": percentile(detect_times, 95),
+            "mean": statistics.mean(detect_times)
+        },
+        "turn_ms": {
+            "p50": percentile(total_times, 50),
+            "p95": percentile(total_times, 95),
+            "mean": statistics.mean(total_times)
+        },
+        "failures": failures
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark keyword vs native Ollama tool calling")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per corpus entry")
+    parser.add_argument("--keyword-only", action="store_true", help="Skip the Ollama-backed native mode")
+    parser.add_argument("--no-generation", action="store_true", help="Only time the tool decision, not the final answer")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    with_generation = not args.no_generation and not args.keyword_only
+    results = {
+        "model": serverllm.OLLAMA_MODEL,
+        "corpus_size": len(CORPUS),
+        "with_generation": with_generation,
+        "modes": [run_mode("keyword", run_keyword, args.repeat, with_generation)]
+    }
+    if not args.keyword_only:
+        results["modes"].append(run_mode("native", run_native, args.repeat, with_generation))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
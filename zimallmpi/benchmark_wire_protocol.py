@@ -0,0 +1,102 @@
+# benchmark_wire_protocol.py - JSON vs msgpack encode/decode cost for server <-> Pi messages
+#
+# Run it on the Raspberry Pi itself (3B+ or newer) to get numbers for the device
+# that actually has to decode the traffic:
+#   python benchmark_wire_protocol.py --iterations 2000 --output wire_results.json
+
+import argparse
+import gzip
+import json
+import platform
+import time
+from datetime import datetime
+
+import wire_protocol
+
+def sample_messages(user_count):
+    now = datetime.now().isoformat()
+    users = [{
+        "id": str(i),
+        "personal": {"name": f"Patient {i}", "age": 60 + i % 30, "gender": "Unknown"},
+        "medical_history": {"conditions": ["Hypertension"], "allergies": ["Penicillin"] if i % 4 == 0 else []},
+        "medications": [
+            {"name": "Paracetamol", "dosage": "500mg", "schedule": "As needed", "slot": 1},
+            {"name": "Antibiotic", "dosage": "250mg", "schedule": "Every 8 hours", "slot": 2}
+        ]
+    } for i in range(1, user_count + 1)]
+
+    return [
+        ("heartbeat", "heartbeat", {"status": "ok", "server_time": now, "clients_count": 3}),
+        ("function_call", "function_call", {"function_name": "rotate_servo_90_degrees", "args": {"servo_num": 1, "direction": "clockwise"}}),
+        ("sensor_event", "sensor_event", {"status": "Pill taken", "distance_cm": 7.42, "pill_taken": True}),
+        ("result", "result", {"success": True, "servo": 1, "direction": "clockwise", "new_position": 90,
+                              "message": "Servo 1 rotated 90° clockwise to 90°"}),
+        (f"user_list_{user_count}", "raw", {"success": True, "users": users})
+    ]
+
+def time_per_op(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+def bench_message(name, message_type, payload, iterations):
+    json_body = json.dumps(payload).encode()
+    result = {
+        "message": name,
+        "json": {
+            "bytes": len(json_body),
+            "encode_us": round(time_per_op(lambda: json.dumps(payload).encode(), iterations), 2),
+            "decode_us": round(time_per_op(lambda: json.loads(json_body), iterations), 2)
+        }
+    }
+
+    if wire_protocol.msgpack_available():
+        packed = wire_protocol.encode(payload, message_type)
+        assert wire_protocol.decode(packed) == payload, f"{name} did not round-trip"
+        result["msgpack"] = {
+            "bytes": len(packed),
+            "encode_us": round(time_per_op(lambda: wire_protocol.encode(payload, message_type), iterations), 2),
+            "decode_us": round(time_per_op(lambda: wire_protocol.decode(packed), iterations), 2)
+        }
+
+    if len(json_body) >= wire_protocol.COMPRESSION_THRESHOLD:
+        gzipped = gzip.compress(json_body, compresslevel=6)
+        result["json_gzip"] = {
+            "bytes": len(gzipped),
+            "decompress_us": round(time_per_op(lambda: gzip.decompress(gzipped), iterations), 2)
+        }
+        if wire_protocol.zstandard and wire_protocol.msgpack_available():
+            compressed = wire_protocol.zstandard.ZstdCompressor(level=3).compress(packed)
+            decompressor = wire_protocol.zstandard.ZstdDecompressor()
+            result["msgpack_zstd"] = {
+                "bytes": len(compressed),
+                "decompress_us": round(time_per_op(lambda: decompressor.decompress(compressed), iterations), 2)
+            }
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON vs msgpack wire encoding")
+    parser.add_argument("--iterations", type=int, default=1000, help="Encode/decode runs per message")
+    parser.add_argument("--users", type=int, default=200, help="Profiles in the user list payload")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args()
+
+    results = {
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "msgpack": wire_protocol.msgpack_available(),
+        "zstd": wire_protocol.zstandard is not None,
+        "iterations": args.iterations,
+        "messages": [bench_message(name, message_type, payload, args.iterations)
+                     for name, message_type, payload in sample_messages(args.users)]
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+if __name__ == "__main__":
+    main()
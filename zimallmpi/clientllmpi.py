@@ -3,38 +3,113 @@
 import sys # **** ADDED FOR DIAGNOSTICS ****
 import os # Moved os import earlier for consistency
 import logging # Moved logging import earlier
+import time
+PROCESS_START = time.time()  # Startup phase timings are measured from here
 
 # **** START DIAGNOSTICS ****
-print("--- SCRIPT START DIAGNOSTICS ---")
-print(f"Python Executable: {sys.executable}")
-print("sys.path:")
-for p in sys.path:
-    print(f"  - {p}")
-# Check if a local 'telegram.py' or 'telegram' directory exists
-current_script_directory = os.path.dirname(os.path.abspath(__file__))
-local_telegram_py = os.path.join(current_script_directory, 'telegram.py')
-local_telegram_dir = os.path.join(current_script_directory, 'telegram')
-if os.path.exists(local_telegram_py):
-    print(f"WARNING: Local file 'telegram.py' found at {local_telegram_py}. This might be shadowing the installed library.")
-if os.path.exists(local_telegram_dir) and os.path.isdir(local_telegram_dir):
-    print(f"WARNING: Local directory 'telegram/' found at {local_telegram_dir}. This might be shadowing the installed library.")
-print("--- END DIAGNOSTICS ---")
+# Opt-in with ZIMA_STARTUP_DIAGNOSTICS=1 when the telegram import is being shadowed
+if os.environ.get("ZIMA_STARTUP_DIAGNOSTICS", "0") == "1":
+    print("--- SCRIPT START DIAGNOSTICS ---")
+    print(f"Python Executable: {sys.executable}")
+    print("sys.path:")
+    for p in sys.path:
+        print(f"  - {p}")
+    # Check if a local 'telegram.py' or 'telegram' directory exists
+    current_script_directory = os.path.dirname(os.path.abspath(__file__))
+    local_telegram_py = os.path.join(current_script_directory, 'telegram.py')
+    local_telegram_dir = os.path.join(current_script_directory, 'telegram')
+    if os.path.exists(local_telegram_py):
+        print(f"WARNING: Local file 'telegram.py' found at {local_telegram_py}. This might be shadowing the installed library.")
+    if os.path.exists(local_telegram_dir) and os.path.isdir(local_telegram_dir):
+        print(f"WARNING: Local directory 'telegram/' found at {local_telegram_dir}. This might be shadowing the installed library.")
+    print("--- END DIAGNOSTICS ---")
 # **** END DIAGNOSTICS ****
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import requests
-import time
 import json # Moved json import earlier
 from datetime import datetime
 import socket
 import threading
+import uuid
 import asyncio
+import queue
+import re
+from collections import OrderedDict, deque
 from functools import wraps
+from contextlib import contextmanager
+import wire_protocol
+import hardware_sim
+import tracing
+import profiling
+import speech
+import tts
+import local_llm
+import command_queue
+import user_model
+import config
+
+def check_cache_ttls(ttls):
+    if not all(isinstance(ttl, (int, float)) and not isinstance(ttl, bool) and ttl >= 0 for ttl in ttls.values()):
+        return ["proxy_cache_ttls must map endpoint prefixes to seconds >= 0"]
+    return []
+
+# Every knob is declared here once; see config.py for the file/env/--set layers
+# and which settings hot-reload. The module constants below are read from it.
+PI_SETTINGS = [
+    config.Setting("llm_server_url", "http://192.168.0.104:5000", help="The server's address, e.g. http://<mac ip>:5000"),
+    config.Setting("wire_format", "json", choices=("json", "msgpack"),
+                   help="msgpack negotiates the compact encoding, needs msgpack on both machines"),
+    config.Setting("device_id", socket.gethostname(), help="Name this dispenser reports on the server's fleet dashboard"),
+    config.Setting("command_log", os.path.join(os.path.expanduser("~"), "zima_data", "pi_commands.jsonl"),
+                   help="Dedup table for server commands; must survive reboots for dispenses to stay at-most-once"),
+    config.Setting("telemetry_state", os.path.join(os.path.expanduser("~"), "zima_data", "pi_telemetry.json"),
+                   help="Today's dispense and missed-dose counts, kept so a reboot does not reset them"),
+    config.Setting("hardware_backend", "mock", choices=tuple(hardware_sim.BACKENDS),
+                   help="Backend used when not driving GPIO: mock (instant) or sim (time-accurate simulator)"),
+    config.Setting("servo_pin1", 12, int, minimum=0, maximum=40),
+    config.Setting("servo_pin2", 23, int, minimum=0, maximum=40),
+    config.Setting("trig_pin", 21, int, minimum=0, maximum=40),
+    config.Setting("echo_pin", 20, int, minimum=0, maximum=40),
+    config.Setting("openweather_api_key", "", secret=True),
+    config.Setting("default_city", "London", help="City for weather queries that name none"),
+    config.Setting("telegram_bot_token", "", secret=True),
+    config.Setting("telegram_chat_id", "", help='Caregiver chat, e.g. "@yourchannel" or a numerical ID'),
+    config.Setting("server_timeout_s", 10.0, float, minimum=1, reloadable=True, help="Seconds per call to the server"),
+    config.Setting("chat_timeout_s", 250.0, float, minimum=10, reloadable=True,
+                   help="Seconds a chat call to the server may take, keep above its LLM queue timeout"),
+    config.Setting("connection_check_interval_s", 30, int, minimum=5, reloadable=True,
+                   help="Seconds between server connection checks and heartbeats"),
+    config.Setting("pickup_threshold_cm", 10.0, float, minimum=1, reloadable=True,
+                   help="A distance reading below this counts as the pill being picked up"),
+    config.Setting("missed_dose_grace_s", 1800, int, minimum=60, reloadable=True,
+                   help="Seconds after its scheduled time an untaken dose counts as missed"),
+    config.Setting("missed_dose_check_interval_s", 900, int, minimum=60, reloadable=True),
+    config.Setting("weather_cache_ttl_s", 600, int, minimum=0, reloadable=True,
+                   help="Seconds a weather result is served without refetching"),
+    config.Setting("weather_stale_ttl_s", 1800, int, minimum=0, reloadable=True,
+                   help="Seconds a stale result may still be served while it revalidates"),
+    config.Setting("weather_negative_ttl_s", 300, int, minimum=0, reloadable=True,
+                   help="Seconds an unknown city is remembered"),
+    config.Setting("proxy_cache_ttls", {"/api/users": 60, "/api/select_user": 60, "/api/get_medication_info": 300,
+                                        "/api/get_schedule": 60},
+                   dict, reloadable=True, check=check_cache_ttls, help="Seconds per server endpoint prefix"),
+    config.Setting("sse_keepalive_s", 15, int, minimum=1, reloadable=True,
+                   help="Seconds between keepalive comments on an idle event stream"),
+    config.Setting("profile_hz", profiling.CONTINUOUS_HZ, float, minimum=0, maximum=profiling.MAX_PROFILE_HZ,
+                   reloadable=True, help="Continuous profiler samples per second; 0 pauses it"),
+]
+settings = config.load(PI_SETTINGS, os.path.join(os.path.expanduser("~"), "zima_data", "pi_config.json"),
+                       sys.argv[1:] if __name__ == "__main__" else [])
 
 # OpenWeatherMap API configuration
-OPENWEATHER_API_KEY = ""  # Replace with your actual API key
+OPENWEATHER_API_KEY = settings["openweather_api_key"]
 OPENWEATHER_BASE_URL = "http://api.openweathermap.org/data/2.5/weather"
-DEFAULT_CITY = "London"  # Default city for weather queries
+DEFAULT_CITY = settings["default_city"]
+WEATHER_CACHE_TTL = settings["weather_cache_ttl_s"]
+WEATHER_STALE_TTL = settings["weather_stale_ttl_s"]
+WEATHER_NEGATIVE_TTL = settings["weather_negative_ttl_s"]
+WEATHER_CACHE_MAX_ENTRIES = 256  # Cities kept; the least recently used is dropped first
 
 # Function calling decorator
 def function_call(func):
@@ -46,39 +121,45 @@ def function_call(func):
     wrapper._function_name = func.__name__
     return wrapper
 
-telegram = None # Initialize telegram to None
+telegram = None # Imported on first use by load_telegram(), the import takes seconds on a Pi
 async_telegram = None 
 telegram_errors = None # To store specific telegram error types if import is successful
-# Replace lines 34-45 with this updated code:
-
-try:
-    import telegram
-    from telegram import error as telegram_errors_module  # Use a different alias to avoid conflict
-    # Get the correct error classes from the telegram library
-    # The error was using 'Unauthorized' when it should be 'Forbidden'
-    Unauthorized = telegram_errors_module.Forbidden  # Proper class name is Forbidden
-    ChatNotFound = telegram_errors_module.BadRequest  # Use BadRequest for chat not found errors
-    NetworkError = telegram_errors_module.NetworkError  # This one is correct
-    logger_for_import = logging.getLogger(__name__)  # Get a logger instance for this block
-    logger_for_import.info("Successfully imported 'python-telegram-bot' library and its error types.")
-except ImportError as e:
-    # This print goes to stdout, not the logger by default
-    print("--------------------------------------------------------------------")
-    print(f"CRITICAL-IMPORT-ERROR: The 'python-telegram-bot' library could not be imported.")
-    print(f"Error details: {e}")
-    print(f"Attempted to import from 'telegram'. Check if this module is shadowed or if the installation in {sys.executable} is corrupted.")
-    print("Please ensure it's correctly installed in the active virtual environment: pip install python-telegram-bot")
-    print("Telegram notifications will be disabled.")
-    print("--------------------------------------------------------------------")
-    # Also log it, so it appears in the file log if possible early on
-    # Note: logger might not be fully configured here if this is the first thing that fails.
-    # We will use the root logger for this specific early error.
-    logging.getLogger().error(f"CRITICAL-IMPORT-ERROR: 'python-telegram-bot' library failed to import. Details: {e}. Telegram will be disabled.")
-    # telegram remains None
-    # Define dummy error classes so the rest of the script doesn't break if telegram was not imported
-    class Unauthorized(Exception): pass
-    class ChatNotFound(Exception): pass
-    class NetworkError(Exception): pass
+telegram_errors_module = None
+telegram_import_lock = threading.Lock()
+telegram_import_attempted = False
+
+# Dummy error classes until the telegram library is loaded
+class Unauthorized(Exception): pass
+class ChatNotFound(Exception): pass
+class NetworkError(Exception): pass
+
+def load_telegram():
+    """Import python-telegram-bot once, on first use. Returns the module or None."""
+    global telegram, telegram_errors_module, Unauthorized, ChatNotFound, NetworkError, telegram_import_attempted
+    with telegram_import_lock:
+        if telegram_import_attempted:
+            return telegram
+        telegram_import_attempted = True
+        try:
+            import telegram
+            from telegram import error as telegram_errors_module  # Use a different alias to avoid conflict
+            # Get the correct error classes from the telegram library
+            # The error was using 'Unauthorized' when it should be 'Forbidden'
+            Unauthorized = telegram_errors_module.Forbidden  # Proper class name is Forbidden
+            ChatNotFound = telegram_errors_module.BadRequest  # Use BadRequest for chat not found errors
+            NetworkError = telegram_errors_module.NetworkError  # This one is correct
+            logger.info("Successfully imported 'python-telegram-bot' library and its error types.")
+        except ImportError as e:
+            telegram = None
+            print("--------------------------------------------------------------------")
+            print(f"CRITICAL-IMPORT-ERROR: The 'python-telegram-bot' library could not be imported.")
+            print(f"Error details: {e}")
+            print(f"Attempted to import from 'telegram'. Check if this module is shadowed or if the installation in {sys.executable} is corrupted.")
+            print("Please ensure it's correctly installed in the active virtual environment: pip install python-telegram-bot")
+            print("Telegram notifications will be disabled.")
+            print("--------------------------------------------------------------------")
+            logger.error(f"CRITICAL-IMPORT-ERROR: 'python-telegram-bot' library failed to import. Details: {e}. Telegram will be disabled.")
+        return telegram
 
 # Configure logging (if not already configured by the root logger above)
 # This will append handlers if root logger was already touched by the import error log
@@ -93,32 +174,175 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Startup phase timings in ms since process start, reported at /startup_status
+startup_phases = []
+startup_state = {"serving_ms": None, "background_done_ms": None}
+
+def ms_since_start(timestamp=None):
+    return round(((timestamp or time.time()) - PROCESS_START) * 1000, 1)
+
+@contextmanager
+def startup_phase(name):
+    """Time one startup step; errors are logged and do not stop the remaining steps"""
+    start = time.time()
+    status = "ok"
+    try:
+        yield
+    except Exception as e:
+        status = f"error: {e}"
+        logger.error(f"Startup phase '{name}' failed: {e}", exc_info=True)
+    finally:
+        startup_phases.append({
+            "phase": name,
+            "start_ms": ms_since_start(start),
+            "duration_ms": round((time.time() - start) * 1000, 1),
+            "status": status
+        })
+
 # LLM Server configuration
-LLM_SERVER_URL = "http://192.168.0.104:5000"  # always Replace with your Mac's IP address
+LLM_SERVER_URL = settings["llm_server_url"]  # Set llm_server_url to your Mac's IP address
+WIRE_FORMAT = settings["wire_format"]
+DEVICE_ID = settings["device_id"]
+SENSOR_WINDOW = 50  # Recent readings per sensor that the health report covers
+COMMAND_LOG_PATH = settings["command_log"]
+TELEMETRY_STATE_PATH = settings["telemetry_state"]
+SERVER_TIMEOUT = settings["server_timeout_s"]
+CHAT_TIMEOUT = settings["chat_timeout_s"]
+CONNECTION_CHECK_INTERVAL = settings["connection_check_interval_s"]
+PICKUP_THRESHOLD_CM = settings["pickup_threshold_cm"]
+MISSED_DOSE_GRACE_S = settings["missed_dose_grace_s"]
+MISSED_DOSE_CHECK_INTERVAL = settings["missed_dose_check_interval_s"]
 
 # --- IMPORTANT TELEGRAM CONFIGURATION ---
-TELEGRAM_BOT_TOKEN = ""  # <<< --- !!! REPLACE THIS !!!
-TELEGRAM_CHAT_ID = ""  # <<< --- !!! REPLACE THIS !!! e.g., "@yourchannel" or a numerical ID
+TELEGRAM_BOT_TOKEN = settings["telegram_bot_token"]  # <<< --- !!! SET telegram_bot_token !!!
+TELEGRAM_CHAT_ID = settings["telegram_chat_id"]  # <<< --- !!! SET telegram_chat_id !!!
 TELEGRAM_ENABLED = True # Initial default, will be checked/updated based on import success
 # --- END TELEGRAM CONFIGURATION ---
 
 app = Flask(__name__, 
             static_folder='static',
             template_folder='templates')
+tracer = tracing.Tracer("clientllmpi")
+tracing.init_app(app, tracer)
+sampling_profiler = profiling.SamplingProfiler()
+continuous_profiler = profiling.ContinuousProfiler(hz=settings["profile_hz"])
 
 # Check if running on Raspberry Pi or in development environment
 RASPBERRY_PI = os.path.exists('/sys/class/gpio')
+HARDWARE_BACKEND = settings["hardware_backend"]
 
 # GPIO pin configuration
-SERVO_PIN1 = 12
-SERVO_PIN2 = 23
-TRIG_PIN = 21
-ECHO_PIN = 20
+SERVO_PIN1 = settings["servo_pin1"]
+SERVO_PIN2 = settings["servo_pin2"]
+TRIG_PIN = settings["trig_pin"]
+ECHO_PIN = settings["echo_pin"]
+
+class WeatherCache:
+    """TTL cache for weather lookups keyed by (city, units).
+    
+    Concurrent lookups for the same key share one OpenWeatherMap request, stale
+    entries are served while a background refresh runs, and unknown cities are
+    cached as failures so typos do not hit the API on every message. Expired
+    entries are dropped on insert and at most max_entries are kept.
+    """
+    def __init__(self, ttl, stale_ttl, negative_ttl, max_entries=WEATHER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (result, stored_at), least recently used first
+        self.in_flight = {}  # key -> threading.Event set when the leader finishes
+        self.stats = {"hits": 0, "misses": 0, "stale_served": 0, "coalesced": 0, "negative_hits": 0, "fetches": 0}
+    
+    def _key(self, city, units):
+        return (city.strip().lower(), units)
+    
+    def _max_age(self, result):
+        return self.negative_ttl if result.get("error") == "City not found" else self.ttl
+    
+    def _expired(self, entry, now):
+        result, stored_at = entry
+        usable_for = max(self.stale_ttl, self.ttl) if result.get("success") else self._max_age(result)
+        return now - stored_at >= usable_for
+    
+    def _store(self, key, result):
+        # Only successes and unknown cities are cached, network errors are retried
+        if result.get("success") or result.get("error") == "City not found":
+            now = time.time()
+            for old_key in [k for k, entry in self.entries.items() if self._expired(entry, now)]:
+                del self.entries[old_key]
+            self.entries[key] = (result, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def _fetch(self, key, fetch, city, units, event):
+        try:
+            with self.lock:
+                self.stats["fetches"] += 1
+            result = fetch(city, units)
+            with self.lock:
+                self._store(key, result)
+            return result
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            event.set()
+    
+    def get(self, city, units, fetch):
+        key = self._key(city, units)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                result, stored_at = entry
+                age = time.time() - stored_at
+                if age < self._max_age(result):
+                    self.stats["negative_hits" if not result.get("success") else "hits"] += 1
+                    return result
+                if result.get("success") and age < self.stale_ttl:
+                    # Serve stale and refresh in the background, once per key
+                    self.stats["stale_served"] += 1
+                    if key not in self.in_flight:
+                        event = threading.Event()
+                        self.in_flight[key] = event
+                        threading.Thread(target=self._fetch, args=(key, fetch, city, units, event),
+                                         daemon=True, name="WeatherRefresh").start()
+                    return result
+            
+            event = self.in_flight.get(key)
+            if event:
+                self.stats["coalesced"] += 1
+                leader = False
+            else:
+                self.stats["misses"] += 1
+                event = threading.Event()
+                self.in_flight[key] = event
+                leader = True
+        
+        if leader:
+            return self._fetch(key, fetch, city, units, event)
+        
+        # Follower: wait for the leader's request instead of making our own
+        event.wait(15)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry:
+            return entry[0]
+        return fetch(city, units)
+    
+    def status(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "in_flight": len(self.in_flight),
+                    **self.stats}
+
+weather_cache = WeatherCache(WEATHER_CACHE_TTL, WEATHER_STALE_TTL, WEATHER_NEGATIVE_TTL)
 
 @function_call
 def get_weather_data(city=None, units="metric"):
     """
-    Fetch current weather data from OpenWeatherMap API
+    Fetch current weather data from OpenWeatherMap API, through the weather cache
     
     Args:
         city (str): City name (defaults to DEFAULT_CITY)
@@ -135,9 +359,13 @@ def get_weather_data(city=None, units="metric"):
         return {
             "success": False,
             "error": "Weather API key not configured",
-            "message": "Please set OPENWEATHER_API_KEY in the configuration"
+            "message": "Please set openweather_api_key (ZIMA_OPENWEATHER_API_KEY) in the configuration"
         }
     
+    return weather_cache.get(city, units, fetch_weather_data)
+
+def fetch_weather_data(city, units="metric"):
+    """Uncached OpenWeatherMap request, use get_weather_data instead"""
     try:
         params = {
             "q": city,
@@ -147,6 +375,13 @@ def get_weather_data(city=None, units="metric"):
         
         logger.info(f"Fetching weather data for {city}")
         response = requests.get(OPENWEATHER_BASE_URL, params=params, timeout=10)
+        if response.status_code == 404:
+            logger.warning(f"Weather service does not know city: {city}")
+            return {
+                "success": False,
+                "error": "City not found",
+                "message": f"Could not find weather for '{city}'"
+            }
         response.raise_for_status()
         
         weather_data = response.json()
@@ -196,8 +431,9 @@ class HardwareController:
         # Add servo position tracking
         self.servo1_position = 0  # Current angle in degrees
         self.servo2_position = 0  # Current angle in degrees
+        self.backend = None  # Set whenever mock_mode is True
         
-        if RASPBERRY_PI:
+        if RASPBERRY_PI and HARDWARE_BACKEND != "sim":
             try:
                 import RPi.GPIO as GPIO
                 self.GPIO = GPIO
@@ -219,14 +455,21 @@ class HardwareController:
             except Exception as e:
                 logger.error(f"Error initializing GPIO: {e}")
                 self.mock_mode = True
-                logger.warning("Falling back to MOCK mode due to error")
+                self.backend = hardware_sim.create_backend(HARDWARE_BACKEND)
+                logger.warning(f"Falling back to MOCK mode ({self.backend.name} backend) due to error")
         else:
             self.mock_mode = True
-            logger.warning("Hardware controller initialized in MOCK mode (not running on Raspberry Pi)")
+            self.backend = hardware_sim.create_backend(HARDWARE_BACKEND)
+            logger.warning(f"Hardware controller initialized in MOCK mode with the {self.backend.name} backend")
+
+    @property
+    def mode_name(self):
+        return "real" if not self.mock_mode else self.backend.name
 
     def dispense_pill(self, servo_num):
         if self.mock_mode:
             logger.info(f"MOCK: Dispensing pill from servo {servo_num}")
+            self.backend.dispense(servo_num)
             return
             
         if servo_num == 1:
@@ -270,6 +513,16 @@ class HardwareController:
             current_pos = self.servo1_position if servo_num == 1 else self.servo2_position
             rotation_amount = 90 if direction == "clockwise" else -90
             new_position = (current_pos + rotation_amount) % 360
+
+            try:
+                self.backend.move_servo(servo_num, new_position)
+            except hardware_sim.HardwareFault as e:
+                logger.error(f"MOCK: Error rotating servo {servo_num}: {e}")
+                return {
+                    "success": False,
+                    "error": "Hardware error",
+                    "message": f"Failed to rotate servo {servo_num}: {str(e)}"
+                }
             
             if servo_num == 1:
                 self.servo1_position = new_position
@@ -335,8 +588,7 @@ class HardwareController:
 
     def measure_distance(self):
         if self.mock_mode:
-            import random
-            distance = round(random.uniform(5, 20), 2)
+            distance = self.backend.measure_distance()
             logger.debug(f"MOCK: Measured distance: {distance} cm")
             return distance
         
@@ -378,6 +630,7 @@ class HardwareController:
 
     def cleanup(self):
         if self.mock_mode:
+            self.backend.cleanup()
             return
         if RASPBERRY_PI and hasattr(self, 'GPIO') and self.GPIO: 
             try:
@@ -407,7 +660,7 @@ def test_telegram_connection():
         logger.warning("Telegram is disabled. Cannot test connection.")
         return False
     
-    if not telegram:
+    if not load_telegram():
         logger.error("Telegram library not imported successfully. Cannot test connection.")
         return False
     
@@ -441,19 +694,33 @@ def test_telegram_connection():
 connection_status = {"connected": False}
 
 # Utility functions for communicating with the LLM server
-def call_api(endpoint, method="GET", data=None):
+def call_api(endpoint, method="GET", data=None, headers=None, meta=None):
+    """Call the LLM server. Pass a dict as meta to receive the status code and ETag."""
     url = f"{LLM_SERVER_URL}{endpoint}"
+    span = tracer.start(f"server {method} {endpoint}", kind="client")
     try:
         logger.debug(f"Calling API: {method} {url}")
-        timeout = 250 if "chat" in endpoint else 10 
+        timeout = CHAT_TIMEOUT if "chat" in endpoint else SERVER_TIMEOUT
+        if WIRE_FORMAT == "msgpack" and wire_protocol.msgpack_available():
+            headers = {**wire_protocol.request_headers(), **(headers or {})}
+        headers = tracer.headers(headers)
         
         if method == "GET":
-            response = requests.get(url, timeout=timeout)
+            response = requests.get(url, headers=headers, timeout=timeout)
         else:
-            response = requests.post(url, json=data, timeout=timeout)
+            response = requests.post(url, json=data, headers=headers, timeout=timeout)
+        span.set(status_code=response.status_code)
+        
+        if meta is not None:
+            meta["status_code"] = response.status_code
+            meta["etag"] = response.headers.get("ETag")
+        if response.status_code == 304:
+            return {"success": True, "not_modified": True}
         
         response.raise_for_status() 
         logger.debug(f"API call successful: {url}")
+        if wire_protocol.MSGPACK_CONTENT_TYPE in response.headers.get('Content-Type', ''):
+            return wire_protocol.decode(response.content)
         if 'application/json' in response.headers.get('Content-Type', ''):
             return response.json()
         else:
@@ -474,9 +741,135 @@ def call_api(endpoint, method="GET", data=None):
     except json.JSONDecodeError as e:
         logger.error(f"Failed to decode JSON response from {url}: {e}. Response text (first 200 chars): {response.text[:200] if 'response' in locals() else 'Response object not available'}")
         return {"success": False, "error": "Invalid JSON response from server"}
+    finally:
+        tracer.end(span)
+
+def stream_api(endpoint, data):
+    """POST to a streaming server endpoint and yield its NDJSON lines as dicts.
+    Raises requests exceptions so callers can fall back to call_api."""
+    url = f"{LLM_SERVER_URL}{endpoint}"
+    with tracer.span(f"server POST {endpoint}", kind="client") as span:
+        with requests.post(url, json=data, headers=tracer.headers(), stream=True, timeout=(5, CHAT_TIMEOUT)) as response:
+            span.set(status_code=response.status_code)
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+# Read-through cache for server proxy endpoints, TTLs in seconds by endpoint prefix
+PROXY_CACHE_TTLS = settings["proxy_cache_ttls"]
+
+class ProxyCache:
+    """Read-through cache for server calls made on behalf of the browser.
+    
+    Fresh entries are served without a network hop, expired ones are revalidated
+    with If-None-Match, and when the server fails or is offline the last good
+    response is served instead of the hard-coded fallbacks.
+    """
+    def __init__(self, ttls):
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stale_served": 0}
+    
+    def _ttl(self, endpoint):
+        for prefix, ttl in self.ttls.items():
+            if endpoint.startswith(prefix):
+                return ttl
+        return 0
+    
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+    
+    def fetch(self, endpoint, method="GET", data=None, is_valid=None):
+        """Return the server response for endpoint, from cache when possible.
+        
+        Returns None when the server is offline and nothing is cached.
+        """
+        key = (method, endpoint, json.dumps(data, sort_keys=True) if data is not None else None)
+        with self.lock:
+            entry = self.entries.get(key)
+        
+        if entry and time.time() - entry["stored_at"] < self._ttl(endpoint):
+            self._count("hits")
+            return entry["body"]
+        
+        if not connection_status["connected"]:
+            if entry:
+                self._count("stale_served")
+                return entry["body"]
+            return None
+        
+        headers = {"If-None-Match": entry["etag"]} if entry and entry["etag"] else None
+        meta = {}
+        api_response = call_api(endpoint, method=method, data=data, headers=headers, meta=meta)
+        
+        if meta.get("status_code") == 304 and entry:
+            self._count("revalidated")
+            with self.lock:
+                entry["stored_at"] = time.time()
+            return entry["body"]
+        
+        valid = api_response and api_response.get("success", True) and (is_valid is None or is_valid(api_response))
+        if valid:
+            self._count("misses")
+            with self.lock:
+                self.entries[key] = {"body": api_response, "etag": meta.get("etag"), "stored_at": time.time()}
+            return api_response
+        
+        if entry:
+            logger.warning(f"Server call to {endpoint} failed, serving cached response. Response: {api_response}")
+            self._count("stale_served")
+            return entry["body"]
+        return api_response
+    
+    def invalidate(self, prefix):
+        with self.lock:
+            for key in [key for key in self.entries if key[1].startswith(prefix)]:
+                del self.entries[key]
+    
+    def status(self):
+        with self.lock:
+            return {"entries": len(self.entries), **self.stats}
+
+proxy_cache = ProxyCache(PROXY_CACHE_TTLS)
+
+def apply_settings(changed):
+    """Hot-reload hook: copy reloaded settings into the module constants and the caches built from them"""
+    global SERVER_TIMEOUT, CHAT_TIMEOUT, CONNECTION_CHECK_INTERVAL, PICKUP_THRESHOLD_CM
+    global MISSED_DOSE_GRACE_S, MISSED_DOSE_CHECK_INTERVAL, SSE_KEEPALIVE_INTERVAL
+    SERVER_TIMEOUT = settings["server_timeout_s"]
+    CHAT_TIMEOUT = settings["chat_timeout_s"]
+    CONNECTION_CHECK_INTERVAL = settings["connection_check_interval_s"]
+    PICKUP_THRESHOLD_CM = settings["pickup_threshold_cm"]
+    MISSED_DOSE_GRACE_S = settings["missed_dose_grace_s"]
+    MISSED_DOSE_CHECK_INTERVAL = settings["missed_dose_check_interval_s"]
+    SSE_KEEPALIVE_INTERVAL = settings["sse_keepalive_s"]
+    weather_cache.ttl = settings["weather_cache_ttl_s"]
+    weather_cache.stale_ttl = settings["weather_stale_ttl_s"]
+    weather_cache.negative_ttl = settings["weather_negative_ttl_s"]
+    proxy_cache.ttls = settings["proxy_cache_ttls"]
+    continuous_profiler.hz = settings["profile_hz"]
+
+settings.on_change(apply_settings)
+
+# Profiles parsed from the cached /api/users body; rebuilt only when the cache hands back a different body
+user_profiles_cache = {"body": None, "profiles": []}
+OFFLINE_PROFILES = [user_model.UserProfile.from_dict(
+    {"id": "1", "personal": {"name": "Default User", "age": 40, "gender": "Unknown"},
+     "medications": [
+         {"name": "Paracetamol", "dosage": "500mg", "schedule": "As needed", "slot": 1},
+         {"name": "Antibiotic", "dosage": "250mg", "schedule": "Every 8 hours", "slot": 2}]})]
+
+def profiles_from_response(body):
+    if user_profiles_cache["body"] is not body:
+        user_profiles_cache["profiles"] = [user_model.UserProfile.from_dict(u, strict=False) for u in body["users"]]
+        user_profiles_cache["body"] = body
+    return user_profiles_cache["profiles"]
 
 def check_server_connection():
-    api_response = call_api("/api/heartbeat") 
+    api_response = call_api("/api/heartbeat", method="POST", data=telemetry.report())
     if api_response and api_response.get("status") == "ok":
         return True
     return False
@@ -487,7 +880,9 @@ def register_with_server():
         "client_type": "raspberry_pi",
         "client_ip": local_ip,
         "client_version": "1.0",
-        "hardware_mode": "real" if not hardware.mock_mode else "mock"
+        "device_id": DEVICE_ID,
+        "hardware_mode": hardware.mode_name,
+        "wire_formats": wire_protocol.supported_formats() if WIRE_FORMAT == "msgpack" else ["json"]
     }
     api_response = call_api("/api/register_client", method="POST", data=data)
     if api_response and api_response.get("success", True) != False : 
@@ -533,6 +928,13 @@ def generate_local_response(user_input):
         else:
             return f"Failed to rotate servo: {result.get('message', 'Unknown error')}"
     
+    # Free-text questions go to the on-device model when one is configured; dispense
+    # requests stay on the fixed replies so the model never claims an action it did not take
+    if local_llm_tier and not any(word in user_input_lower for word in ["dispense", "give", "take"]):
+        answer = local_llm_tier.generate(user_input)
+        if answer:
+            return answer
+    
     # Existing medication responses
     if any(word in user_input_lower for word in ["headache", "pain", "hurt", "head", "ache"]):
         return "For headaches, I recommend taking Paracetamol from slot 1. Would you like me to dispense it for you?"
@@ -553,9 +955,204 @@ def generate_local_response(user_input):
 # Chat history - local cache
 chat_history = []
 
+# Server-sent events for the web UI
+SSE_REPLAY_SIZE = 500  # Events kept for reconnecting browsers
+SSE_KEEPALIVE_INTERVAL = settings["sse_keepalive_s"]
+
+class EventBus:
+    """Fan-out of UI events to SSE subscribers with a replay buffer.
+    
+    Every event gets an increasing id; a browser reconnecting with Last-Event-ID
+    (or ?cursor=) receives whatever it missed from the replay buffer.
+    """
+    def __init__(self, replay_size):
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.replay = deque(maxlen=replay_size)
+        self.subscribers = set()
+    
+    def publish(self, event_type, data):
+        with self.lock:
+            event = {"id": self.next_id, "type": event_type, "data": data}
+            self.next_id += 1
+            self.replay.append(event)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+        return event
+    
+    def subscribe(self, cursor=None):
+        """Register a subscriber queue, pre-filled with events after cursor"""
+        subscriber = queue.Queue()
+        with self.lock:
+            if cursor is not None:
+                for event in self.replay:
+                    if event["id"] > cursor:
+                        subscriber.put(event)
+            self.subscribers.add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+    
+    def status(self):
+        with self.lock:
+            return {"subscribers": len(self.subscribers), "last_event_id": self.next_id - 1, "buffered": len(self.replay)}
+
+event_bus = EventBus(SSE_REPLAY_SIZE)
+last_published_schedule = {"schedule": None}
+
+def add_chat_message(message_type, sender, message):
+    """Append to the local chat history and push it to open browser tabs"""
+    entry = {'type': message_type, 'sender': sender, 'message': message, 'timestamp': datetime.now().strftime('%H:%M:%S')}
+    chat_history.append(entry)
+    event_bus.publish("chat", entry)
+    return entry
+
+def publish_schedule_if_changed(schedule):
+    """Push a schedule event only when the schedule differs from the last one sent"""
+    if schedule != last_published_schedule["schedule"]:
+        last_published_schedule["schedule"] = schedule
+        event_bus.publish("schedule", schedule)
+
+class DeviceTelemetry:
+    """Daily counts and recent sensor outcomes this Pi sends with each heartbeat.
+    
+    Counts are totals for the day, not increments, so the server can apply a
+    report twice or miss one without miscounting. They are saved to path after
+    every change and reloaded on start, so a reboot keeps the day's totals;
+    boot_id tells the server when this process started over anyway.
+    """
+    def __init__(self, path=None, window=SENSOR_WINDOW):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.boot_id = uuid.uuid4().hex
+        self.path = path
+        self.window = window
+        self.sensors = {}
+        self._reset_day(datetime.now().strftime('%Y-%m-%d'))
+        self._load()
+    
+    def _reset_day(self, day):
+        self.day = day
+        self.dispenses = 0
+        self.dispenses_by_user = {}
+        self.missed = set()
+        self.missed_by_user = {}
+    
+    def _roll(self):
+        day = datetime.now().strftime('%Y-%m-%d')
+        if day != self.day:
+            self._reset_day(day)
+    
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get("day") != self.day:
+                return
+            self.dispenses = int(state.get("dispenses", 0))
+            self.dispenses_by_user = {str(user_id): int(count) for user_id, count in state.get("dispenses_by_user", {}).items()}
+            self.missed = {tuple(dose_key) for dose_key in state.get("missed", [])}
+            self.missed_by_user = {str(user_id): int(count) for user_id, count in state.get("missed_by_user", {}).items()}
+            logger.info(f"Restored today's telemetry: {self.dispenses} dispenses, {len(self.missed)} missed doses")
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.error(f"Could not read saved telemetry {self.path}, starting the day from zero: {e}")
+    
+    def _save(self):
+        """Write the day's counts atomically; called with the lock held"""
+        if not self.path:
+            return
+        state = {"day": self.day, "dispenses": self.dispenses, "dispenses_by_user": self.dispenses_by_user,
+                 "missed": sorted(list(dose_key) for dose_key in self.missed), "missed_by_user": self.missed_by_user}
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not save telemetry to {self.path}: {e}")
+    
+    def dispensed(self, user_id=None):
+        with self.lock:
+            self._roll()
+            self.dispenses += 1
+            if user_id:
+                user_id = str(user_id)
+                self.dispenses_by_user[user_id] = self.dispenses_by_user.get(user_id, 0) + 1
+            self._save()
+    
+    def missed_dose(self, name, time_str, user_id=None):
+        """Count a missed dose once however often the reminder loop sees it.
+        
+        It is charged to user_id only when the schedule entry names one; otherwise
+        it counts for the device alone.
+        """
+        dose_key = (str(user_id) if user_id else "", name, time_str)
+        with self.lock:
+            self._roll()
+            if dose_key in self.missed:
+                return
+            self.missed.add(dose_key)
+            if user_id:
+                user_id = str(user_id)
+                self.missed_by_user[user_id] = self.missed_by_user.get(user_id, 0) + 1
+            self._save()
+    
+    def sensor(self, name, ok):
+        with self.lock:
+            self.sensors.setdefault(name, deque(maxlen=self.window)).append(bool(ok))
+    
+    def report(self):
+        with self.lock:
+            self._roll()
+            sensors = {}
+            for name, outcomes in self.sensors.items():
+                streak = 0
+                for ok in reversed(outcomes):
+                    if ok:
+                        break
+                    streak += 1
+                sensors[name] = {"reads": len(outcomes), "failures": outcomes.count(False), "consecutive_failures": streak}
+            return {
+                "device_id": DEVICE_ID,
+                "boot_id": self.boot_id,
+                "day": self.day,
+                "hardware_mode": hardware.mode_name,
+                "uptime_s": int(time.time() - self.started_at),
+                "queue_depth": local_llm_tier.waiting if local_llm_tier else 0,
+                "dispenses_today": self.dispenses,
+                "dispenses_by_user": dict(self.dispenses_by_user),
+                "missed_doses_today": len(self.missed),
+                "missed_by_user": dict(self.missed_by_user),
+                "sensors": sensors
+            }
+
+telemetry = DeviceTelemetry(TELEMETRY_STATE_PATH)
+command_log = command_queue.CommandLog(COMMAND_LOG_PATH)
+
+def read_distance():
+    """Distance in cm, with the outcome recorded for the sensor health report"""
+    distance = hardware.measure_distance()
+    telemetry.sensor("distance", distance < hardware_sim.NO_ECHO_DISTANCE)
+    return distance
+
 # Instantiate hardware controller
 hardware = HardwareController()
-local_ip = get_local_ip()
+tts_pipeline = tts.create_pipeline()
+local_llm_tier = local_llm.create_local_llm()  # None unless ZIMA_LOCAL_LLM=1
+
+def speak(text):
+    """Say text on the Pi speaker when a local TTS engine is installed"""
+    if tts_pipeline and text:
+        tts_pipeline.say(text)
+local_ip = "127.0.0.1"  # Replaced by get_local_ip() in the background startup tasks
 
 # Periodic connection check
 def periodic_connection_check():
@@ -566,18 +1163,14 @@ def periodic_connection_check():
                 connection_status["connected"] = connected
                 status_msg = "Online" if connected else "Offline"
                 logger.info(f"Server connection status changed to: {status_msg}")
+                event_bus.publish("connection", {"server_connected": connected, "server_url": LLM_SERVER_URL})
                 
-                chat_history.append({
-                    'type': 'system',
-                    'sender': 'System',
-                    'message': f'LLM server connection {"restored" if connected else "lost"}. Operating in {"online" if connected else "offline"} mode.',
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                })
+                add_chat_message('system', 'System', f'LLM server connection {"restored" if connected else "lost"}. Operating in {"online" if connected else "offline"} mode.')
                 if connected: 
                     register_with_server()
         except Exception as e:
             logger.error(f"Error in periodic connection check: {e}", exc_info=True)
-        time.sleep(30) 
+        time.sleep(CONNECTION_CHECK_INTERVAL)
 
 async def send_telegram_notification_async(message, priority="normal"):
     """Asynchronously send notification to caregiver via Telegram"""
@@ -587,7 +1180,7 @@ async def send_telegram_notification_async(message, priority="normal"):
         logger.info(f"Telegram notifications globally disabled. Would have sent: {message}")
         return False
 
-    if not telegram: 
+    if not load_telegram(): 
         logger.error("Telegram library object is None (import likely failed). Cannot send notification.")
         return False
 
@@ -675,6 +1268,7 @@ def check_missed_medications():
                 api_response = call_api("/api/get_schedule")
                 if api_response and api_response.get("success", True) and isinstance(api_response.get("today"), list):
                     medications = api_response.get("today", [])
+                    publish_schedule_if_changed(api_response)
                 else:
                     logger.warning(f"Failed to get schedule or invalid format from server for missed medication check. Response: {api_response}")
             else:
@@ -695,42 +1289,54 @@ def check_missed_medications():
                 if med_time_str and med_status == "upcoming":
                     try:
                         med_datetime = datetime.strptime(f"{now.strftime('%Y-%m-%d')} {med_time_str}", "%Y-%m-%d %H:%M")
-                        if now > med_datetime and (now - med_datetime).total_seconds() > 1800: 
+                        if now > med_datetime and (now - med_datetime).total_seconds() > MISSED_DOSE_GRACE_S:
                             logger.warning(f"Missed medication detected: {med_name} at {med_time_str}. Sending notification.")
+                            telemetry.missed_dose(med_name, med_time_str, med.get("user_id"))
+                            speak(f"Reminder: it is time to take your {med_name}.")
                             run_send_telegram_notification(
                                 f"MISSED MEDICATION: {med_name} scheduled for {med_time_str} hasn't been taken.",
                                 priority="warning"
                             )
                     except ValueError:
                         logger.error(f"Invalid time format for medication '{med_name}': '{med_time_str}'")
-            time.sleep(15 * 60)
+            time.sleep(MISSED_DOSE_CHECK_INTERVAL)
         except Exception as e:
             logger.error(f"Error in medication reminder check: {e}", exc_info=True)
             time.sleep(60)
 
+# Message schema used when the server negotiates the compact wire encoding
+WIRE_MESSAGE_TYPES = {
+    "get_distance": "sensor_event",
+    "check_pill_pickup": "sensor_event",
+    "handle_function_call": "result",
+    "dispense": "result",
+    "rotate_servo": "result"
+}
+
+@app.after_request
+def encode_wire_response(response):
+    """Send msgpack to the server when it asked for it and compress large bodies"""
+    if response.mimetype == 'text/event-stream':
+        return response
+    return wire_protocol.encode_flask_response(response, request, WIRE_MESSAGE_TYPES.get(request.endpoint, "raw"))
+
 # Flask routes
 @app.route('/')
 def index():
     try:
-        users_data = {"users": []}
-        if connection_status["connected"]:
-            server_response = call_api("/api/users")
-            if server_response and server_response.get("success", True) and isinstance(server_response.get("users"), list):
-                users_data = {"users": server_response.get("users", [])}
+        profiles = []
+        server_response = proxy_cache.fetch("/api/users", is_valid=lambda r: isinstance(r.get("users"), list))
+        if server_response is not None:
+            if server_response.get("success", True) and isinstance(server_response.get("users"), list):
+                profiles = profiles_from_response(server_response)
             else:
                 logger.warning(f"Failed to get user data or invalid format from server for index page. Response: {server_response}")
         else:
-            users_data = {"users": [
-                {"id": "1", "personal": {"name": "Default User", "age": 40, "gender": "Unknown"},
-                 "medications": [
-                     {"name": "Paracetamol", "dosage": "500mg", "schedule": "As needed", "slot": 1},
-                     {"name": "Antibiotic", "dosage": "250mg", "schedule": "Every 8 hours", "slot": 2}]}
-            ]}
+            profiles = OFFLINE_PROFILES
         current_user_id = "1"
-        user = next((u for u in users_data.get('users', []) if u.get('id') == current_user_id), {})
-        user_options = [{'id': u.get('id'), 'name': u.get('personal', {}).get('name', 'Unknown')} 
-                        for u in users_data.get('users', [])]
-        return render_template('index.html', chat_history=chat_history, user_data=user,
+        profile = next((p for p in profiles if p.id == current_user_id), None)
+        user_options = [p.summary() for p in profiles]
+        return render_template('index.html', chat_history=chat_history, profile=profile,
                                current_user=current_user_id, user_options=user_options,
                                server_connected=connection_status["connected"], server_url=LLM_SERVER_URL)
     except Exception as e:
@@ -742,34 +1348,84 @@ def error_page():
     error = request.args.get('message', 'Unknown error')
     return render_template('error.html', error=error)
 
-@app.route('/dispense/<int:compartment>', methods=['POST'])
-def dispense(compartment):
+def dispense_safety_verdict(user_id, compartment):
+    """Server's precomputed verdict for this user and slot, from the proxy cache when offline; None if unknown"""
+    api_response = proxy_cache.fetch(f"/api/users/{user_id}/safety", is_valid=lambda r: "safety" in r)
+    if not (api_response and api_response.get("safety")):
+        logger.warning(f"No safety verdict available for user {user_id}")
+        return None
+    return api_response["safety"].get("slots", {}).get(str(compartment))
+
+def perform_dispense(compartment, user_id=None, check_safety=True):
+    """(response body, status code) for dispensing from compartment"""
+    if compartment in [1, 2] and user_id and check_safety:
+        verdict = dispense_safety_verdict(user_id, compartment)
+        if verdict is None:
+            # Fail closed: dispensing unchecked for a known user needs an explicit override
+            add_chat_message('error', 'System', f"Compartment {compartment} not dispensed: no safety check available for this user")
+            logger.warning(f"Dispense from compartment {compartment} refused for user {user_id}: safety verdict unknown")
+            return {'error': 'No safety verdict available, resend with override to dispense anyway', 'safety_unknown': True}, 409
+        if verdict.get("level") == "block":
+            reasons = "; ".join(c["note"] for c in verdict.get("conflicts", []))
+            add_chat_message('error', 'System', f"{verdict['drug']} not dispensed for safety reasons: {reasons}")
+            logger.warning(f"Dispense from compartment {compartment} blocked for user {user_id}: {reasons}")
+            return {'error': 'Dispense blocked by safety check', 'safety': verdict}, 409
     if compartment in [1, 2]:
         hardware.dispense_pill(compartment)
+        telemetry.dispensed(user_id)
         med_name = "Paracetamol" if compartment == 1 else "Antibiotic"
-        chat_history.append({
-            'type': 'system', 'sender': 'System',
-            'message': f'{med_name} dispensed from compartment {compartment}',
-            'timestamp': datetime.now().strftime('%H:%M:%S')})
+        add_chat_message('system', 'System', f'{med_name} dispensed from compartment {compartment}')
+        event_bus.publish("dispense", {"compartment": compartment, "medication": med_name})
         logger.info(f"Dispensed {med_name} from compartment {compartment}")
-        return jsonify({'status': f'{med_name} dispensed from compartment {compartment}'})
+        return {'status': f'{med_name} dispensed from compartment {compartment}'}, 200
     logger.warning(f"Invalid compartment number: {compartment}")
-    return jsonify({'error': 'Invalid compartment number'}), 400
+    return {'error': 'Invalid compartment number'}, 400
+
+@app.route('/dispense/<int:compartment>', methods=['POST'])
+def dispense(compartment):
+    # The browser sends the selected user; the server checks its own dispense requests before calling here
+    data = request.get_json(silent=True) or {}
+    body, status_code = perform_dispense(compartment, data.get('user_id'), check_safety=not data.get('override'))
+    return jsonify(body), status_code
+
+def execute_command(command):
+    """Run one queued server command; called at most once per command id"""
+    args = command.get("args") or {}
+    if command.get("function") == "dispense_pill":
+        # The server ran the safety check before queueing
+        body, status_code = perform_dispense(args.get("compartment"), command.get("user_id"), check_safety=False)
+        return {"success": status_code == 200, **body}
+    return {"success": False, "error": f"Unknown command: {command.get('function')}"}
+
+@app.route('/commands', methods=['POST'])
+def run_commands():
+    """Run a batch of server commands in order; a command id seen before returns its stored result"""
+    commands = (request.get_json(silent=True) or {}).get("commands", [])
+    results = [command_log.run(command, execute_command) for command in commands]
+    return jsonify({"results": results})
+
+@app.route('/commands/status', methods=['GET'])
+def commands_status():
+    return jsonify(command_log.status())
+
+@app.route('/config', methods=['GET'])
+def get_config():
+    """Effective settings and where each came from; read-only, edit the config file to change them"""
+    return jsonify(settings.snapshot())
 
 @app.route('/distance', methods=['GET'])
 def get_distance():
-    distance = hardware.measure_distance()
+    distance = read_distance()
     return jsonify({'distance_cm': distance})
 
 @app.route('/check_pill_pickup', methods=['GET'])
 def check_pill_pickup():
-    distance = hardware.measure_distance()
-    threshold = 10
-    pill_taken = distance < threshold
+    distance = read_distance()
+    pill_taken = distance < PICKUP_THRESHOLD_CM
     status = 'Pill taken' if pill_taken else 'Pill not taken'
     
     if pill_taken:
-        chat_history.append({'type': 'system', 'sender': 'System', 'message': 'Pill pickup detected', 'timestamp': datetime.now().strftime('%H:%M:%S')})
+        add_chat_message('system', 'System', 'Pill pickup detected')
         logger.info(f"Pill pickup detected. Distance: {distance} cm")
     else:
         med_info = request.args.get('medication', 'Medication')
@@ -779,9 +1435,8 @@ def check_pill_pickup():
             f"Patient hasn't picked up {med_info} scheduled for {time_info}. Distance: {distance} cm.",
             priority="warning"
         )
-        chat_history.append({'type': 'system', 'sender': 'System', 
-                             'message': f'Pill ({med_info}) not picked up. Caregiver notified. Distance: {distance} cm.',
-                             'timestamp': datetime.now().strftime('%H:%M:%S')})
+        add_chat_message('system', 'System', f'Pill ({med_info}) not picked up. Caregiver notified. Distance: {distance} cm.')
+    event_bus.publish("pickup", {'status': status, 'distance_cm': distance, 'pill_taken': pill_taken})
     return jsonify({'status': status, 'distance_cm': distance, 'pill_taken': pill_taken})
 
 @app.route('/weather', methods=['GET'])
@@ -793,23 +1448,18 @@ def get_weather():
     weather_data = get_weather_data(city, units)
     
     if weather_data.get('success'):
-        chat_history.append({
-            'type': 'system',
-            'sender': 'Weather',
-            'message': f"Weather in {weather_data['city']}: {weather_data['temperature']}°{'C' if units=='metric' else 'F'}, {weather_data['description']}",
-            'timestamp': datetime.now().strftime('%H:%M:%S')
-        })
+        add_chat_message('system', 'Weather', f"Weather in {weather_data['city']}: {weather_data['temperature']}°{'C' if units=='metric' else 'F'}, {weather_data['description']}")
         logger.info(f"Weather data retrieved for {city}")
     else:
-        chat_history.append({
-            'type': 'error',
-            'sender': 'Weather',
-            'message': f"Failed to get weather for {city}: {weather_data.get('message', 'Unknown error')}",
-            'timestamp': datetime.now().strftime('%H:%M:%S')
-        })
+        add_chat_message('error', 'Weather', f"Failed to get weather for {city}: {weather_data.get('message', 'Unknown error')}")
     
     return jsonify(weather_data)
 
+@app.route('/weather/cache', methods=['GET'])
+def weather_cache_status():
+    """Weather cache hit/miss counters"""
+    return jsonify({"success": True, "cache": weather_cache.status()})
+
 @app.route('/servo_rotate', methods=['POST'])
 def rotate_servo():
     """Rotate servo motor by 90 degrees"""
@@ -825,22 +1475,14 @@ def rotate_servo():
         }), 400
     
     result = hardware.rotate_servo_90_degrees(servo_num, direction)
+    if servo_num in [1, 2]:
+        telemetry.sensor("servo", result.get('success'))
     
     if result.get('success'):
-        chat_history.append({
-            'type': 'system',
-            'sender': 'Hardware',
-            'message': f"Servo {servo_num} rotated 90° {direction}",
-            'timestamp': datetime.now().strftime('%H:%M:%S')
-        })
+        add_chat_message('system', 'Hardware', f"Servo {servo_num} rotated 90° {direction}")
         logger.info(f"Servo {servo_num} rotated 90° {direction} via manual control")
     else:
-        chat_history.append({
-            'type': 'error',
-            'sender': 'Hardware',
-            'message': f"Failed to rotate servo {servo_num}: {result.get('message', 'Unknown error')}",
-            'timestamp': datetime.now().strftime('%H:%M:%S')
-        })
+        add_chat_message('error', 'Hardware', f"Failed to rotate servo {servo_num}: {result.get('message', 'Unknown error')}")
     
     return jsonify(result)
 
@@ -863,6 +1505,71 @@ def get_servo_position_route(servo_num):
             'message': 'Servo number must be 1 or 2'
         }), 400
 
+@app.route('/hardware/sim', methods=['GET', 'POST'])
+def hardware_sim_control():
+    """Simulator state, failure injection and scripted pickups"""
+    if not isinstance(hardware.backend, hardware_sim.SimulatedHardware):
+        return jsonify({'success': False, 'error': 'Simulator not active',
+                        'message': 'Start the client with ZIMA_HARDWARE_BACKEND=sim'}), 404
+
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            if 'inject' in data:
+                hardware.backend.inject_failure(data['inject'], int(data.get('count', 1)))
+            for kind, rate in data.get('failure_rates', {}).items():
+                hardware.backend.set_failure_rate(kind, rate)
+            if 'pickup_in' in data:
+                hardware.backend.schedule_pickup(float(data['pickup_in']))
+        except (ValueError, TypeError) as e:
+            return jsonify({'success': False, 'error': 'Invalid simulator command', 'message': str(e)}), 400
+
+    return jsonify({'success': True, 'simulator': hardware.backend.status()})
+
+@app.route('/debug/traces', methods=['GET'])
+def debug_traces():
+    """Spans recorded on the Pi; the server merges these into /api/debug/traces?clients=1"""
+    trace_id = request.args.get('trace_id')
+    return jsonify({
+        'success': True,
+        'spans': tracer.recent_spans(trace_id),
+        'traces': tracer.traces(limit=request.args.get('limit', 20, type=int), trace_id=trace_id)
+    })
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """Sample all thread stacks for ?seconds at ?hz and return collapsed stacks"""
+    allowed, status_code, message = profiling.check_token(request)
+    if not allowed:
+        return jsonify({'success': False, 'error': message}), status_code
+    
+    result = sampling_profiler.profile(request.args.get('seconds', 10, type=float),
+                                       request.args.get('hz', 100, type=float),
+                                       include_idle=request.args.get('idle') == '1')
+    if result is None:
+        return jsonify({'success': False, 'error': 'A profile is already running'}), 409
+    stacks, samples = result
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'success': True,
+            'samples': samples,
+            'stacks': [{'stack': stack, 'count': count} for stack, count in stacks.most_common()]
+        })
+    return Response(profiling.collapsed_text(stacks), mimetype='text/plain')
+
+@app.route('/debug/profile/hot', methods=['GET'])
+def debug_profile_hot():
+    """Hottest functions seen by the continuous profiler over the last ?minutes"""
+    allowed, status_code, message = profiling.check_token(request)
+    if not allowed:
+        return jsonify({'success': False, 'error': message}), status_code
+    return jsonify({
+        'success': True,
+        'profile': continuous_profiler.hot_functions(request.args.get('minutes', 60, type=int),
+                                                     request.args.get('top', 30, type=int))
+    })
+
 @app.route('/function_call', methods=['POST'])
 def handle_function_call():
     """Handle function calls from the LLM or UI"""
@@ -898,97 +1605,300 @@ def handle_function_call():
 @app.route('/llm_response', methods=['POST'])
 def llm_response():
     user_input = request.json.get('message', '')
-    chat_history.append({'type': 'user', 'sender': 'You', 'message': user_input, 'timestamp': datetime.now().strftime('%H:%M:%S')})
+    add_chat_message('user', 'You', user_input)
     logger.info(f"User message: {user_input}")
     
     response_text = ""
     if not connection_status["connected"]:
         logger.warning("Server not connected, using local fallback response")
         response_text = generate_local_response(user_input)
+        speak(response_text)
+    elif tts_pipeline:
+        # Stream the reply so speech starts with the first finished sentence
+        session = tts_pipeline.session()
+        pieces = []
+        try:
+            for line in stream_api("/api/chat_stream", {"message": user_input}):
+                if line.get("text"):
+                    pieces.append(line["text"])
+                    session.feed(line["text"])
+        except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+            logger.warning(f"Streaming LLM response failed, falling back to /api/chat: {e}")
+        response_text = "".join(pieces)
+        if not response_text:
+            response_text = request_llm_reply(user_input)
+            session.feed(response_text)
+        session.close()
     else:
-        api_response = call_api("/api/chat", method="POST", data={"message": user_input})
-        if api_response and api_response.get("success", True) and isinstance(api_response.get("response"), str) :
-            response_text = api_response.get("response")
-        else:
-            err_msg = api_response.get('error', 'Unknown error') if api_response else "No response from API"
-            logger.warning(f"Failed to get LLM response or invalid format: {err_msg}. Response: {api_response}")
-            response_text = generate_local_response(user_input)
+        response_text = request_llm_reply(user_input)
     
-    chat_history.append({'type': 'bot', 'sender': 'Assistant', 'message': response_text, 'timestamp': datetime.now().strftime('%H:%M:%S')})
+    add_chat_message('bot', 'Assistant', response_text)
     return jsonify({'response': response_text})
 
-@app.route('/voice_command', methods=['POST'])
-def voice_command():
-    command = request.json.get("command", "")
-    logger.info(f"Received voice command: {command}")
-    chat_history.append({'type': 'user', 'sender': 'Voice', 'message': command, 'timestamp': datetime.now().strftime('%H:%M:%S')})
+def request_llm_reply(user_input):
+    """Whole reply from the server's /api/chat, or the local fallback"""
+    api_response = call_api("/api/chat", method="POST", data={"message": user_input})
+    if api_response and api_response.get("success", True) and isinstance(api_response.get("response"), str) :
+        return api_response.get("response")
+    err_msg = api_response.get('error', 'Unknown error') if api_response else "No response from API"
+    logger.warning(f"Failed to get LLM response or invalid format: {err_msg}. Response: {api_response}")
+    return generate_local_response(user_input)
+
+# Voice intents that are complete once recognised, so a stable partial transcript may trigger them.
+# Emergency waits for the final transcript: "help me check the weather" starts with a stable "help me".
+EARLY_VOICE_INTENTS = {"rotate", "dispense", "measure"}
+VOICE_EARLY_STABLE_PARTIALS = 2  # Consecutive partials that must agree before acting early
+VOICE_CHUNK_BYTES = 3200  # 100 ms of 16 kHz 16-bit mono audio
+
+def said(text, *phrases):
+    """True when any phrase occurs in text as whole words, so 'one' does not match 'phone'"""
+    return re.search(r"\b(?:" + "|".join(re.escape(phrase) for phrase in phrases) + r")\b", text) is not None
+
+def classify_voice_command(command):
+    """Return (intent, params, complete) for a voice command.
     
-    response_text = ""
+    complete is False when a parameter was defaulted rather than heard, e.g. "rotate servo"
+    without a number, so a partial transcript is not acted on before the rest arrives.
+    """
     command_lower = command.lower()
 
     # Weather commands
-    if any(word in command_lower for word in ["weather", "temperature", "forecast"]):
+    if said(command_lower, "weather", "temperature", "forecast"):
         city = DEFAULT_CITY
         for word in command.split():
             if word.lower() not in ["weather", "in", "the", "what's", "how's"]:
                 city = word
                 break
-        
-        weather_data = get_weather_data(city)
-        if weather_data.get('success'):
-            temp_unit = "°C" if weather_data.get('units') == 'metric' else "°F"
-            response_text = f"The weather in {weather_data['city']} is {weather_data['temperature']}{temp_unit} with {weather_data['description']}"
-        else:
-            response_text = f"Sorry, I couldn't get weather information: {weather_data.get('message', 'Unknown error')}"
+        return "weather", {"city": city}, False
     
     # Servo rotation commands
-    elif any(word in command_lower for word in ["rotate", "turn", "servo", "motor"]):
+    elif said(command_lower, "rotate", "turn", "servo", "motor"):
         servo_num = 1
         direction = "clockwise"
+        counter = ("counterclockwise", "anticlockwise", "counter", "anti", "left")
         
-        if "2" in command_lower or "two" in command_lower:
+        if said(command_lower, "2", "two"):
             servo_num = 2
-        if "counter" in command_lower or "anti" in command_lower or "left" in command_lower:
+        if said(command_lower, *counter):
             direction = "counterclockwise"
-            
+        heard_servo = said(command_lower, "1", "one", "2", "two")
+        heard_direction = said(command_lower, "clockwise", "right", *counter)
+        return "rotate", {"servo_num": servo_num, "direction": direction}, heard_servo and heard_direction
+    
+    elif said(command_lower, "dispense") and said(command_lower, "paracetamol", "slot 1", "one"):
+        return "dispense", {"compartment": 1}, True
+    elif said(command_lower, "dispense") and said(command_lower, "antibiotic", "slot 2", "two"):
+        return "dispense", {"compartment": 2}, True
+    elif said(command_lower, "distance", "measure", "pickup", "check pill"):
+        return "measure", {}, True
+    elif said(command_lower, "emergency", "help"):
+        return "emergency", {}, True
+    return "chat", {}, False
+
+def dispense_spoken_response(compartment, body, status_code):
+    """What to say after a voice dispense, given perform_dispense's result"""
+    med_name = "Paracetamol" if compartment == 1 else "Antibiotic"
+    if status_code == 200:
+        return f"Dispensing {med_name} from compartment {compartment}."
+    if body.get('safety_unknown'):
+        return f"I can't check that {med_name} is safe for you right now, so I have not dispensed it. Please confirm on the screen."
+    if body.get('safety'):
+        reasons = " ".join(c["note"] for c in body['safety'].get("conflicts", []))
+        return f"I have not dispensed {med_name} for safety reasons. {reasons}".strip()
+    return f"Sorry, I couldn't dispense: {body.get('error', 'Unknown error')}"
+
+def execute_voice_intent(intent, params, command, user_id=None):
+    """Carry out a classified voice command.
+    
+    Returns (spoken response, dispense result), the result being perform_dispense's
+    (body, status code) for a dispense and None for anything else.
+    """
+    if intent == "weather":
+        weather_data = get_weather_data(params["city"])
+        if weather_data.get('success'):
+            temp_unit = "°C" if weather_data.get('units') == 'metric' else "°F"
+            return f"The weather in {weather_data['city']} is {weather_data['temperature']}{temp_unit} with {weather_data['description']}", None
+        return f"Sorry, I couldn't get weather information: {weather_data.get('message', 'Unknown error')}", None
+    
+    if intent == "rotate":
+        servo_num, direction = params["servo_num"], params["direction"]
         result = hardware.rotate_servo_90_degrees(servo_num, direction)
         if result.get('success'):
-            response_text = f"Servo {servo_num} rotated 90 degrees {direction}"
-        else:
-            response_text = f"Failed to rotate servo: {result.get('message', 'Unknown error')}"
-    
-    elif "dispense" in command_lower and ("paracetamol" in command_lower or "slot 1" in command_lower or "one" in command_lower):
-        hardware.dispense_pill(1)
-        response_text = "Dispensing Paracetamol from compartment 1."
-    elif "dispense" in command_lower and ("antibiotic" in command_lower or "slot 2" in command_lower or "two" in command_lower):
-        hardware.dispense_pill(2)
-        response_text = "Dispensing Antibiotic from compartment 2."
-    elif "distance" in command_lower or "measure" in command_lower or "pickup" in command_lower or "check pill" in command_lower:
-        distance = hardware.measure_distance()
-        response_text = f"Pill pickup {'detected' if distance < 10 else 'not detected'}. Distance is {distance} cm."
-    elif "emergency" in command_lower or "help" in command_lower:
-        chat_history.append({'type': 'error', 'sender': 'System', 'message': 'EMERGENCY ALERT TRIGGERED VIA VOICE', 'timestamp': datetime.now().strftime('%H:%M:%S')})
+            return f"Servo {servo_num} rotated 90 degrees {direction}", None
+        return f"Failed to rotate servo: {result.get('message', 'Unknown error')}", None
+    
+    if intent == "dispense":
+        # Same path as the UI button: safety verdict, telemetry and the dispense event
+        body, status_code = perform_dispense(params["compartment"], user_id)
+        return dispense_spoken_response(params["compartment"], body, status_code), (body, status_code)
+    
+    if intent == "measure":
+        distance = read_distance()
+        return f"Pill pickup {'detected' if distance < PICKUP_THRESHOLD_CM else 'not detected'}. Distance is {distance} cm.", None
+    
+    if intent == "emergency":
+        add_chat_message('error', 'System', 'EMERGENCY ALERT TRIGGERED VIA VOICE')
         run_send_telegram_notification("EMERGENCY ALERT triggered by voice command from patient.", priority="emergency")
-        response_text = "Emergency alert triggered. Help has been notified."
         logger.critical("EMERGENCY ALERT triggered by voice command.")
-    else:
-        if connection_status["connected"]:
-            api_response = call_api("/api/chat", method="POST", data={"message": command})
-            if api_response and api_response.get("success", True) and isinstance(api_response.get("response"), str):
-                response_text = api_response.get("response")
-            else:
-                logger.warning(f"LLM response for voice command failed or invalid format. Response: {api_response}")
-                response_text = generate_local_response(command)
-        else:
-            response_text = generate_local_response(command)
+        return "Emergency alert triggered. Help has been notified.", None
     
-    chat_history.append({'type': 'bot', 'sender': 'Bot', 'message': response_text, 'timestamp': datetime.now().strftime('%H:%M:%S')})
+    if connection_status["connected"]:
+        api_response = call_api("/api/chat", method="POST", data={"message": command})
+        if api_response and api_response.get("success", True) and isinstance(api_response.get("response"), str):
+            return api_response.get("response"), None
+        logger.warning(f"LLM response for voice command failed or invalid format. Response: {api_response}")
+    return generate_local_response(command), None
+
+def handle_voice_command(command, user_id=None):
+    """Log, execute and answer one transcribed voice command"""
+    logger.info(f"Received voice command: {command}")
+    add_chat_message('user', 'Voice', command)
+    intent, params, _ = classify_voice_command(command)
+    response_text, _ = execute_voice_intent(intent, params, command, user_id)
+    add_chat_message('bot', 'Bot', response_text)
+    speak(response_text)
     logger.info(f"Voice command response: {response_text}")
+    return response_text
+
+class VoiceIntentTracker:
+    """Watches partial transcripts and fires at most one early action per utterance"""
+    def __init__(self):
+        self.candidate = None
+        self.agreeing = 0
+        self.fired = None  # (intent, params, transcript, response) once an action ran
+    
+    def feed(self, hypothesis):
+        """Return (intent, params) when the partial is stable enough to act on now"""
+        if self.fired:
+            return None
+        intent, params, complete = classify_voice_command(hypothesis)
+        if intent not in EARLY_VOICE_INTENTS or not complete:
+            self.candidate, self.agreeing = None, 0
+            return None
+        if (intent, params) == self.candidate:
+            self.agreeing += 1
+        else:
+            self.candidate, self.agreeing = (intent, params), 1
+        return self.candidate if self.agreeing >= VOICE_EARLY_STABLE_PARTIALS else None
+
+@app.route('/voice_command', methods=['POST'])
+def voice_command():
+    # user_id is the user selected in the UI, so a spoken dispense gets their safety check
+    data = request.get_json(silent=True) or {}
+    response_text = handle_voice_command(data.get("command", ""), data.get("user_id"))
     return jsonify({"message": response_text})
 
+@app.route('/voice_stream', methods=['POST'])
+def voice_stream():
+    """Recognise streamed audio on the Pi and act on commands before the utterance ends.
+    
+    Send a chunked POST of audio/pcm;rate=16000 (little-endian), audio/L16;rate=16000
+    (big-endian, as RFC 2586 defines it) or length-prefixed audio/opus, with
+    ?user_id= naming the selected user so a spoken dispense gets their safety check.
+    The reply is NDJSON: "partial" events as the transcript grows, an "action" event
+    as soon as a hardware command is recognised, and a "final" event at the end.
+    An action that dispenses carries perform_dispense's body and status, so a
+    blocked or refused dispense shows up there.
+    """
+    try:
+        engine = speech.get_engine()
+        decoder = speech.decoder_for(request.content_type)
+    except speech.ASRUnavailable as e:
+        return jsonify({"success": False, "error": "Speech recognition unavailable", "message": str(e)}), 503
+    except ValueError as e:
+        return jsonify({"success": False, "error": "Unsupported audio", "message": str(e)}), 415
+    
+    asr_stream = engine.stream()
+    audio_in = request.stream
+    user_id = request.args.get("user_id")
+    
+    def generate():
+        tracker = VoiceIntentTracker()
+        start = time.time()
+        audio_bytes = 0
+        hypothesis = ""
+        timings = {"first_partial_ms": None, "action_ms": None}
+        
+        while True:
+            chunk = audio_in.read(VOICE_CHUNK_BYTES)
+            if not chunk:
+                break
+            pcm = decoder.decode(chunk)
+            if not pcm:
+                continue
+            audio_bytes += len(pcm)
+            partial = asr_stream.accept(pcm)
+            if not partial or partial == hypothesis:
+                continue
+            hypothesis = partial
+            if timings["first_partial_ms"] is None:
+                timings["first_partial_ms"] = round((time.time() - start) * 1000, 1)
+            event_bus.publish("voice_partial", {"text": hypothesis})
+            yield json.dumps({"type": "partial", "text": hypothesis}) + "\n"
+            
+            action = tracker.feed(hypothesis)
+            if action:
+                intent, params = action
+                logger.info(f"Acting on partial voice command '{hypothesis}': {intent} {params}")
+                add_chat_message('user', 'Voice', hypothesis)
+                response_text, dispense_result = execute_voice_intent(intent, params, hypothesis, user_id)
+                add_chat_message('bot', 'Bot', response_text)
+                speak(response_text)
+                tracker.fired = (intent, params, hypothesis, response_text)
+                timings["action_ms"] = round((time.time() - start) * 1000, 1)
+                event = {"type": "action", "intent": intent, "params": params, "text": hypothesis,
+                         "response": response_text,
+                         "audio_ms": round(audio_bytes / speech.BYTES_PER_SAMPLE / speech.SAMPLE_RATE * 1000)}
+                if dispense_result:
+                    event["result"], event["status"] = dispense_result
+                yield json.dumps(event) + "\n"
+        
+        final_text = asr_stream.finish() or hypothesis
+        if tracker.fired:
+            intent, params, _, response_text = tracker.fired
+            final_intent, final_params, _ = classify_voice_command(final_text)
+            if (final_intent, final_params) != (intent, params):
+                logger.warning(f"Final transcript '{final_text}' differs from the partial already acted on ({intent} {params})")
+        elif final_text:
+            response_text = handle_voice_command(final_text, user_id)
+        else:
+            response_text = ""
+        yield json.dumps({
+            "type": "final",
+            "text": final_text,
+            "response": response_text,
+            "early_action": bool(tracker.fired),
+            "audio_ms": round(audio_bytes / speech.BYTES_PER_SAMPLE / speech.SAMPLE_RATE * 1000),
+            "final_ms": round((time.time() - start) * 1000, 1),
+            **timings
+        }) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/tts/status', methods=['GET'])
+def tts_status():
+    """Speech engine, phrase cache counters and time to first audio"""
+    if not tts_pipeline:
+        return jsonify({"success": False, "error": "TTS unavailable",
+                        "message": "Install espeak-ng or piper, and leave ZIMA_TTS unset or 1"}), 404
+    return jsonify({"success": True, "tts": tts_pipeline.status()})
+
+@app.route('/local_llm/status', methods=['GET'])
+def local_llm_status():
+    """Offline fallback model, queue state, latency and rejection counters"""
+    if not local_llm_tier:
+        return jsonify({"success": False, "error": "Local model disabled",
+                        "message": "Set ZIMA_LOCAL_LLM=1 and run a small model in a local Ollama or llama.cpp server"}), 404
+    return jsonify({"success": True, "local_llm": local_llm_tier.status()})
+
+@app.route('/voice_stream/status', methods=['GET'])
+def voice_stream_status():
+    """Configured speech engine and which optional packages are installed"""
+    return jsonify({"success": True, "speech": speech.status()})
+
 @app.route('/emergency', methods=['POST'])
 def emergency():
-    chat_history.append({'type': 'error', 'sender': 'System', 'message': 'EMERGENCY ALERT TRIGGERED FROM UI', 'timestamp': datetime.now().strftime('%H:%M:%S')})
+    add_chat_message('error', 'System', 'EMERGENCY ALERT TRIGGERED FROM UI')
     run_send_telegram_notification("EMERGENCY ALERT triggered from the web interface.", priority="emergency")
     logger.critical("EMERGENCY ALERT TRIGGERED FROM UI")
     return jsonify({"status": "Emergency alert triggered and caregiver notified."})
@@ -997,9 +1907,10 @@ def emergency():
 def select_user_route(): 
     user_id = request.json.get('user_id', '')
     logger.info(f"Selecting user: {user_id}")
-    if connection_status["connected"]:
-        api_response = call_api("/api/select_user", method="POST", data={"user_id": user_id})
-        if api_response and api_response.get("success", True) and isinstance(api_response.get("user"), dict):
+    api_response = proxy_cache.fetch("/api/select_user", method="POST", data={"user_id": user_id},
+                                     is_valid=lambda r: isinstance(r.get("user"), dict))
+    if api_response is not None:
+        if api_response.get("success", True) and isinstance(api_response.get("user"), dict):
             return jsonify({"status": "success", "user": api_response.get("user")})
         else:
             err_msg = api_response.get('error', 'Unknown error') if api_response else "No response from API"
@@ -1013,7 +1924,10 @@ def select_user_route():
 def add_user_route(): 
     try:
         new_user_data = request.json
-        user_name = new_user_data.get('personal', {}).get('name', 'Unknown')
+        try:
+            user_name = user_model.UserProfile.from_dict(new_user_data).display_name
+        except user_model.ProfileError as e:
+            return jsonify({"status": "error", "message": str(e), "errors": e.errors}), 400
         logger.info(f"Attempting to add new user: {user_name}")
         if not connection_status["connected"]:
             logger.warning("Server offline, cannot add user via server.")
@@ -1025,7 +1939,8 @@ def add_user_route():
             logger.warning(f"Failed to add user: {err_msg}. Response: {api_response}")
             return jsonify({"status": "error", "message": err_msg}), 500
         
-        chat_history.append({'type': 'system', 'sender': 'System', 'message': f'New user created: {user_name}', 'timestamp': datetime.now().strftime('%H:%M:%S')})
+        proxy_cache.invalidate("/api/users")
+        add_chat_message('system', 'System', f'New user created: {user_name}')
         logger.info(f"User added successfully: ID {api_response.get('user_id')}")
         return jsonify({"status": "success", "user_id": api_response.get("user_id")})
     except Exception as e:
@@ -1034,13 +1949,13 @@ def add_user_route():
 
 @app.route('/get_medication_info/<int:slot>', methods=['GET'])
 def get_medication_info_route(slot): 
-    if not connection_status["connected"]:
+    api_response = proxy_cache.fetch(f"/api/get_medication_info/{slot}", is_valid=lambda r: bool(r.get("name")))
+    if api_response is None:
         if slot == 1: return jsonify({"name": "Paracetamol", "dosage": "500mg", "schedule": "As needed", "description": "Use for pain or fever...", "icon": "bi-capsule"})
         if slot == 2: return jsonify({"name": "Antibiotic", "dosage": "250mg", "schedule": "Every 8 hours", "description": "Take with food...", "icon": "bi-pill"})
         return jsonify({"error": "Invalid slot number"}), 400
     
-    api_response = call_api(f"/api/get_medication_info/{slot}")
-    if api_response and api_response.get("success", True) and api_response.get("name"): 
+    if api_response.get("success", True) and api_response.get("name"): 
         return jsonify(api_response) 
     else:
         err_msg = api_response.get('error', 'Unknown error') if api_response else f"No response or missing name for slot {slot}"
@@ -1051,9 +1966,11 @@ def get_medication_info_route(slot):
 
 @app.route('/get_schedule', methods=['GET'])
 def get_schedule_route(): 
-    if connection_status["connected"]:
-        api_response = call_api("/api/get_schedule")
-        if api_response and api_response.get("success", True) and isinstance(api_response.get("today"), list) and isinstance(api_response.get("upcoming"), dict):
+    api_response = proxy_cache.fetch("/api/get_schedule",
+                                     is_valid=lambda r: isinstance(r.get("today"), list) and isinstance(r.get("upcoming"), dict))
+    if api_response is not None:
+        if api_response.get("success", True) and isinstance(api_response.get("today"), list) and isinstance(api_response.get("upcoming"), dict):
+            publish_schedule_if_changed(api_response)
             return jsonify(api_response)
         else:
             logger.warning(f"Failed to get schedule from server or invalid format. Response: {api_response}")
@@ -1067,23 +1984,99 @@ def get_schedule_route():
             {"name": "Paracetamol (Local)", "dosage": "500mg", "time": f"{next_hour:02d}:00", "slot": 1, "status": "upcoming"}
         ]})
 
+@app.route('/events', methods=['GET'])
+def events_stream():
+    """Server-sent events stream of chat, connection, dispense, pickup and schedule updates"""
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    try:
+        cursor = int(cursor) if cursor is not None else None
+    except ValueError:
+        cursor = None
+    subscriber = event_bus.subscribe(cursor)
+    
+    def generate():
+        try:
+            # A fresh tab gets the current connection state, a reconnecting one its missed events
+            if cursor is None:
+                hello = {"server_connected": connection_status["connected"], "server_url": LLM_SERVER_URL,
+                         "last_event_id": event_bus.status()["last_event_id"]}
+                yield f"event: connection\ndata: {json.dumps(hello)}\n\n"
+            while True:
+                try:
+                    event = subscriber.get(timeout=SSE_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+        finally:
+            event_bus.unsubscribe(subscriber)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/proxy_cache', methods=['GET'])
+def proxy_cache_status():
+    """Read-through cache counters for server proxy endpoints"""
+    return jsonify({"success": True, "cache": proxy_cache.status()})
+
 @app.route('/connection_status', methods=['GET'])
 def connection_status_endpoint():
     return jsonify({"server_connected": connection_status["connected"], "server_url": LLM_SERVER_URL, "client_ip": local_ip})
 
-if __name__ == '__main__':
-    logger.info(f"Starting Raspberry Pi client (IP: {local_ip})")
-    logger.info(f"Connecting to LLM server at: {LLM_SERVER_URL}")
+@app.route('/startup_status', methods=['GET'])
+def startup_status():
+    """How long each startup phase took, in ms since the process started"""
+    return jsonify({"success": True, "phases": startup_phases, **startup_state})
 
-    # Explicitly check and log telegram library status
-    if telegram is None:
-        logger.error("FATAL STARTUP ERROR: 'python-telegram-bot' library object is None (Import failed).")
-        TELEGRAM_ENABLED = False
-    else:
-        logger.info("'python-telegram-bot' library appears to be imported successfully.")
+def wait_until_serving(port, timeout=10):
+    """Block until Flask accepts connections on port, so the time to serve can be recorded"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(0.02)
+    return False
 
+def run_startup_tasks():
+    """Network probes, server registration and Telegram checks, run once the UI is being served"""
+    global local_ip, TELEGRAM_ENABLED
+    if wait_until_serving(5001):
+        startup_state["serving_ms"] = ms_since_start()
+        logger.info(f"Local UI and hardware endpoints serving {startup_state['serving_ms']} ms after start")
+    
+    with startup_phase("local_ip"):
+        local_ip = get_local_ip()
+        logger.info(f"Raspberry Pi client IP: {local_ip}")
+    
+    with startup_phase("server_registration"):
+        initial_connection = check_server_connection()
+        connection_status["connected"] = initial_connection
+        if initial_connection:
+            event_bus.publish("connection", {"server_connected": True, "server_url": LLM_SERVER_URL})
+            if not register_with_server():
+                logger.warning("Initial registration with server failed despite connection.")
+            else:
+                logger.info("Server connected and client registered. Operating in connected mode.")
+        else:
+            logger.warning("Could not connect to LLM server. Operating in standalone mode.")
+    
+    connection_thread = threading.Thread(target=periodic_connection_check, daemon=True, name="ConnectionCheckThread")
+    connection_thread.start()
+    logger.info("Connection monitoring thread started.")
+    
+    if TELEGRAM_ENABLED:
+        with startup_phase("telegram_import"):
+            # Explicitly check and log telegram library status
+            if load_telegram() is None:
+                logger.error("FATAL STARTUP ERROR: 'python-telegram-bot' library object is None (Import failed).")
+                TELEGRAM_ENABLED = False
+            else:
+                logger.info("'python-telegram-bot' library appears to be imported successfully.")
+    
     logger.info(f"Telegram notifications are {'ENABLED' if TELEGRAM_ENABLED else 'DISABLED'} after import check.")
-
+    
     if TELEGRAM_ENABLED:
         if TELEGRAM_BOT_TOKEN == "YOUR_ACTUAL_TELEGRAM_BOT_TOKEN" or not TELEGRAM_BOT_TOKEN:
             logger.warning("TELEGRAM_BOT_TOKEN is not set or is a placeholder. Telegram notifications will likely fail even if library is loaded.")
@@ -1091,32 +2084,40 @@ if __name__ == '__main__':
             logger.warning("TELEGRAM_CHAT_ID is not set or is a placeholder. Telegram notifications will likely fail even if library is loaded.")
         
         # Test Telegram connection at startup
-        try:
+        with startup_phase("telegram_check"):
             test_telegram_connection()
-        except Exception as e:
-            logger.error(f"Telegram test failed with unexpected error: {e}", exc_info=True)
-    
-    initial_connection = check_server_connection()
-    connection_status["connected"] = initial_connection
-
-    if initial_connection:
-        if not register_with_server():
-             logger.warning("Initial registration with server failed despite connection.")
-        else:
-            logger.info("Server connected and client registered. Operating in connected mode.")
-    else:
-        logger.warning("Could not connect to LLM server. Operating in standalone mode.")
-    
-    connection_thread = threading.Thread(target=periodic_connection_check, daemon=True, name="ConnectionCheckThread")
-    connection_thread.start()
-    logger.info("Connection monitoring thread started.")
-    
-    if TELEGRAM_ENABLED:
+        
         medication_thread = threading.Thread(target=check_missed_medications, daemon=True, name="MedicationMonitorThread")
         medication_thread.start()
         logger.info("Medication monitoring thread started.")
     else:
         logger.info("Medication monitoring thread NOT started as Telegram is disabled (likely due to import error or configuration).")
+    
+    if tts_pipeline:
+        with startup_phase("tts_prewarm"):
+            tts_pipeline.prewarm()
+    
+    if local_llm_tier:
+        with startup_phase("local_llm_warm"):
+            local_llm_tier.warm_prefix()
+    
+    startup_state["background_done_ms"] = ms_since_start()
+    logger.info("Startup phases: " + ", ".join(f"{p['phase']}={p['duration_ms']}ms" for p in startup_phases)
+                + f", serving at {startup_state['serving_ms']}ms, background done at {startup_state['background_done_ms']}ms")
+
+startup_phases.append({"phase": "module_load", "start_ms": 0.0, "duration_ms": ms_since_start(), "status": "ok"})
+
+if __name__ == '__main__':
+    logger.info(f"Starting Raspberry Pi client, module loaded in {startup_phases[0]['duration_ms']} ms")
+    logger.info(f"Connecting to LLM server at: {LLM_SERVER_URL}")
+    logger.info(f"Config file: {settings.path} ({'loaded' if settings.file_version else 'not found, using defaults'})")
+    settings.watch()
+    
+    if profiling.CONTINUOUS_PROFILING:
+        continuous_profiler.ensure_started()
+    
+    # Serve the local UI first; probes, registration and Telegram run in the background
+    threading.Thread(target=run_startup_tasks, daemon=True, name="StartupTasksThread").start()
         
     try:
         logger.info(f"Flask app starting on host 0.0.0.0, port 5001. Debug: True, Reloader: False")
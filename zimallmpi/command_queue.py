@@ -0,0 +1,361 @@
+# command_queue.py - Durable dispenser commands with at-most-once actuation
+#
+# The server used to fire a dispense at the Pi and hope. A timeout left it
+# unable to tell whether the pill dropped, and retrying could double-dose.
+# Now every command gets an id, plus the caller's idempotency key when one is
+# given, and is written to a journal before anything is sent. A delivery
+# thread posts each device's pending commands to the Pi's /commands endpoint
+# in one batch. It retries with backoff until the Pi acknowledges each
+# command with a result.
+#
+# The Pi keeps its own journal of command ids (CommandLog). It writes
+# "started" to disk before moving any hardware. A retried or duplicated
+# delivery therefore gets the stored result back instead of a second
+# dispense, and a command cut short by a crash is reported as unknown rather
+# than run again.
+#
+# Commands carry an absolute expiry, so a dose is never dropped long after it
+# was asked for. This relies on the server and the Pi keeping their clocks in
+# sync (NTP). A command that was never sent expires on the server. One that
+# may have reached the Pi stays in delivery until the Pi reports what
+# happened to it.
+#
+# Both journals are append-only JSON lines, fsynced on every write and
+# compacted when they grow.
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+COMMAND_TTL_S = int(os.environ.get("ZIMA_COMMAND_TTL_S", "600"))   # A dose more than 10 minutes late must not drop
+DELIVERY_BATCH_SIZE = 20
+DELIVERY_WORKERS = 8        # Devices delivered to in parallel, so one unreachable Pi cannot hold up the rest
+RETRY_BASE_S = 1.0
+RETRY_MAX_S = 60.0
+RETENTION_S = 24 * 3600     # How long finished commands (and their idempotency keys) are remembered
+COMPACT_AFTER_LINES = 5000
+
+PENDING_STATES = ("queued", "sent")
+FINAL_STATES = ("acked", "expired", "unknown")
+
+class Journal:
+    """Append-only JSON-lines file of records with an "id"; the last line for an id wins"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def load(self):
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line from a crash mid-write
+                records[record["id"]] = record
+                self.lines += 1
+        return records
+
+    def append(self, *records):
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.lines += len(records)
+
+    def rewrite(self, records):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.lines = len(records)
+
+class CommandQueue:
+    """Server side: per-device queue of commands, delivered in batches until acknowledged.
+
+    send(address, commands) posts a batch and returns the Pi's result list, raising on
+    transport errors. observer(address, function, success, error), if given, hears about
+    every finished command and failed delivery.
+    """
+
+    def __init__(self, path, send, observer=None, ttl=COMMAND_TTL_S, batch_size=DELIVERY_BATCH_SIZE, clock=time.time):
+        self.journal = Journal(path)
+        self.send = send
+        self.observer = observer
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.commands = self.journal.load()
+        self.keys = {c["idempotency_key"]: c["id"] for c in self.commands.values() if c.get("idempotency_key")}
+        self.retry = {}         # address -> (failed attempts, next attempt time)
+        self.in_flight = set()  # addresses with a batch on the wire
+        self.pool = ThreadPoolExecutor(max_workers=DELIVERY_WORKERS, thread_name_prefix="CommandDelivery")
+        self.stats = {"submitted": 0, "deduplicated": 0, "batches": 0, "delivery_errors": 0,
+                      "acked": 0, "expired": 0, "unknown": 0}
+        pending = sum(1 for c in self.commands.values() if c["state"] in PENDING_STATES)
+        if pending:
+            logger.info(f"Recovered {pending} undelivered commands from {path}")
+
+    def submit(self, address, function, args, idempotency_key=None, user_id=None):
+        """(command, created); an idempotency key seen before returns the original command"""
+        with self.cond:
+            if idempotency_key and idempotency_key in self.keys:
+                self.stats["deduplicated"] += 1
+                return dict(self.commands[self.keys[idempotency_key]]), False
+            now = self.clock()
+            command = {"id": uuid.uuid4().hex, "idempotency_key": idempotency_key, "address": address,
+                       "function": function, "args": args, "user_id": user_id, "state": "queued",
+                       "created_at": now, "expires_at": now + self.ttl, "attempts": 0, "result": None,
+                       "updated_at": now}
+            self.journal.append(command)
+            self.commands[command["id"]] = command
+            if idempotency_key:
+                self.keys[idempotency_key] = command["id"]
+            self.stats["submitted"] += 1
+            self.retry.pop(address, None)  # New work is worth an immediate attempt
+            self.cond.notify_all()
+            return dict(command), True
+
+    def get(self, command_id):
+        with self.cond:
+            command = self.commands.get(command_id)
+            return dict(command) if command else None
+
+    def wait(self, command_id, timeout):
+        """The command once it is final, or as it stands when timeout runs out"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.commands[command_id]["state"] not in FINAL_STATES and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return dict(self.commands[command_id])
+
+    def list(self, address=None, state=None, limit=100):
+        with self.cond:
+            matched = [dict(c) for c in self.commands.values()
+                       if (address is None or c["address"] == address) and (state is None or c["state"] == state)]
+        matched.sort(key=lambda c: c["created_at"], reverse=True)
+        return matched[:limit]
+
+    def _update(self, command, **changes):
+        command.update(changes, updated_at=self.clock())
+        return command
+
+    def _due_batches(self):
+        """{address: [command, ...]} ready to send now; expires never-sent commands on the way"""
+        now = self.clock()
+        batches = {}
+        expired = []
+        pending = [c for c in self.commands.values() if c["state"] in PENDING_STATES]
+        for command in sorted(pending, key=lambda c: c["created_at"]):
+            if command["state"] == "queued" and now > command["expires_at"]:
+                expired.append(self._update(command, state="expired", result={"success": False, "error": "Expired before delivery"}))
+                continue
+            if command["state"] == "sent" and now > command["created_at"] + RETENTION_S:
+                # The Pi never answered; whether it ran is unknowable, stop asking
+                expired.append(self._update(command, state="unknown", result={"success": False, "error": "Device never confirmed"}))
+                continue
+            if command["address"] in self.in_flight:
+                continue
+            if self.retry.get(command["address"], (0, 0))[1] > now:
+                continue
+            batch = batches.setdefault(command["address"], [])
+            if len(batch) < self.batch_size:
+                batch.append(command)
+        if expired:
+            self.journal.append(*expired)
+            for command in expired:
+                self.stats[command["state"]] += 1
+                logger.warning(f"Command {command['id']} ({command['function']}) for {command['address']} ended {command['state']}: {command['result']['error']}")
+                self._observe(command, False, "expired")
+            self.cond.notify_all()
+        return batches
+
+    def _observe(self, command, success, error=None):
+        if self.observer:
+            try:
+                self.observer(command["address"], command["function"], success, error)
+            except Exception as e:
+                logger.error(f"Command observer failed: {e}")
+
+    def _deliver(self, address, batch):
+        payload = [{"id": c["id"], "function": c["function"], "args": c["args"], "user_id": c["user_id"],
+                    "expires_at": c["expires_at"]} for c in batch]
+        try:
+            results = self.send(address, payload)
+        except Exception as e:
+            with self.cond:
+                attempts = self.retry.get(address, (0, 0))[0] + 1
+                delay = min(RETRY_MAX_S, RETRY_BASE_S * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                self.retry[address] = (attempts, self.clock() + delay)
+                self.in_flight.discard(address)
+                self.stats["delivery_errors"] += 1
+                self.cond.notify_all()  # The delivery loop re-plans its wakeup around the backoff
+            logger.warning(f"Delivering {len(batch)} commands to {address} failed (attempt {attempts}, retry in {delay:.1f}s): {e}")
+            self._observe(batch[0], False, type(e).__name__)
+            return
+        finished = []
+        with self.cond:
+            self.retry.pop(address, None)
+            self.in_flight.discard(address)
+            by_id = {result.get("id"): result for result in results if isinstance(result, dict)}
+            for command in batch:
+                result = by_id.get(command["id"])
+                status = result.get("status") if result else None
+                if status == "done":
+                    finished.append(self._update(command, state="acked", result=result.get("result")))
+                elif status in ("expired", "unknown"):
+                    finished.append(self._update(command, state=status, result={"success": False, "error": result.get("error", status)}))
+                # Missing or "in_progress": still pending, the next batch asks again
+            for command in finished:
+                self.stats[command["state"]] += 1
+            if finished:
+                self.journal.append(*finished)
+            self.cond.notify_all()
+        for command in finished:
+            success = command["state"] == "acked" and (command["result"] or {}).get("success", True)
+            self._observe(command, success, None if success else (command["result"] or {}).get("error"))
+
+    def deliver_once(self):
+        """Send every due batch; returns the number of batches started"""
+        with self.cond:
+            batches = self._due_batches()
+            for address, batch in batches.items():
+                self.in_flight.add(address)
+                for command in batch:
+                    self._update(command, state="sent", attempts=command["attempts"] + 1)
+            if batches:
+                # Recorded as sent before the request leaves, so a restart knows the Pi may have it
+                self.journal.append(*(c for batch in batches.values() for c in batch))
+                self.stats["batches"] += len(batches)
+        for address, batch in batches.items():
+            self.pool.submit(self._deliver, address, batch)
+        return len(batches)
+
+    def _next_wakeup(self):
+        now = self.clock()
+        waits = [RETRY_MAX_S]
+        for command in self.commands.values():
+            if command["state"] in PENDING_STATES and command["address"] not in self.in_flight:
+                waits.append(max(0.0, self.retry.get(command["address"], (0, 0))[1] - now))
+                if command["state"] == "queued":
+                    waits.append(max(0.0, command["expires_at"] - now))
+        return min(waits)
+
+    def compact(self):
+        """Rewrite the journal without commands that finished more than RETENTION_S ago"""
+        with self.cond:
+            cutoff = self.clock() - RETENTION_S
+            for command_id in [i for i, c in self.commands.items() if c["state"] in FINAL_STATES and c["updated_at"] < cutoff]:
+                command = self.commands.pop(command_id)
+                self.keys.pop(command.get("idempotency_key"), None)
+            self.journal.rewrite(list(self.commands.values()))
+
+    def run(self):
+        while True:
+            try:
+                with self.cond:
+                    self.cond.wait(self._next_wakeup())
+                self.deliver_once()
+                if self.journal.lines > COMPACT_AFTER_LINES:
+                    self.compact()
+            except Exception as e:
+                logger.error(f"Command delivery loop error: {e}", exc_info=True)
+                time.sleep(1)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="CommandQueue").start()
+
+    def status(self):
+        with self.cond:
+            states = {}
+            for command in self.commands.values():
+                states[command["state"]] = states.get(command["state"], 0) + 1
+            return {"journal": self.journal.path, "journal_lines": self.journal.lines, "states": states,
+                    "devices_backing_off": sum(1 for _, at in self.retry.values() if at > self.clock()),
+                    **self.stats}
+
+class CommandLog:
+    """Pi side: dedup table that lets each command id move the hardware at most once"""
+
+    def __init__(self, path, retention=RETENTION_S, clock=time.time):
+        self.journal = Journal(path)
+        self.retention = retention
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = self.journal.load()
+        self.running = set()
+        self.stats = {"executed": 0, "duplicates": 0, "expired": 0, "interrupted": 0}
+        self._compact()
+
+    def _compact(self):
+        cutoff = self.clock() - self.retention
+        self.entries = {i: e for i, e in self.entries.items() if e["at"] >= cutoff}
+        self.journal.rewrite(list(self.entries.values()))
+
+    def _reply(self, entry):
+        reply = {"id": entry["id"], "status": entry["state"]}
+        if entry["state"] == "done":
+            reply["result"] = entry.get("result")
+        elif entry.get("error"):
+            reply["error"] = entry["error"]
+        return reply
+
+    def run(self, command, execute):
+        """Result of command, running execute(command) only if this id has never started"""
+        command_id = command.get("id")
+        if not command_id:
+            return {"id": None, "status": "unknown", "error": "Command has no id"}
+        with self.lock:
+            entry = self.entries.get(command_id)
+            if entry:
+                self.stats["duplicates"] += 1
+                if entry["state"] != "started":
+                    return dict(self._reply(entry), duplicate=True)
+                if command_id in self.running:
+                    return {"id": command_id, "status": "in_progress"}
+                # Started before a restart and never finished: the pill may have dropped, never rerun
+                return {"id": command_id, "status": "unknown", "error": "Interrupted during actuation, not repeated"}
+            entry = {"id": command_id, "function": command.get("function"), "at": self.clock()}
+            if command.get("expires_at") and self.clock() > command["expires_at"]:
+                entry.update(state="expired", error="Expired before it reached the dispenser")
+                self.stats["expired"] += 1
+            else:
+                entry["state"] = "started"
+                self.running.add(command_id)
+            self.journal.append(entry)  # On disk before the hardware moves
+            self.entries[command_id] = entry
+            if entry["state"] == "expired":
+                return self._reply(entry)
+
+        try:
+            entry = dict(entry, state="done", result=execute(command))
+            self.stats["executed"] += 1
+        except Exception as e:
+            logger.error(f"Command {command_id} ({command.get('function')}) failed during execution: {e}", exc_info=True)
+            entry = dict(entry, state="unknown", error=f"Failed during execution: {e}")
+            self.stats["interrupted"] += 1
+        with self.lock:
+            self.journal.append(entry)
+            self.entries[command_id] = entry
+            self.running.discard(command_id)
+            if self.journal.lines > COMPACT_AFTER_LINES:
+                self._compact()
+        return self._reply(entry)
+
+    def status(self):
+        with self.lock:
+            return {"journal": self.journal.path, "entries": len(self.entries), "running": len(self.running), **self.stats}
@@ -0,0 +1,274 @@
+# config.py - Layered settings for the server and the Pi, with hot reload of tuning knobs
+#
+# Each script declares its settings once as a list of Setting entries. A value
+# is resolved from four layers, later ones winning:
+#   1. the default declared with the setting
+#   2. a JSON config file, {"setting_name": value, ...}, named by --config,
+#      the ZIMA_CONFIG environment variable or the script's default path
+#   3. the setting's environment variable (ZIMA_<NAME> unless declared otherwise)
+#   4. --set name=value on the command line
+# The winning value of every setting is checked against its type and bounds,
+# and all problems are reported together with the layer they came from.
+#
+# The file is polled for changes. Settings marked reloadable (timeouts, pool
+# sizes, cache TTLs, sampling rates, model tiers) take effect without a
+# restart through the script's on_change hooks. A changed file that fails
+# validation is rejected as a whole and the running values stay. Everything
+# else (hosts, pins, paths, keys) is read once at startup, and a new value in
+# the file is listed as waiting for a restart. Secret values are never shown.
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL_S = float(os.environ.get("ZIMA_CONFIG_POLL_S", "5"))
+TRUE_WORDS = {"1", "true", "yes", "on"}
+FALSE_WORDS = {"0", "false", "no", "off", ""}  # An empty variable meant off under the old == "1" checks
+REDACTED = "***"
+
+class ConfigError(ValueError):
+    """Settings failed validation; .errors lists every problem"""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    word = str(value).strip().lower()
+    if word in TRUE_WORDS:
+        return True
+    if word in FALSE_WORDS:
+        return False
+    raise ValueError(f"expected true or false, got {value!r}")
+
+class Setting:
+    """One named value: its default, type, bounds and whether it may change while running.
+
+    kind is bool, int, float, str, dict or list. Text from the environment or the
+    command line is converted to it (JSON for dict and list); values from the file
+    must already have that type. check(value), if given, returns a list of errors.
+    """
+
+    def __init__(self, name, default, kind=str, env=None, help="", reloadable=False, secret=False,
+                 minimum=None, maximum=None, choices=None, check=None):
+        self.name = name
+        self.default = default
+        self.kind = kind
+        self.env = env or f"ZIMA_{name.upper()}"
+        self.help = help
+        self.reloadable = reloadable
+        self.secret = secret
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+        self.check = check
+
+    def _convert(self, value, text):
+        if self.kind is bool:
+            return parse_bool(value)
+        if self.kind in (int, float):
+            if isinstance(value, bool) or not (text or isinstance(value, (int, float))):
+                raise ValueError(f"expected a number, got {value!r}")
+            if self.kind is int and isinstance(value, float):
+                if not value.is_integer():
+                    raise ValueError(f"expected a whole number, got {value!r}")
+                return int(value)
+            try:
+                return self.kind(value)
+            except ValueError:
+                raise ValueError(f"expected a {'whole number' if self.kind is int else 'number'}, got {value!r}")
+        if self.kind in (dict, list):
+            if text:
+                try:
+                    value = json.loads(value)
+                except ValueError as e:
+                    raise ValueError(f"invalid JSON: {e}")
+            if not isinstance(value, self.kind):
+                raise ValueError(f"expected a JSON {'object' if self.kind is dict else 'array'}")
+            return value
+        if not isinstance(value, str):
+            raise ValueError(f"expected a string, got {value!r}")
+        return value
+
+    def validate(self, value, text=False):
+        """Typed value, or ValueError describing what is wrong with it"""
+        value = self._convert(value, text)
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError(f"must be at least {self.minimum}")
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError(f"must be at most {self.maximum}")
+        if self.choices is not None and value not in self.choices:
+            raise ValueError(f"must be one of {', '.join(map(str, self.choices))}")
+        if self.check:
+            errors = self.check(value)
+            if errors:
+                raise ValueError("; ".join(errors))
+        return value
+
+    def show(self, value):
+        return REDACTED if self.secret and value else value
+
+class Config:
+    """Resolved settings for one process; read a value with config["name"].
+
+    Reads are plain dict lookups. A reload swaps in a new dict, so a reader never
+    sees a half-applied change.
+    """
+
+    def __init__(self, settings, path=None, overrides=None, environ=None):
+        self.settings = {setting.name: setting for setting in settings}
+        self.path = path
+        self.overrides = dict(overrides or {})
+        self.environ = os.environ if environ is None else environ
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.values, self.sources, self.file_version = self._resolve()
+        self.loaded_at = time.time()
+        self.reloads = 0
+        self.last_reload = None
+        self.restart_required = {}
+        self.watcher = None
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def _read_file(self):
+        """(settings from the file, (mtime_ns, size)); ({}, None) when there is no file"""
+        if not self.path:
+            return {}, None
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {}, None
+        with open(self.path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("must hold a JSON object of setting names to values")
+        return data, (stat.st_mtime_ns, stat.st_size)
+
+    def _resolve(self):
+        """(values, sources, file version) from every layer; raises ConfigError"""
+        try:
+            file_values, version = self._read_file()
+        except (OSError, ValueError) as e:
+            raise ConfigError([f"{self.path}: {e}"])
+        errors = [f"{self.path}: unknown setting '{name}'" for name in file_values if name not in self.settings]
+        errors += [f"--set: unknown setting '{name}'" for name in self.overrides if name not in self.settings]
+        values, sources = {}, {}
+        for name, setting in self.settings.items():
+            source, raw, text = "default", setting.default, False
+            if name in file_values:
+                source, raw, text = "file", file_values[name], False
+            if setting.env in self.environ:
+                source, raw, text = f"env {setting.env}", self.environ[setting.env], True
+            if name in self.overrides:
+                source, raw, text = "--set", self.overrides[name], True
+            try:
+                values[name] = raw if source == "default" else setting.validate(raw, text)
+            except ValueError as e:
+                errors.append(f"{name} from {self.path if source == 'file' else source}: {e}")
+            sources[name] = source
+        if errors:
+            raise ConfigError(errors)
+        return values, sources, version
+
+    def on_change(self, hook):
+        """Call hook({name: new value}) after a reload changes reloadable settings"""
+        self.hooks.append(hook)
+
+    def reload(self):
+        """Re-read every layer and apply the reloadable changes; returns their names"""
+        with self.lock:
+            try:
+                values, sources, self.file_version = self._resolve()
+            except ConfigError as e:
+                self.file_version = self._stat_version()  # Not retried until the file changes again
+                self.last_reload = {"at": datetime.now().isoformat(), "error": e.errors}
+                logger.error(f"Config reload rejected, keeping the running settings: {e}")
+                return []
+            changed, restart_required = {}, {}
+            for name, value in values.items():
+                if value == self.values[name]:
+                    continue
+                if self.settings[name].reloadable:
+                    changed[name] = value
+                else:
+                    restart_required[name] = value
+            self.values = dict(self.values, **changed)
+            self.sources = dict(self.sources, **{name: sources[name] for name in changed})
+            self.restart_required = restart_required
+            self.reloads += 1
+            self.last_reload = {"at": datetime.now().isoformat(), "changed": sorted(changed),
+                                "restart_required": sorted(restart_required)}
+        if restart_required:
+            logger.warning(f"Config changes to {', '.join(sorted(restart_required))} take effect after a restart")
+        if changed:
+            logger.info("Config reloaded: " + ", ".join(f"{name}={self.settings[name].show(value)}"
+                                                        for name, value in sorted(changed.items())))
+            for hook in self.hooks:
+                try:
+                    hook(changed)
+                except Exception as e:
+                    logger.error(f"Config change hook failed: {e}", exc_info=True)
+        return sorted(changed)
+
+    def _stat_version(self):
+        try:
+            stat = os.stat(self.path)
+        except (OSError, TypeError):
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                if self._stat_version() != self.file_version:
+                    self.reload()
+            except Exception as e:
+                logger.error(f"Config watcher error: {e}", exc_info=True)
+
+    def watch(self, interval=POLL_INTERVAL_S):
+        """Poll the config file every interval seconds and reload when it changes"""
+        if self.watcher is None and self.path:
+            self.watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True, name="ConfigWatcher")
+            self.watcher.start()
+
+    def snapshot(self):
+        """Every setting with its effective value and where it came from, secrets redacted"""
+        with self.lock:
+            values, sources = self.values, self.sources
+            return {
+                "path": self.path,
+                "file_loaded": self.file_version is not None,
+                "loaded_at": datetime.fromtimestamp(self.loaded_at).isoformat(),
+                "reloads": self.reloads,
+                "last_reload": self.last_reload,
+                "restart_required": sorted(self.restart_required),
+                "settings": {name: {"value": setting.show(values[name]), "source": sources[name],
+                                    "default": setting.show(setting.default), "reloadable": setting.reloadable,
+                                    "env": setting.env, "help": setting.help}
+                             for name, setting in self.settings.items()}
+            }
+
+def load(settings, default_path, argv=()):
+    """Config from --config/--set in argv, ZIMA_CONFIG or default_path, and the environment"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help=f"JSON settings file (default: $ZIMA_CONFIG or {default_path})")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Override one setting; repeatable")
+    args = parser.parse_args(list(argv))
+    overrides = {}
+    for item in args.set:
+        name, separator, value = item.partition("=")
+        if not separator:
+            parser.error(f"--set expects NAME=VALUE, got {item!r}")
+        overrides[name.strip()] = value
+    return Config(settings, args.config or os.environ.get("ZIMA_CONFIG") or default_path, overrides)
@@ -0,0 +1,563 @@
+# drug_index.py - Retrieval over local drug monographs for grounded answers
+#
+# Monographs are plain text or markdown files under ZIMA_DRUG_CORPUS, one drug
+# per file (paracetamol.md, or a "# Paracetamol" first line). They are cut into
+# overlapping passages, embedded through Ollama's embedding API and stored as a
+# float32 matrix that the server memory-maps, so a query only reads the pages it
+# touches.
+#
+#   ollama pull nomic-embed-text
+#   python drug_index.py build            # full rebuild
+#   python drug_index.py update           # embed only passages that are new or changed
+#   python drug_index.py query "can I drink alcohol with it" --drug Paracetamol
+#   python drug_index.py stats
+#
+# Search is exact (one matrix-vector product) below IVF_MIN_ROWS passages. Above
+# that, rows are grouped by k-means into inverted lists stored contiguously, and
+# a query scans only the IVF_NPROBE lists whose centroids are closest.
+#
+# Each build writes a new generation directory and then swaps manifest.json, so
+# the server keeps answering from the old index until the new one is complete.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+import requests
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.expanduser("~"), "zima_data")
+CORPUS_DIR = os.environ.get("ZIMA_DRUG_CORPUS", os.path.join(DATA_DIR, "drug_corpus"))
+INDEX_DIR = os.environ.get("ZIMA_DRUG_INDEX", os.path.join(DATA_DIR, "drug_index"))
+RAG_ENABLED = os.environ.get("ZIMA_RAG", "1") == "1"
+EMBED_HOST = os.environ.get("ZIMA_EMBED_HOST", "http://localhost:11434")
+EMBED_MODEL = os.environ.get("ZIMA_EMBED_MODEL", "nomic-embed-text")
+EMBED_BATCH_SIZE = 32
+EMBED_TIMEOUT = (5, 120)  # (connect, read) seconds per embedding batch
+RAG_TOP_K = int(os.environ.get("ZIMA_RAG_TOP_K", "3"))
+RAG_MIN_SCORE = float(os.environ.get("ZIMA_RAG_MIN_SCORE", "0.4"))  # Cosine similarity below this is not injected
+CHUNK_CHARS = 700
+CHUNK_OVERLAP_CHARS = 150
+IVF_MIN_ROWS = 4096
+IVF_NPROBE = 8
+IVF_TRAIN_ITERATIONS = 10
+IVF_TRAIN_SAMPLE_PER_LIST = 64
+QUERY_CACHE_SIZE = 256
+CORPUS_EXTENSIONS = (".md", ".txt")
+INDEX_VERSION = 1
+
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+class IndexUnavailable(Exception):
+    """numpy is missing or no index has been built"""
+
+def require_numpy():
+    if np is None:
+        raise IndexUnavailable("numpy is not installed: pip install numpy")
+
+# ---------------------------------------------------------------- corpus
+
+def drug_name_for(path, text):
+    first_line = text.lstrip().split("\n", 1)[0]
+    if first_line.startswith("# "):
+        return first_line[2:].strip()
+    return os.path.splitext(os.path.basename(path))[0].replace("_", " ").replace("-", " ").title()
+
+def split_units(paragraph):
+    """Paragraph as one unit, or as sentences when it is longer than a chunk"""
+    if len(paragraph) <= CHUNK_CHARS:
+        return [paragraph]
+    return [sentence for sentence in SENTENCE_RE.split(paragraph) if sentence]
+
+def chunk_document(text):
+    """[(section, passage)] with passages up to CHUNK_CHARS that overlap by about CHUNK_OVERLAP_CHARS"""
+    chunks = []
+    section = ""
+    units = []
+    for block in re.split(r"\n\s*\n", text):
+        block = block.strip()
+        if not block:
+            continue
+        if block.startswith("#"):
+            heading, _, rest = block.partition("\n")
+            if units:
+                chunks.extend((section, passage) for passage in pack_units(units))
+                units = []
+            section = heading.lstrip("#").strip()
+            block = rest.strip()
+            if not block:
+                continue
+        units.extend(split_units(" ".join(block.split())))
+    if units:
+        chunks.extend((section, passage) for passage in pack_units(units))
+    return chunks
+
+def pack_units(units):
+    passages = []
+    current = []
+    for unit in units:
+        if current and len(" ".join(current + [unit])) > CHUNK_CHARS:
+            passages.append(" ".join(current))
+            # Carry trailing units into the next passage so facts cut at a boundary stay retrievable
+            overlap = []
+            for previous in reversed(current):
+                if len(" ".join([previous] + overlap)) > CHUNK_OVERLAP_CHARS:
+                    break
+                overlap.insert(0, previous)
+            current = overlap
+        current.append(unit)
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+def read_corpus(corpus_dir):
+    """Chunk metadata for every monograph, in a stable order, plus per-file hashes"""
+    chunks = []
+    files = {}
+    for root, _, names in sorted(os.walk(corpus_dir)):
+        for name in sorted(names):
+            if not name.lower().endswith(CORPUS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, corpus_dir)
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            drug = drug_name_for(path, text)
+            document_chunks = chunk_document(text)
+            files[relative] = {"sha1": hashlib.sha1(text.encode()).hexdigest(), "drug": drug, "chunks": len(document_chunks)}
+            for section, passage in document_chunks:
+                embed_text = f"{drug} - {section}: {passage}" if section else f"{drug}: {passage}"
+                chunks.append({
+                    "drug": drug,
+                    "section": section,
+                    "source": relative,
+                    "text": passage,
+                    "embed_text": embed_text,
+                    "sha1": hashlib.sha1(embed_text.encode()).hexdigest()
+                })
+    return chunks, files
+
+# ---------------------------------------------------------------- embeddings
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class OllamaEmbedder:
+    """Batched calls to /api/embed, falling back to one-at-a-time /api/embeddings on older Ollama"""
+
+    def __init__(self, host=EMBED_HOST, model=EMBED_MODEL, batch_size=EMBED_BATCH_SIZE, timeout=EMBED_TIMEOUT):
+        self.host = host.rstrip("/")
+        self.model = model
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.legacy_api = False
+
+    def _embed_batch(self, texts):
+        if not self.legacy_api:
+            response = requests.post(f"{self.host}/api/embed", json={"model": self.model, "input": texts}, timeout=self.timeout)
+            # Ollama before 0.3 has no /api/embed ("404 page not found"); a missing model is also a 404
+            if response.status_code != 404 or "model" in response.text:
+                response.raise_for_status()
+                return response.json()["embeddings"]
+            self.legacy_api = True
+        vectors = []
+        for text in texts:
+            response = requests.post(f"{self.host}/api/embeddings", json={"model": self.model, "prompt": text}, timeout=self.timeout)
+            response.raise_for_status()
+            vectors.append(response.json()["embedding"])
+        return vectors
+
+    def embed(self, texts, progress=None):
+        """Unit-length float32 matrix, one row per text"""
+        require_numpy()
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            rows.extend(self._embed_batch(texts[start:start + self.batch_size]))
+            if progress:
+                progress(min(start + self.batch_size, len(texts)), len(texts))
+        return normalize(rows)
+
+# ---------------------------------------------------------------- IVF
+
+def train_ivf(vectors, nlist, iterations=IVF_TRAIN_ITERATIONS, seed=0):
+    """Spherical k-means on a sample; returns (centroids, list id for every row)"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * IVF_TRAIN_SAMPLE_PER_LIST)
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_lists(sample, centroids)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=nlist)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        centroids[nonempty] = normalize(np.add.reduceat(sample[order], starts, axis=0))
+    return centroids, assign_lists(vectors, centroids)
+
+def assign_lists(vectors, centroids, block_rows=8192):
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        assignment[start:start + block_rows] = np.argmax(vectors[start:start + block_rows] @ centroids.T, axis=1)
+    return assignment
+
+# ---------------------------------------------------------------- storage
+
+def write_index(index_dir, vectors, chunks, files, model):
+    """Write a new generation and point manifest.json at it; returns the manifest"""
+    require_numpy()
+    vectors = np.asarray(vectors, dtype=np.float32)
+    ivf = None
+    if len(vectors) >= IVF_MIN_ROWS:
+        nlist = int(np.sqrt(len(vectors)))
+        centroids, assignment = train_ivf(vectors, nlist)
+        order = np.argsort(assignment, kind="stable")
+        vectors = vectors[order]
+        chunks = [chunks[i] for i in order]
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=nlist)))).astype(np.int64)
+        ivf = {"nlist": nlist}
+
+    generation = f"gen-{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{os.getpid()}"
+    generation_dir = os.path.join(index_dir, generation)
+    os.makedirs(generation_dir)
+    np.save(os.path.join(generation_dir, "vectors.npy"), vectors)
+    if ivf:
+        np.save(os.path.join(generation_dir, "centroids.npy"), centroids)
+        np.save(os.path.join(generation_dir, "offsets.npy"), offsets)
+    with open(os.path.join(generation_dir, "chunks.jsonl"), "w") as f:
+        for chunk in chunks:
+            f.write(json.dumps({key: chunk[key] for key in ("drug", "section", "source", "text", "sha1")}) + "\n")
+
+    manifest = {
+        "version": INDEX_VERSION,
+        "generation": generation,
+        "model": model,
+        "dim": int(vectors.shape[1]) if len(vectors) else 0,
+        "rows": len(vectors),
+        "ivf": ivf,
+        "files": files,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    temp_path = os.path.join(index_dir, "manifest.json.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    previous = read_manifest(index_dir)
+    os.replace(temp_path, os.path.join(index_dir, "manifest.json"))
+
+    # Keep the previous generation for readers that still have it mapped
+    keep = {generation, previous.get("generation") if previous else None}
+    for name in os.listdir(index_dir):
+        if name.startswith("gen-") and name not in keep:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+    return manifest
+
+def read_manifest(index_dir):
+    try:
+        with open(os.path.join(index_dir, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class DrugIndex:
+    """One memory-mapped index generation"""
+
+    def __init__(self, index_dir, manifest):
+        require_numpy()
+        self.manifest = manifest
+        generation_dir = os.path.join(index_dir, manifest["generation"])
+        self.vectors = np.load(os.path.join(generation_dir, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(generation_dir, "chunks.jsonl")) as f:
+            self.chunks = [json.loads(line) for line in f]
+        self.centroids = self.offsets = None
+        if manifest.get("ivf"):
+            self.centroids = np.load(os.path.join(generation_dir, "centroids.npy"))
+            self.offsets = np.load(os.path.join(generation_dir, "offsets.npy"))
+        drug_rows = {}
+        for row, chunk in enumerate(self.chunks):
+            drug_rows.setdefault(chunk["drug"].lower(), []).append(row)
+        self.drug_rows = {drug: np.array(rows, dtype=np.int64) for drug, rows in drug_rows.items()}
+
+    @classmethod
+    def open(cls, index_dir=INDEX_DIR):
+        manifest = read_manifest(index_dir)
+        if manifest is None:
+            raise IndexUnavailable(f"No index in {index_dir}, run: python drug_index.py build")
+        return cls(index_dir, manifest)
+
+    def _top(self, scores, rows, k):
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), int(rows[i]) if rows is not None else int(i)) for i in best]
+
+    def search(self, query, k=RAG_TOP_K, drugs=None, mode="auto", nprobe=IVF_NPROBE):
+        """[(score, row)] best first. drugs limits the search to those monographs (exact, they are small)."""
+        if not self.chunks:
+            return []
+        if drugs:
+            rows = [self.drug_rows[name.lower()] for name in drugs if name and name.lower() in self.drug_rows]
+            if not rows:
+                return []
+            rows = np.sort(np.concatenate(rows))
+            return self._top(self.vectors[rows] @ query, rows, k)
+        if mode == "exact" or (mode == "auto" and self.centroids is None):
+            return self._top(self.vectors @ query, None, k)
+        if self.centroids is None:
+            raise IndexUnavailable("Index has no IVF lists, it is small enough for exact search")
+        lists = np.argsort(-(self.centroids @ query))[:nprobe]
+        scores, rows = [], []
+        for list_id in lists:
+            start, end = int(self.offsets[list_id]), int(self.offsets[list_id + 1])
+            if end > start:
+                scores.append(self.vectors[start:end] @ query)  # Contiguous slice, only these pages are read
+                rows.append(np.arange(start, end))
+        if not scores:
+            return []
+        return self._top(np.concatenate(scores), np.concatenate(rows), k)
+
+    def passage(self, row, score=None):
+        chunk = self.chunks[row]
+        result = {"drug": chunk["drug"], "section": chunk["section"], "source": chunk["source"], "text": chunk["text"]}
+        if score is not None:
+            result["score"] = round(score, 4)
+        return result
+
+def build_index(corpus_dir=CORPUS_DIR, index_dir=INDEX_DIR, embedder=None, incremental=True, progress=None):
+    """Chunk the corpus, embed what the current index does not already have, write a new generation"""
+    require_numpy()
+    start = time.time()
+    embedder = embedder or OllamaEmbedder()
+    if not os.path.isdir(corpus_dir):
+        raise IndexUnavailable(f"Corpus directory {corpus_dir} does not exist")
+    os.makedirs(index_dir, exist_ok=True)
+    chunks, files = read_corpus(corpus_dir)
+
+    # Vectors of unchanged passages are reused, keyed by the hash of the exact text that was embedded
+    reusable = {}
+    previous = None
+    if incremental:
+        try:
+            previous = DrugIndex.open(index_dir)
+        except IndexUnavailable:
+            previous = None
+        if previous and previous.manifest.get("model") != embedder.model:
+            logger.info(f"Embedding model changed from {previous.manifest.get('model')} to {embedder.model}, re-embedding everything")
+            previous = None
+        if previous:
+            reusable = {chunk["sha1"]: row for row, chunk in enumerate(previous.chunks)}
+
+    pending = [i for i, chunk in enumerate(chunks) if chunk["sha1"] not in reusable]
+    new_vectors = embedder.embed([chunks[i]["embed_text"] for i in pending], progress) if pending else None
+    dim = new_vectors.shape[1] if new_vectors is not None else (previous.vectors.shape[1] if previous else 0)
+    vectors = np.empty((len(chunks), dim), dtype=np.float32)
+    if pending:
+        vectors[pending] = new_vectors
+    reused = [i for i, chunk in enumerate(chunks) if chunk["sha1"] in reusable]
+    if reused:
+        vectors[reused] = previous.vectors[[reusable[chunks[i]["sha1"]] for i in reused]]
+
+    old_files = previous.manifest.get("files", {}) if previous else {}
+    if previous and not pending and old_files == files:
+        return {"changed": False, "rows": len(chunks), "embedded": 0, "reused": len(chunks),
+                "seconds": round(time.time() - start, 2), "generation": previous.manifest["generation"]}
+
+    manifest = write_index(index_dir, vectors, chunks, files, embedder.model)
+    return {
+        "changed": True,
+        "rows": len(chunks),
+        "files": len(files),
+        "embedded": len(pending),
+        "reused": len(chunks) - len(pending),
+        "added_files": sorted(set(files) - set(old_files)),
+        "changed_files": sorted(name for name in files if name in old_files and old_files[name]["sha1"] != files[name]["sha1"]),
+        "removed_files": sorted(set(old_files) - set(files)),
+        "ivf": manifest["ivf"],
+        "seconds": round(time.time() - start, 2),
+        "generation": manifest["generation"]
+    }
+
+# ---------------------------------------------------------------- server side
+
+class DrugRetriever:
+    """Embeds a question and returns passages for the user's medications.
+
+    Reopens the index whenever manifest.json changes, so `drug_index.py update`
+    takes effect on a running server.
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, embedder=None, top_k=RAG_TOP_K, min_score=RAG_MIN_SCORE):
+        self.index_dir = index_dir
+        self.embedder = embedder or OllamaEmbedder()
+        self.top_k = top_k
+        self.min_score = min_score
+        self.index = None
+        self.manifest_mtime = None
+        self.lock = threading.Lock()
+        self.query_cache = OrderedDict()
+        self.embed_ms = deque(maxlen=200)
+        self.search_ms = deque(maxlen=200)
+        self.stats = {"queries": 0, "cache_hits": 0, "injected": 0, "errors": 0, "reloads": 0}
+
+    def current_index(self):
+        try:
+            mtime = os.stat(os.path.join(self.index_dir, "manifest.json")).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            if mtime != self.manifest_mtime:
+                try:
+                    self.index = DrugIndex.open(self.index_dir)
+                    self.stats["reloads"] += 1
+                    logger.info(f"Loaded drug index {self.index.manifest['generation']} ({self.index.manifest['rows']} passages)")
+                except (IndexUnavailable, OSError, ValueError, KeyError) as e:
+                    logger.error(f"Could not open drug index: {e}")
+                    self.index = None
+                self.manifest_mtime = mtime
+            return self.index
+
+    def _embed_query(self, question):
+        key = " ".join(question.lower().split())
+        with self.lock:
+            if key in self.query_cache:
+                self.query_cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return self.query_cache[key]
+        start = time.time()
+        vector = self.embedder.embed([question])[0]
+        with self.lock:
+            self.embed_ms.append((time.time() - start) * 1000)
+            self.query_cache[key] = vector
+            while len(self.query_cache) > QUERY_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+        return vector
+
+    def retrieve(self, question, drugs=None, k=None):
+        """Passages scoring at least min_score, best first; [] when there is no index or Ollama fails"""
+        index = self.current_index()
+        if index is None or not index.chunks or not question.strip():
+            return []
+        with self.lock:
+            self.stats["queries"] += 1
+        try:
+            query = self._embed_query(question)
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logger.warning(f"Query embedding failed, answering without reference passages: {e}")
+            with self.lock:
+                self.stats["errors"] += 1
+            return []
+        if query.shape[0] != index.vectors.shape[1]:
+            logger.error(f"Query has {query.shape[0]} dimensions, index has {index.vectors.shape[1]}; rebuild the index")
+            return []
+        start = time.time()
+        hits = index.search(query, k or self.top_k, drugs=drugs)
+        passages = [index.passage(row, score) for score, row in hits if score >= self.min_score]
+        with self.lock:
+            self.search_ms.append((time.time() - start) * 1000)
+            if passages:
+                self.stats["injected"] += 1
+        return passages
+
+    def status(self):
+        def pct(values, p):
+            if not values:
+                return None
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))], 2)
+        index = self.current_index()
+        with self.lock:
+            return {
+                "index_dir": self.index_dir,
+                "model": self.embedder.model,
+                "loaded": index is not None,
+                "generation": index.manifest["generation"] if index else None,
+                "rows": index.manifest["rows"] if index else 0,
+                "drugs": sorted({chunk["drug"] for chunk in index.chunks}) if index else [],
+                "ivf": index.manifest.get("ivf") if index else None,
+                "embed_ms": {"p50": pct(self.embed_ms, 50), "p95": pct(self.embed_ms, 95)},
+                "search_ms": {"p50": pct(self.search_ms, 50), "p95": pct(self.search_ms, 95)},
+                **self.stats
+            }
+
+def format_passages(passages):
+    """Numbered reference block for the prompt"""
+    lines = []
+    for number, passage in enumerate(passages, 1):
+        where = f"{passage['drug']}, {passage['section']}" if passage["section"] else passage["drug"]
+        lines.append(f"[{number}] ({where}) {passage['text']}")
+    return "\n".join(lines)
+
+def create_retriever(ollama_host=EMBED_HOST):
+    """DrugRetriever, or None when retrieval is disabled or numpy is missing"""
+    if not RAG_ENABLED:
+        return None
+    if np is None:
+        logger.warning("numpy is not installed, answers will not include drug monograph passages")
+        return None
+    return DrugRetriever(embedder=OllamaEmbedder(host=os.environ.get("ZIMA_EMBED_HOST", ollama_host)))
+
+# ---------------------------------------------------------------- CLI
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the drug monograph retrieval index")
+    parser.add_argument("command", choices=["build", "update", "query", "stats"])
+    parser.add_argument("text", nargs="?", help="Question for the query command")
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="Directory of .md/.txt monographs")
+    parser.add_argument("--index", default=INDEX_DIR, help="Index directory")
+    parser.add_argument("--host", default=EMBED_HOST, help="Ollama base URL")
+    parser.add_argument("--model", default=EMBED_MODEL, help="Ollama embedding model")
+    parser.add_argument("--k", type=int, default=RAG_TOP_K, help="Passages to return")
+    parser.add_argument("--drug", action="append", help="Limit the query to this drug (repeatable)")
+    parser.add_argument("--mode", choices=["auto", "exact", "ivf"], default="auto")
+    parser.add_argument("--nprobe", type=int, default=IVF_NPROBE, help="IVF lists scanned per query")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    try:
+        embedder = OllamaEmbedder(host=args.host, model=args.model)
+        if args.command in ("build", "update"):
+            def progress(done, total):
+                print(f"\rEmbedded {done}/{total} passages", end="", file=sys.stderr, flush=True)
+            summary = build_index(args.corpus, args.index, embedder, incremental=args.command == "update", progress=progress)
+            print(file=sys.stderr)
+            print(json.dumps(summary, indent=2))
+        elif args.command == "query":
+            if not args.text:
+                parser.error("query needs the question text")
+            index = DrugIndex.open(args.index)
+            start = time.perf_counter()
+            query = embedder.embed([args.text])[0]
+            embed_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            hits = index.search(query, args.k, drugs=args.drug, mode=args.mode, nprobe=args.nprobe)
+            search_ms = (time.perf_counter() - start) * 1000
+            print(json.dumps({"embed_ms": round(embed_ms, 2), "search_ms": round(search_ms, 3),
+                              "passages": [index.passage(row, score) for score, row in hits]}, indent=2))
+        else:
+            manifest = read_manifest(args.index)
+            if manifest is None:
+                raise IndexUnavailable(f"No index in {args.index}")
+            print(json.dumps({**manifest, "files": len(manifest["files"])}, indent=2))
+    except (IndexUnavailable, requests.exceptions.RequestException) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+# fleet.py - Fleet-wide view of dispensers and their users for the dashboard
+#
+# Every device and user has a row of counters that is updated as events reach
+# the server: heartbeats carrying the Pi's own report, function calls the
+# server makes to a Pi, and safety blocks. A dashboard then reads one page of
+# ready-made rows plus fleet totals in a single request instead of asking
+# every Pi in turn.
+#
+# Counts reported by the Pi (dispenses, missed doses) are the device's totals
+# for its current day. A repeated or lost heartbeat therefore never double
+# counts; user rows move by the difference from the previous report. Daily
+# counters reset lazily the first time a row is touched on a new day.
+#
+# Each Pi process sends a fresh boot_id. If a Pi comes back from a restart
+# with lower counts than it reported before (its saved day was lost), the
+# earlier counts are carried and the new boot counts on top of them, so a
+# reboot never takes dispenses or missed doses away. A lower count under the
+# same boot_id is a late report that arrived out of order and is skipped.
+
+import os
+import threading
+import time
+from datetime import datetime
+
+STALE_AFTER_S = int(os.environ.get("ZIMA_FLEET_STALE_S", "90"))       # Three missed 30 s heartbeats
+OFFLINE_AFTER_S = int(os.environ.get("ZIMA_FLEET_OFFLINE_S", "600"))
+SENSOR_DEGRADED_RATE = 0.2  # Failure rate over the Pi's recent window that marks a sensor degraded
+SENSOR_FAILED_STREAK = 3    # Consecutive failures that mark it failed
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+DEVICE_STATUSES = ("online", "stale", "offline")
+HEALTH_ORDER = {"ok": 0, "unknown": 1, "degraded": 2, "failed": 3}
+DEVICE_SORT_KEYS = {"device_id", "last_heartbeat", "status", "health", "dispenses_today", "missed_doses_today",
+                    "error_rate", "calls_today", "blocked_today", "queue_depth"}
+USER_SORT_KEYS = {"user_id", "dispenses_today", "missed_doses_today", "blocked_today", "last_dispense_at"}
+REPORT_TOTALS = ("dispenses_today", "missed_doses_today")
+REPORT_BY_USER = ("dispenses_by_user", "missed_by_user")
+
+def today():
+    return datetime.now().strftime("%Y-%m-%d")
+
+def iso(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec="seconds") if timestamp else None
+
+def sensor_state(window):
+    """ok, degraded, failed or unknown for one sensor's reported window"""
+    if not window or not window.get("reads"):
+        return "unknown"
+    if window.get("consecutive_failures", 0) >= SENSOR_FAILED_STREAK:
+        return "failed"
+    if window.get("failures", 0) / window["reads"] >= SENSOR_DEGRADED_RATE:
+        return "degraded"
+    return "ok"
+
+def _sort_value(row, key):
+    value = row.get(key)
+    if key == "status":
+        return DEVICE_STATUSES.index(value)
+    if key == "health":
+        return HEALTH_ORDER.get(value, 1)
+    if key == "device_id" or key == "user_id":
+        return (0, int(value), "") if str(value).isdigit() else (1, 0, str(value))
+    return (value is not None, value or 0)
+
+def paginate(rows, sort, offset, limit, allowed):
+    """Sort by sort ("-key" for descending) and cut one page; raises ValueError on bad arguments"""
+    descending = sort.startswith("-")
+    key = sort.lstrip("-")
+    if key not in allowed:
+        raise ValueError(f"sort must be one of {', '.join(sorted(allowed))}")
+    if offset < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"offset must be >= 0 and limit between 1 and {MAX_PAGE_SIZE}")
+    rows.sort(key=lambda row: _sort_value(row, key), reverse=descending)
+    return rows[offset:offset + limit]
+
+def _count(value, name):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 or value != int(value):
+        raise ValueError(f"'{name}' must be a whole number of at least 0, got {value!r}")
+    return int(value)
+
+def _lower(new, old):
+    """True if a reported count (a total or a per-user dict) went below the previous report"""
+    if new is None or old is None:
+        return False
+    if isinstance(new, dict):
+        return any(new.get(user_id, 0) < count for user_id, count in old.items())
+    return new < old
+
+def _add(first, second):
+    """Sum two sets of reported counts, per user for the per-user dicts"""
+    total = dict(first)
+    for name, value in second.items():
+        if isinstance(value, dict):
+            merged = dict(total.get(name, {}))
+            for user_id, count in value.items():
+                merged[user_id] = merged.get(user_id, 0) + count
+            total[name] = merged
+        else:
+            total[name] = total.get(name, 0) + value
+    return total
+
+def clean_report(report):
+    """The heartbeat report with its counts checked and made ints; raises ValueError when malformed"""
+    if report is None:
+        return {}
+    if not isinstance(report, dict):
+        raise ValueError("The heartbeat report must be a JSON object")
+    report = dict(report)
+    for name in REPORT_TOTALS + ("uptime_s", "queue_depth"):
+        if name in report:
+            report[name] = _count(report[name], name)
+    for name in REPORT_BY_USER:
+        if name not in report:
+            continue
+        if not isinstance(report[name], dict):
+            raise ValueError(f"'{name}' must be an object of user ids to counts")
+        report[name] = {str(user_id): _count(count, f"{name}.{user_id}") for user_id, count in report[name].items()}
+    if "sensors" in report and not isinstance(report["sensors"], dict):
+        raise ValueError("'sensors' must be an object of sensor names to windows")
+    return report
+
+class FleetStats:
+    """Per-device and per-user counters for every dispenser the server has heard from"""
+
+    DEVICE_DAILY = ("dispenses_today", "missed_doses_today", "calls_today", "call_errors_today", "blocked_today")
+    USER_DAILY = ("dispenses_today", "missed_doses_today", "blocked_today")
+
+    def __init__(self, stale_after=STALE_AFTER_S, offline_after=OFFLINE_AFTER_S, clock=time.time):
+        self.stale_after = stale_after
+        self.offline_after = offline_after
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.users = {}
+        self.address_to_device = {}
+
+    def _roll(self, row, fields):
+        day = today()
+        if row["day"] != day:
+            row["day"] = day
+            for field in fields:
+                row[field] = 0
+            row.pop("reported", None)
+
+    def _device(self, device_id):
+        row = self.devices.get(device_id)
+        if row is None:
+            row = {"device_id": device_id, "client_ip": None, "client_version": None, "hardware_mode": None,
+                   "registered_at": None, "last_heartbeat": None, "user_id": None, "day": today(),
+                   "sensors": {}, "queue_depth": 0, "uptime_s": None, "last_error": None, "last_error_at": None,
+                   **{field: 0 for field in self.DEVICE_DAILY}}
+            self.devices[device_id] = row
+        self._roll(row, self.DEVICE_DAILY)
+        return row
+
+    def _user(self, user_id):
+        user_id = str(user_id)
+        row = self.users.get(user_id)
+        if row is None:
+            row = {"user_id": user_id, "device_id": None, "last_dispense_at": None, "day": today(),
+                   **{field: 0 for field in self.USER_DAILY}}
+            self.users[user_id] = row
+        self._roll(row, self.USER_DAILY)
+        return row
+
+    def register(self, client_ip, client_data):
+        """A Pi (re)registered; its device_id defaults to its address"""
+        device_id = str(client_data.get("device_id") or client_ip)
+        with self.lock:
+            row = self._device(device_id)
+            row.update(client_ip=client_ip, client_version=client_data.get("client_version"),
+                       hardware_mode=client_data.get("hardware_mode"), registered_at=self.clock(),
+                       last_heartbeat=self.clock())
+            self.address_to_device[client_ip] = device_id
+        return device_id
+
+    def heartbeat(self, client_ip, report=None):
+        """Record a heartbeat and the absolute daily counts the Pi sent with it; ValueError for a malformed report"""
+        report = clean_report(report)
+        with self.lock:
+            device_id = str(report.get("device_id") or self.address_to_device.get(client_ip, client_ip))
+            self.address_to_device[client_ip] = device_id
+            row = self._device(device_id)
+            row["client_ip"] = client_ip
+            row["last_heartbeat"] = self.clock()
+            if not report:
+                return device_id
+            for field in ("hardware_mode", "uptime_s", "queue_depth"):
+                if field in report:
+                    row[field] = report[field]
+            if isinstance(report.get("sensors"), dict):
+                row["sensors"] = {name: dict(window, state=sensor_state(window))
+                                  for name, window in report["sensors"].items() if isinstance(window, dict)}
+            if report.get("day") == row["day"]:
+                self._apply_counts(row, report)
+        return device_id
+
+    def _apply_counts(self, row, report):
+        """Replace the device's daily counts and move user rows by the change since the last report"""
+        state = row.setdefault("reported", {"boot_id": None, "counts": {}, "carried": {}})
+        counts = {name: report[name] for name in REPORT_TOTALS if name in report}
+        for source in REPORT_BY_USER:
+            if source in report:
+                counts[source] = report[source]
+        previous = state["counts"]
+        went_down = any(_lower(counts.get(name), previous.get(name)) for name in REPORT_TOTALS + REPORT_BY_USER)
+        boot_id = report.get("boot_id")
+        if went_down and (boot_id is None or boot_id != state["boot_id"]):
+            state["carried"] = _add(state["carried"], previous)  # Restarted without its saved counts
+            previous = {}
+        elif went_down:
+            return  # Older report from the same boot arriving late
+        state["boot_id"] = boot_id
+        state["counts"] = dict(previous, **counts)
+        before, after = _add(state["carried"], previous), _add(state["carried"], state["counts"])
+        for name in REPORT_TOTALS:
+            row[name] = after.get(name, row[name])
+        for source, field in (("dispenses_by_user", "dispenses_today"), ("missed_by_user", "missed_doses_today")):
+            old, new = before.get(source, {}), after.get(source, {})
+            for user_id in set(new) | set(old):
+                delta = new.get(user_id, 0) - old.get(user_id, 0)
+                if delta:
+                    user = self._user(user_id)
+                    user[field] += delta
+                    user["device_id"] = row["device_id"]
+                    if field == "dispenses_today" and delta > 0:
+                        user["last_dispense_at"] = self.clock()
+                        row["user_id"] = user_id  # The user this dispenser served most recently
+
+    def record_call(self, client_ip, function_name, success, error=None):
+        """Outcome of a function call the server made on a Pi"""
+        with self.lock:
+            row = self._device(self.address_to_device.get(client_ip, client_ip))
+            row["calls_today"] += 1
+            if not success:
+                row["call_errors_today"] += 1
+                row["last_error"] = f"{function_name}: {error}" if error else function_name
+                row["last_error_at"] = self.clock()
+
+    def record_blocked(self, client_ip, user_id):
+        with self.lock:
+            row = self._device(self.address_to_device.get(client_ip, client_ip))
+            row["blocked_today"] += 1
+            user = self._user(user_id)
+            user["blocked_today"] += 1
+            user["device_id"] = row["device_id"]
+
+    def _device_view(self, row, now):
+        age = now - row["last_heartbeat"] if row["last_heartbeat"] else None
+        if age is None or age > self.offline_after:
+            status = "offline"
+        elif age > self.stale_after:
+            status = "stale"
+        else:
+            status = "online"
+        states = [window["state"] for window in row["sensors"].values()]
+        health = max(states, key=lambda state: HEALTH_ORDER[state]) if states else "unknown"
+        view = {key: value for key, value in row.items() if key != "reported"}
+        view.update(status=status, health=health, last_heartbeat=iso(row["last_heartbeat"]),
+                    registered_at=iso(row["registered_at"]), last_error_at=iso(row["last_error_at"]),
+                    error_rate=round(row["call_errors_today"] / row["calls_today"], 3) if row["calls_today"] else 0.0)
+        return view
+
+    def list_devices(self, status=None, health=None, user_id=None, q=None, sort="device_id",
+                     offset=0, limit=DEFAULT_PAGE_SIZE):
+        """One filtered, sorted page of devices plus totals for the whole fleet, in a single pass"""
+        now = self.clock()
+        q = (q or "").lower()
+        summary = {"devices": 0, "status": dict.fromkeys(DEVICE_STATUSES, 0), "health": dict.fromkeys(HEALTH_ORDER, 0),
+                   "dispenses_today": 0, "missed_doses_today": 0, "blocked_today": 0, "calls_today": 0,
+                   "call_errors_today": 0, "queue_depth": 0}
+        matched = []
+        with self.lock:
+            for row in self.devices.values():
+                self._roll(row, self.DEVICE_DAILY)
+                view = self._device_view(row, now)
+                summary["devices"] += 1
+                summary["status"][view["status"]] += 1
+                summary["health"][view["health"]] += 1
+                for field in ("dispenses_today", "missed_doses_today", "blocked_today", "calls_today",
+                              "call_errors_today", "queue_depth"):
+                    summary[field] += view[field] or 0
+                if status and view["status"] != status:
+                    continue
+                if health and view["health"] != health:
+                    continue
+                if user_id and view["user_id"] != str(user_id):
+                    continue
+                if q and q not in view["device_id"].lower() and q not in (view["client_ip"] or "").lower():
+                    continue
+                matched.append(view)
+        summary["error_rate"] = round(summary["call_errors_today"] / summary["calls_today"], 3) if summary["calls_today"] else 0.0
+        page = paginate(matched, sort, offset, limit, DEVICE_SORT_KEYS)
+        return {"total": len(matched), "offset": offset, "limit": limit, "devices": page, "summary": summary}
+
+    def device(self, device_id):
+        with self.lock:
+            row = self.devices.get(device_id)
+            if row is None:
+                return None
+            self._roll(row, self.DEVICE_DAILY)
+            return self._device_view(row, self.clock())
+
+    def list_users(self, device_id=None, min_missed=0, sort="user_id", offset=0, limit=DEFAULT_PAGE_SIZE):
+        matched = []
+        with self.lock:
+            for row in self.users.values():
+                self._roll(row, self.USER_DAILY)
+                if device_id and row["device_id"] != device_id:
+                    continue
+                if row["missed_doses_today"] < min_missed:
+                    continue
+                matched.append(dict(row, last_dispense_at=iso(row["last_dispense_at"])))
+        page = paginate(matched, sort, offset, limit, USER_SORT_KEYS)
+        return {"total": len(matched), "offset": offset, "limit": limit, "users": page}
@@ -0,0 +1,264 @@
+# hardware_sim.py - Hardware backends for the Pi client
+#
+# HardwareController talks to GPIO directly on a Raspberry Pi. Anywhere else it
+# uses one of these backends instead:
+#   mock - returns instantly (the original development behaviour)
+#   sim  - models servo hold times, ultrasonic echo timing and noise, pill drops
+#          and patient pickups, with optional failure injection
+#
+# The simulator keeps its own clock, so it can run faster than real time:
+#   ZIMA_HARDWARE_BACKEND=sim ZIMA_SIM_SPEED=10 python clientllmpi.py
+#   ZIMA_SIM_FAILURES="servo_stall=0.05,echo_timeout=0.02" ZIMA_SIM_SEED=42 ...
+
+import abc
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Timings taken from the GPIO code paths in clientllmpi.HardwareController
+SERVO_HOLD_S = 0.5           # PWM signal held per servo move
+SENSOR_SETTLE_S = 0.5        # TRIG held low before each measurement
+TRIGGER_PULSE_S = 0.00001    # 10 us trigger pulse
+ECHO_TIMEOUT_S = 0.1         # Measurement gives up after this long
+SPEED_OF_SOUND_CM_S = 34300
+NO_ECHO_DISTANCE = 999       # Value the real code returns on timeout or error
+
+FAILURE_KINDS = ("servo_stall", "echo_timeout", "sensor_spike", "pill_jam")
+
+class HardwareFault(Exception):
+    """Raised by the simulator where the real GPIO code would raise"""
+
+class SimClock:
+    """Simulated time that runs `speed` times faster than the wall clock"""
+
+    def __init__(self, speed=1.0):
+        self.speed = max(speed, 0.001)
+        self._real_start = time.monotonic()
+        self._sim_start = time.time()
+
+    def now(self):
+        return self._sim_start + (time.monotonic() - self._real_start) * self.speed
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+class HardwareBackend(abc.ABC):
+    """Operations HardwareController delegates to when it is not driving GPIO"""
+    name = "base"
+
+    @abc.abstractmethod
+    def move_servo(self, servo_num, angle):
+        """Turn servo_num to angle degrees"""
+
+    @abc.abstractmethod
+    def dispense(self, servo_num):
+        """Run one dispense cycle on servo_num"""
+
+    @abc.abstractmethod
+    def measure_distance(self):
+        """Distance in cm, NO_ECHO_DISTANCE when there is no echo"""
+
+    def cleanup(self):
+        pass
+
+    def status(self):
+        return {"backend": self.name}
+
+class MockHardware(HardwareBackend):
+    """Instant responses and random distances"""
+    name = "mock"
+
+    def move_servo(self, servo_num, angle):
+        pass
+
+    def dispense(self, servo_num):
+        pass
+
+    def measure_distance(self):
+        return round(random.uniform(5, 20), 2)
+
+class SimulatedHardware(HardwareBackend):
+    """Time-accurate model of the two dispenser servos and the HC-SR04 sensor.
+
+    The tray reads `empty_distance_cm` until a pill is dispensed. After a drop
+    the patient reaches in with probability `pickup_probability` after a random
+    delay, and the sensor reads `hand_distance_cm` while their hand is there.
+    """
+    name = "sim"
+
+    def __init__(self, speed=1.0, seed=None, failure_rates=None, noise_cm=0.3,
+                 empty_distance_cm=15.0, hand_distance_cm=6.0, pickup_probability=0.9,
+                 pickup_delay_s=(2.0, 20.0), hand_duration_s=5.0, event_log_size=200):
+        self.clock = SimClock(speed)
+        self.random = random.Random(seed)
+        self.failure_rates = {kind: 0.0 for kind in FAILURE_KINDS}
+        self.failure_rates.update(failure_rates or {})
+        self.noise_cm = noise_cm
+        self.empty_distance_cm = empty_distance_cm
+        self.hand_distance_cm = hand_distance_cm
+        self.pickup_probability = pickup_probability
+        self.pickup_delay_s = pickup_delay_s
+        self.hand_duration_s = hand_duration_s
+
+        self.lock = threading.Lock()
+        self.servo_angles = {1: 0, 2: 0}
+        self.servo_locks = {1: threading.Lock(), 2: threading.Lock()}
+        self.sensor_lock = threading.Lock()  # One trigger/echo cycle at a time, like the real sensor
+        self.pending_failures = []
+        self.hand_windows = []  # (start, end) in simulated time
+        self.events = deque(maxlen=event_log_size)
+        self.stats = {"servo_moves": 0, "dispenses": 0, "measurements": 0, "pickups": 0,
+                      "injected_failures": 0, "busy_s": 0.0}
+
+    @classmethod
+    def from_env(cls):
+        """Build a simulator from ZIMA_SIM_* environment variables"""
+        failure_rates = {}
+        for item in os.environ.get("ZIMA_SIM_FAILURES", "").split(","):
+            if "=" in item:
+                kind, rate = item.split("=", 1)
+                if kind.strip() in FAILURE_KINDS:
+                    failure_rates[kind.strip()] = float(rate)
+                else:
+                    logger.warning(f"Ignoring unknown simulated failure: {kind}")
+        seed = os.environ.get("ZIMA_SIM_SEED")
+        return cls(
+            speed=float(os.environ.get("ZIMA_SIM_SPEED", "1")),
+            seed=int(seed) if seed else None,
+            failure_rates=failure_rates,
+            pickup_probability=float(os.environ.get("ZIMA_SIM_PICKUP_PROBABILITY", "0.9"))
+        )
+
+    def _record(self, event_type, **data):
+        event = {"time": round(self.clock.now(), 3), "event": event_type}
+        event.update(data)
+        with self.lock:
+            self.events.append(event)
+
+    def _busy(self, seconds):
+        self.clock.sleep(seconds)
+        with self.lock:
+            self.stats["busy_s"] += seconds
+
+    def _should_fail(self, kind):
+        with self.lock:
+            if kind in self.pending_failures:
+                self.pending_failures.remove(kind)
+                self.stats["injected_failures"] += 1
+                return True
+            if self.random.random() < self.failure_rates.get(kind, 0.0):
+                self.stats["injected_failures"] += 1
+                return True
+        return False
+
+    def inject_failure(self, kind, count=1):
+        """Make the next `count` operations of this kind fail"""
+        if kind not in FAILURE_KINDS:
+            raise ValueError(f"Unknown failure kind: {kind}")
+        with self.lock:
+            self.pending_failures.extend([kind] * count)
+        self._record("failure_armed", kind=kind, count=count)
+
+    def set_failure_rate(self, kind, rate):
+        if kind not in FAILURE_KINDS:
+            raise ValueError(f"Unknown failure kind: {kind}")
+        with self.lock:
+            self.failure_rates[kind] = max(0.0, min(1.0, float(rate)))
+
+    def move_servo(self, servo_num, angle):
+        with self.servo_locks[servo_num]:
+            if self._should_fail("servo_stall"):
+                # The real servo would buzz for the whole hold window before we notice
+                self._busy(SERVO_HOLD_S)
+                self._record("servo_stall", servo=servo_num, angle=angle)
+                raise HardwareFault(f"Servo {servo_num} stalled")
+            self._busy(SERVO_HOLD_S)
+            with self.lock:
+                self.servo_angles[servo_num] = angle
+                self.stats["servo_moves"] += 1
+        self._record("servo_move", servo=servo_num, angle=angle)
+
+    def dispense(self, servo_num):
+        # Same two-step sweep as HardwareController._rotate_servo
+        with self.servo_locks[servo_num]:
+            self._busy(SERVO_HOLD_S)
+            self._busy(SERVO_HOLD_S)
+            with self.lock:
+                self.stats["dispenses"] += 1
+        if self._should_fail("pill_jam"):
+            self._record("pill_jam", servo=servo_num)
+            return
+        self._record("pill_drop", servo=servo_num)
+        self.schedule_pickup()
+
+    def schedule_pickup(self, delay_s=None):
+        """Maybe put the patient's hand in the tray some time after a drop"""
+        if delay_s is None:
+            if self.random.random() >= self.pickup_probability:
+                self._record("pickup_missed")
+                return
+            delay_s = self.random.uniform(*self.pickup_delay_s)
+        start = self.clock.now() + delay_s
+        with self.lock:
+            self.hand_windows.append((start, start + self.hand_duration_s))
+            self.stats["pickups"] += 1
+        self._record("pickup_scheduled", at=round(start, 3))
+
+    def _true_distance(self, at):
+        with self.lock:
+            self.hand_windows = [w for w in self.hand_windows if w[1] > at]
+            hand_present = any(start <= at for start, _ in self.hand_windows)
+        return self.hand_distance_cm if hand_present else self.empty_distance_cm
+
+    def measure_distance(self):
+        with self.sensor_lock:
+            self._busy(SENSOR_SETTLE_S + TRIGGER_PULSE_S)
+            with self.lock:
+                self.stats["measurements"] += 1
+            if self._should_fail("echo_timeout"):
+                self._busy(ECHO_TIMEOUT_S)
+                self._record("echo_timeout")
+                return NO_ECHO_DISTANCE
+
+            distance = self._true_distance(self.clock.now()) + self.random.gauss(0, self.noise_cm)
+            if self._should_fail("sensor_spike"):
+                distance = self.random.uniform(2, 400)
+            distance = max(distance, 2.0)
+            echo_s = 2 * distance / SPEED_OF_SOUND_CM_S
+            if echo_s > ECHO_TIMEOUT_S:
+                self._busy(ECHO_TIMEOUT_S)
+                return NO_ECHO_DISTANCE
+            self._busy(echo_s)
+        return round(distance, 2)
+
+    def status(self):
+        with self.lock:
+            return {
+                "backend": self.name,
+                "speed": self.clock.speed,
+                "sim_time": round(self.clock.now(), 3),
+                "servo_angles": dict(self.servo_angles),
+                "failure_rates": dict(self.failure_rates),
+                "pending_failures": list(self.pending_failures),
+                "stats": {key: round(value, 3) if isinstance(value, float) else value
+                          for key, value in self.stats.items()},
+                "recent_events": list(self.events)[-20:]
+            }
+
+BACKENDS = {"mock": MockHardware, "sim": SimulatedHardware}
+
+def create_backend(name=None):
+    """Backend named by ZIMA_HARDWARE_BACKEND (default mock)"""
+    name = (name or os.environ.get("ZIMA_HARDWARE_BACKEND", "mock")).lower()
+    if name == "sim":
+        return SimulatedHardware.from_env()
+    if name not in BACKENDS:
+        logger.warning(f"Unknown hardware backend '{name}', using mock")
+        name = "mock"
+    return BACKENDS[name]()
@@ -0,0 +1,215 @@
+# local_llm.py - Optional small model on the Pi for answers while the server is offline
+#
+# Talks to a local Ollama (default) or a llama.cpp server on the Pi itself:
+#   ollama pull qwen2.5:0.5b          # ~400 MB at Q4, fits a 2 GB Pi 4
+#   ZIMA_LOCAL_LLM=1 python clientllmpi.py
+# or
+#   llama-server -m qwen2.5-0.5b-instruct-q4_k_m.gguf -c 1024 -t 3 --port 8080
+#   ZIMA_LOCAL_LLM=1 ZIMA_LOCAL_LLM_API=llamacpp ZIMA_LOCAL_LLM_URL=http://127.0.0.1:8080 ...
+#
+# One generation runs at a time with a short waiting line behind it. Every answer
+# has a hard deadline, queue wait included. The fixed system prompt is sent
+# first and warmed at startup, so the runtime's prompt cache only has to
+# prefill the user's question.
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+LOCAL_LLM_ENABLED = os.environ.get("ZIMA_LOCAL_LLM", "0") == "1"
+LOCAL_LLM_API = os.environ.get("ZIMA_LOCAL_LLM_API", "ollama")  # "ollama" or "llamacpp"
+LOCAL_LLM_URL = os.environ.get("ZIMA_LOCAL_LLM_URL", "http://127.0.0.1:11434")
+LOCAL_LLM_MODEL = os.environ.get("ZIMA_LOCAL_LLM_MODEL", "qwen2.5:0.5b")
+LOCAL_LLM_TIMEOUT = float(os.environ.get("ZIMA_LOCAL_LLM_TIMEOUT", "20"))  # Seconds per answer, queue wait included
+LOCAL_LLM_MAX_WAITING = 2        # Requests allowed to wait behind the running one
+LOCAL_LLM_MIN_FREE_MB = int(os.environ.get("ZIMA_LOCAL_LLM_MIN_FREE_MB", "300"))  # Skip the model below this
+LOCAL_LLM_THREADS = 3            # Leave one Pi 4 core for Flask and the hardware loop
+LOCAL_LLM_CONTEXT = 1024         # Small KV cache keeps the model inside the Pi's memory
+LOCAL_LLM_MAX_TOKENS = 160
+LOCAL_LLM_KEEP_ALIVE = "30m"
+
+LOCAL_SYSTEM_PROMPT = """You are the offline assistant of a home pill dispenser. The main server is unreachable, so keep answers short, plain and kind.
+The dispenser holds Paracetamol 500mg in slot 1 (pain and fever, at most 8 tablets in 24 hours) and Antibiotic 250mg in slot 2 (every 8 hours, with food, finish the course).
+You cannot diagnose. For chest pain, breathing trouble, fainting or other emergencies, tell the user to call emergency services now.
+"""
+
+def available_memory_mb():
+    """MemAvailable from /proc/meminfo, None where it cannot be read"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        return None
+    return None
+
+class LocalLLM:
+    """Bounded, deadline-limited access to the on-device model"""
+
+    def __init__(self, api=LOCAL_LLM_API, url=LOCAL_LLM_URL, model=LOCAL_LLM_MODEL, timeout=LOCAL_LLM_TIMEOUT,
+                 max_waiting=LOCAL_LLM_MAX_WAITING):
+        self.api = api
+        self.url = url.rstrip("/")
+        self.model = model
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self.condition = threading.Condition()
+        self.busy = False
+        self.waiting = 0
+        self.prefix_warm_ms = None
+        self.latencies_ms = deque(maxlen=100)
+        self.first_token_ms = deque(maxlen=100)
+        self.stats = {"requests": 0, "answered": 0, "rejected_busy": 0, "rejected_memory": 0,
+                      "timeouts": 0, "errors": 0}
+
+    def _count(self, stat):
+        with self.condition:
+            self.stats[stat] += 1
+
+    def _request(self, prompt, max_tokens, system=LOCAL_SYSTEM_PROMPT, stream=True, timeout=None):
+        if self.api == "llamacpp":
+            return requests.post(f"{self.url}/completion", json={
+                "prompt": f"{system}\nUser: {prompt}\nAssistant:",
+                "n_predict": max_tokens,
+                "cache_prompt": True,
+                "stream": stream
+            }, stream=stream, timeout=timeout)
+        return requests.post(f"{self.url}/api/generate", json={
+            "model": self.model,
+            "system": system,
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": LOCAL_LLM_KEEP_ALIVE,
+            "options": {"num_ctx": LOCAL_LLM_CONTEXT, "num_thread": LOCAL_LLM_THREADS, "num_predict": max_tokens}
+        }, stream=stream, timeout=timeout)
+
+    def _chunk_text(self, line):
+        if self.api == "llamacpp":
+            line = line[len(b"data: "):] if line.startswith(b"data: ") else line
+            chunk = json.loads(line)
+            return chunk.get("content", ""), chunk.get("stop", False)
+        chunk = json.loads(line)
+        return chunk.get("response", ""), chunk.get("done", False)
+
+    def warm_prefix(self):
+        """Load the model and prefill the system prompt so later answers only prefill the question"""
+        start = time.time()
+        try:
+            response = self._request("Hello", 1, stream=False, timeout=(3, 120))
+            response.raise_for_status()
+            self.prefix_warm_ms = round((time.time() - start) * 1000, 1)
+            logger.info(f"Local model {self.model} loaded and prompt prefix cached in {self.prefix_warm_ms} ms")
+            return True
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Local model warm-up failed, offline answers will use canned responses: {e}")
+            return False
+
+    def _admit(self, deadline):
+        """Wait for the model; False when the line is full or the deadline passes first"""
+        with self.condition:
+            if self.busy and self.waiting >= self.max_waiting:
+                self.stats["rejected_busy"] += 1
+                return False
+            self.waiting += 1
+            try:
+                while self.busy:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        return False
+                    self.condition.wait(remaining)
+                self.busy = True
+                return True
+            finally:
+                self.waiting -= 1
+
+    def _release(self):
+        with self.condition:
+            self.busy = False
+            self.condition.notify()
+
+    def generate(self, user_input):
+        """Answer text, or None when the model is busy, out of memory, too slow or unreachable"""
+        self._count("requests")
+        free_mb = available_memory_mb()
+        if free_mb is not None and free_mb < LOCAL_LLM_MIN_FREE_MB:
+            logger.warning(f"Only {free_mb} MB free, skipping the local model")
+            self._count("rejected_memory")
+            return None
+
+        start = time.time()
+        deadline = start + self.timeout
+        if not self._admit(deadline):
+            return None
+        try:
+            pieces = []
+            timed_out = False
+            with self._request(user_input, LOCAL_LLM_MAX_TOKENS, timeout=(3, max(1, deadline - time.time()))) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    text, done = self._chunk_text(line)
+                    if text and not pieces:
+                        with self.condition:
+                            self.first_token_ms.append((time.time() - start) * 1000)
+                    pieces.append(text)
+                    if done:
+                        break
+                    if time.time() > deadline:
+                        timed_out = True
+                        break
+            answer = "".join(pieces).strip()
+            if timed_out:
+                self._count("timeouts")
+                logger.warning(f"Local model hit the {self.timeout}s deadline after {len(answer)} characters")
+                # Cut back to the last full sentence so a truncated answer still reads cleanly
+                cut = max(answer.rfind(". "), answer.rfind("! "), answer.rfind("? "))
+                answer = answer[:cut + 1] if cut > 0 else ""
+            if not answer:
+                return None
+            with self.condition:
+                self.latencies_ms.append((time.time() - start) * 1000)
+            self._count("answered")
+            return answer
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"Local model request failed: {e}")
+            self._count("errors")
+            return None
+        finally:
+            self._release()
+
+    def status(self):
+        def pct(values, p):
+            if not values:
+                return None
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))], 1)
+        with self.condition:
+            return {
+                "api": self.api,
+                "model": self.model,
+                "timeout_s": self.timeout,
+                "busy": self.busy,
+                "waiting": self.waiting,
+                "prefix_warm_ms": self.prefix_warm_ms,
+                "available_memory_mb": available_memory_mb(),
+                "latency_ms": {"p50": pct(self.latencies_ms, 50), "p95": pct(self.latencies_ms, 95)},
+                "first_token_ms": {"p50": pct(self.first_token_ms, 50), "p95": pct(self.first_token_ms, 95)},
+                **self.stats
+            }
+
+def create_local_llm():
+    """LocalLLM when ZIMA_LOCAL_LLM=1, otherwise None"""
+    if not LOCAL_LLM_ENABLED:
+        return None
+    logger.info(f"Offline fallback model: {LOCAL_LLM_MODEL} via {LOCAL_LLM_API} at {LOCAL_LLM_URL}")
+    return LocalLLM()
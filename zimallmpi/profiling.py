@@ -0,0 +1,160 @@
+# profiling.py - Stack-sampling profiler for the server and the Pi
+#
+# A background thread reads every thread's Python stack through
+# sys._current_frames() at a fixed rate. No tracing hooks are installed, so
+# the app runs at full speed between samples.
+#
+#   on demand  - sample for N seconds and return collapsed stacks
+#                ("a;b;c 42" lines, the input format of flamegraph.pl and speedscope)
+#   continuous - sample at a low rate forever and keep per-minute hot function
+#                counts for the last hour
+#
+# The debug endpoints require ZIMA_DEBUG_TOKEN and are disabled without it.
+
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+DEBUG_TOKEN = os.environ.get("ZIMA_DEBUG_TOKEN", "")
+CONTINUOUS_PROFILING = os.environ.get("ZIMA_PROFILE_CONTINUOUS", "1") == "1"
+CONTINUOUS_HZ = float(os.environ.get("ZIMA_PROFILE_HZ", "2"))
+MAX_PROFILE_SECONDS = 60
+MAX_PROFILE_HZ = 1000
+HISTORY_BUCKET_S = 60
+HISTORY_WINDOW_S = 3600
+
+# Leaf frames of threads that are parked, not working. Left out unless asked for.
+IDLE_FRAMES = {
+    "threading.py:wait", "threading.py:_wait_for_tstate_lock", "selectors.py:select",
+    "socketserver.py:serve_forever", "socket.py:accept", "socket.py:readinto",
+    "queue.py:get", "thread.py:_worker", "ssl.py:read"
+}
+
+# Threads currently sampling, kept out of each other's results
+profiler_thread_ids = set()
+
+def check_token(request):
+    """(allowed, status_code, message) for a debug request"""
+    if not DEBUG_TOKEN:
+        return False, 403, "Set ZIMA_DEBUG_TOKEN to enable profiling endpoints"
+    auth = request.headers.get("Authorization", "")
+    supplied = auth[7:] if auth.startswith("Bearer ") else request.headers.get("X-Debug-Token", "")
+    if not hmac.compare_digest(supplied.encode(), DEBUG_TOKEN.encode()):
+        return False, 401, "Invalid debug token"
+    return True, 200, ""
+
+def frame_label(frame):
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+def sample_stacks():
+    """One collapsed stack per live thread except the profilers, root first"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = []
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id in profiler_thread_ids:
+            continue
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+        labels.append(names.get(thread_id, f"thread-{thread_id}"))
+        labels.reverse()
+        stacks.append(labels)
+    return stacks
+
+class SamplingProfiler:
+    """Collects collapsed stacks for a fixed duration; one run at a time"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def profile(self, seconds, hz, include_idle=False):
+        """Sample for `seconds` at `hz`, returns (Counter of 'a;b;c' stacks, samples taken). None if busy."""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+            interval = 1.0 / max(1.0, min(float(hz), MAX_PROFILE_HZ))
+            profiler_thread_ids.add(threading.get_ident())
+            stacks = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            next_sample = time.monotonic()
+            while next_sample < deadline:
+                for labels in sample_stacks():
+                    if include_idle or labels[-1] not in IDLE_FRAMES:
+                        stacks[";".join(labels)] += 1
+                samples += 1
+                next_sample += interval
+                time.sleep(max(0.0, next_sample - time.monotonic()))
+            return stacks, samples
+        finally:
+            profiler_thread_ids.discard(threading.get_ident())
+            self.lock.release()
+
+class ContinuousProfiler:
+    """Low-rate sampler keeping per-minute self and inclusive counts for the last hour"""
+
+    def __init__(self, hz=CONTINUOUS_HZ, bucket_s=HISTORY_BUCKET_S, window_s=HISTORY_WINDOW_S):
+        self.hz = hz
+        self.bucket_s = bucket_s
+        self.buckets = deque(maxlen=max(1, window_s // bucket_s))  # (bucket_start, self Counter, total Counter, samples)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def ensure_started(self):
+        # Started even at hz 0, so a config reload to a positive rate takes effect; run() idles meanwhile
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="continuous-profiler", daemon=True)
+            self.thread.start()
+
+    def _bucket(self, now):
+        start = int(now // self.bucket_s) * self.bucket_s
+        if not self.buckets or self.buckets[-1][0] != start:
+            self.buckets.append((start, Counter(), Counter(), [0]))
+        return self.buckets[-1]
+
+    def record(self, stacks, now=None):
+        with self.lock:
+            _, self_counts, total_counts, samples = self._bucket(now or time.time())
+            samples[0] += 1
+            for labels in stacks:
+                if labels[-1] in IDLE_FRAMES:
+                    continue
+                self_counts[labels[-1]] += 1
+                for label in set(labels[1:]):
+                    total_counts[label] += 1
+
+    def run(self):
+        profiler_thread_ids.add(threading.get_ident())
+        while True:
+            if self.hz <= 0:  # Paused by a config reload
+                time.sleep(1)
+                continue
+            self.record(sample_stacks())
+            time.sleep(1.0 / self.hz)
+
+    def hot_functions(self, minutes=60, top=30):
+        cutoff = time.time() - minutes * 60
+        self_counts, total_counts, samples = Counter(), Counter(), 0
+        with self.lock:
+            for start, bucket_self, bucket_total, bucket_samples in self.buckets:
+                if start + self.bucket_s < cutoff:
+                    continue
+                self_counts.update(bucket_self)
+                total_counts.update(bucket_total)
+                samples += bucket_samples[0]
+        return {
+            "running": self.thread is not None and self.hz > 0,
+            "hz": self.hz,
+            "minutes": minutes,
+            "samples": samples,
+            "self": [{"function": name, "samples": count} for name, count in self_counts.most_common(top)],
+            "inclusive": [{"function": name, "samples": count} for name, count in total_counts.most_common(top)]
+        }
+
+def collapsed_text(stacks):
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
@@ -0,0 +1,270 @@
+# safety_rules.py - Drug interaction, allergy and condition checks per user
+#
+# Rules come from a local table (interaction_rules.json next to this file, or
+# ZIMA_INTERACTION_RULES). Drug names are matched to classes by word, so
+# "Ibuprofen 400mg" is an NSAID and "Co-codamol" is both paracetamol and an
+# opioid. Words are reduced to their singular first, so an allergy recorded as
+# "Penicillins" or "NSAIDs" matches the same rules as the singular. The table's
+# "checks" are known answers that every loaded table must reproduce.
+#
+# Every user's conflicts are computed once, when their profile is saved, and
+# kept in memory. Dispensing and each chat turn then need only a dictionary
+# lookup. The LLM is handed the finished verdict to explain; it is never asked
+# to find conflicts itself.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import user_model
+
+logger = logging.getLogger(__name__)
+
+RULES_PATH = os.environ.get("ZIMA_INTERACTION_RULES",
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "interaction_rules.json"))
+SEVERITY_ORDER = {"minor": 0, "moderate": 1, "major": 2, "contraindicated": 3}
+BLOCK_SEVERITY = "major"      # This severity and above stops a dispense
+CAUTION_SEVERITY = "moderate"
+
+WORD_RE = re.compile(r"[a-z][a-z\-]*")
+# Dosage forms and filler that must not make two names look like the same drug
+STOP_WORDS = {"mg", "ml", "tablet", "tablets", "capsule", "capsules", "oral", "syrup", "cream", "drops", "extended",
+              "release", "slow", "sr", "xr", "and", "with", "to", "of", "allergy", "drugs", "drug", "medicine"}
+
+def singular(word):
+    if len(word) > 4 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+def words(text):
+    return {singular(word) for word in WORD_RE.findall(str(text).lower()) if word not in STOP_WORDS}
+
+def level_for(conflicts):
+    worst = max((SEVERITY_ORDER[c["severity"]] for c in conflicts), default=-1)
+    if worst >= SEVERITY_ORDER[BLOCK_SEVERITY]:
+        return "block"
+    if worst >= SEVERITY_ORDER[CAUTION_SEVERITY]:
+        return "caution"
+    return "ok"
+
+class SafetyEngine:
+    """Rules table plus a cache of precomputed per-user conflict sets"""
+
+    def __init__(self, rules_path=RULES_PATH, default_slots=None):
+        self.rules_path = rules_path
+        self.default_slots = {str(slot): name for slot, name in (default_slots or {}).items()}
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.stats = {"recomputed": 0, "unchanged": 0, "lookups": 0, "lookup_misses": 0, "blocked_dispenses": 0}
+        self.load_rules()
+
+    def load_rules(self):
+        with open(self.rules_path) as f:
+            rules = json.load(f)
+        self.rules = rules
+        self.member_classes = {}
+        for class_name, members in rules.get("classes", {}).items():
+            for member in members:
+                self.member_classes.setdefault(singular(member.lower()), set()).add(class_name)
+        self.interactions = {}
+        for rule in rules.get("interactions", []):
+            self.interactions[frozenset((rule["a"], rule["b"]))] = rule
+        self.duplicate_classes = set(rules.get("duplicate_classes", []))
+        self.rules_version = hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:12]
+        failures = self.failed_checks()
+        if failures:
+            raise ValueError(f"{self.rules_path} fails its own checks: " + "; ".join(failures))
+        with self.lock:
+            self.profiles.clear()  # Fingerprints include the rules version, everything is recomputed lazily
+        logger.info(f"Loaded {len(self.interactions)} interaction, {len(rules.get('allergies', []))} allergy and "
+                    f"{len(rules.get('conditions', []))} condition rules from {self.rules_path}")
+
+    def failed_checks(self):
+        """Descriptions of the table's known-answer checks that the loaded rules get wrong"""
+        failures = []
+        for check in self.rules.get("checks", []):
+            profile = user_model.UserProfile.from_dict({
+                "personal": {"name": "check"},
+                "medical_history": {"allergies": check.get("allergies", []), "conditions": check.get("conditions", [])},
+                "medications": [{"name": check["drug"], "slot": 1}]
+            }, strict=False)
+            level = self.evaluate(profile)["slots"]["1"]["level"]
+            if level != check["level"]:
+                failures.append(f"{check['drug']} (allergies {check.get('allergies', [])}, conditions "
+                                f"{check.get('conditions', [])}) is '{level}', expected '{check['level']}'")
+        return failures
+
+    def classes_of(self, name):
+        classes = set()
+        for word in words(name):
+            classes |= self.member_classes.get(word, set())
+        return classes
+
+    def _drug_conflicts(self, drug, allergies, conditions):
+        """Allergy and condition conflicts for one drug name"""
+        conflicts = []
+        drug_words = words(drug)
+        drug_classes = self.classes_of(drug)
+        for allergy in allergies:
+            allergy_terms = words(allergy) | self.classes_of(allergy)
+            if drug_words & words(allergy):
+                conflicts.append({"type": "allergy", "drugs": [drug], "allergy": allergy, "severity": "contraindicated",
+                                  "note": f"Recorded allergy to {allergy}."})
+                continue
+            for rule in self.rules.get("allergies", []):
+                if rule["allergy"] in allergy_terms and rule["avoid"] in drug_classes:
+                    conflicts.append({"type": "allergy", "drugs": [drug], "allergy": allergy,
+                                      "severity": rule["severity"], "note": rule["note"]})
+                    break
+        for condition in conditions:
+            condition_text = str(condition).lower()
+            for rule in self.rules.get("conditions", []):
+                if rule["condition"] in condition_text and rule["avoid"] in drug_classes:
+                    conflicts.append({"type": "condition", "drugs": [drug], "condition": condition,
+                                      "severity": rule["severity"], "note": rule["note"]})
+        return conflicts
+
+    def _pair_conflicts(self, first, second):
+        """Interaction and duplicate-therapy conflicts between two drug names"""
+        conflicts = []
+        first_classes, second_classes = self.classes_of(first), self.classes_of(second)
+        seen = set()
+        for a in first_classes:
+            for b in second_classes:
+                rule = self.interactions.get(frozenset((a, b)))
+                if rule and id(rule) not in seen:
+                    seen.add(id(rule))
+                    conflicts.append({"type": "interaction", "drugs": [first, second],
+                                      "severity": rule["severity"], "note": rule["note"]})
+        for shared in sorted(first_classes & second_classes & self.duplicate_classes):
+            conflicts.append({"type": "duplicate", "drugs": [first, second], "severity": "major",
+                              "note": f"Both contain {shared.replace('_', ' ')}; taking both doubles the dose."})
+        return conflicts
+
+    def fingerprint(self, profile):
+        relevant = {
+            "medications": sorted((m.name, str(m.slot)) for m in profile.medications),
+            "allergies": sorted(profile.allergies),
+            "conditions": sorted(profile.conditions),
+            "rules": self.rules_version
+        }
+        return hashlib.sha1(json.dumps(relevant).encode()).hexdigest()
+
+    def evaluate(self, profile):
+        """Full conflict set for a UserProfile, plus a verdict for every dispenser slot"""
+        allergies = profile.allergies
+        conditions = profile.conditions
+        names = [m.name for m in profile.medications]
+
+        drug_conflicts = {name: self._drug_conflicts(name, allergies, conditions) for name in names}
+        conflicts = [c for name in names for c in drug_conflicts[name]]
+        for i, first in enumerate(names):
+            for second in names[i + 1:]:
+                conflicts.extend(self._pair_conflicts(first, second))
+
+        slot_drugs = dict(self.default_slots)
+        slot_drugs.update({str(slot): m.name for slot, m in profile.meds_by_slot.items()})
+        slots = {}
+        for slot, drug in slot_drugs.items():
+            others = [name for name in names if name != drug]
+            slot_conflicts = drug_conflicts[drug] if drug in drug_conflicts else self._drug_conflicts(drug, allergies, conditions)
+            slot_conflicts = slot_conflicts + [c for other in others for c in self._pair_conflicts(drug, other)]
+            slots[slot] = {"drug": drug, "level": level_for(slot_conflicts), "conflicts": slot_conflicts}
+            if drug not in names:
+                conflicts.extend(c for c in slot_conflicts if c not in conflicts)
+
+        conflicts.sort(key=lambda c: -SEVERITY_ORDER[c["severity"]])
+        return {
+            "user_id": profile.id or "",
+            "level": level_for(conflicts),
+            "conflicts": conflicts,
+            "slots": slots,
+            "rules_version": self.rules_version,
+            "computed_at": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }
+
+    def update_user(self, user_id, user_profile):
+        """Recompute one user's conflict set if anything it depends on changed"""
+        fingerprint = self.fingerprint(user_profile)
+        with self.lock:
+            current = self.profiles.get(str(user_id))
+            if current and current["fingerprint"] == fingerprint:
+                self.stats["unchanged"] += 1
+                return current["profile"]
+        profile = self.evaluate(user_profile)
+        profile["user_id"] = str(user_id)
+        with self.lock:
+            self.profiles[str(user_id)] = {"fingerprint": fingerprint, "profile": profile}
+            self.stats["recomputed"] += 1
+        if profile["conflicts"]:
+            logger.info(f"User {user_id} safety level '{profile['level']}' with {len(profile['conflicts'])} conflicts")
+        return profile
+
+    def rebuild(self, profiles):
+        for user_profile in profiles:
+            if user_profile.id is not None:
+                self.update_user(user_profile.id, user_profile)
+
+    def forget_user(self, user_id):
+        with self.lock:
+            self.profiles.pop(str(user_id), None)
+
+    def safety_profile(self, user_id, user_profile=None, loader=None):
+        """Precomputed conflicts; computed on first use from user_profile or loader(user_id). None for unknown users."""
+        with self.lock:
+            self.stats["lookups"] += 1
+            current = self.profiles.get(str(user_id))
+            if current:
+                return current["profile"]
+            self.stats["lookup_misses"] += 1
+        if user_profile is None and loader is not None:
+            user_profile = loader(user_id)
+        if user_profile is None:
+            return None
+        return self.update_user(user_id, user_profile)
+
+    def check_dispense(self, user_id, slot, loader=None):
+        """{"allowed", "level", "drug", "conflicts"} for dispensing slot to user_id"""
+        profile = self.safety_profile(user_id, loader=loader)
+        verdict = (profile or {}).get("slots", {}).get(str(slot))
+        if verdict is None:
+            return {"allowed": True, "level": "unknown", "drug": self.default_slots.get(str(slot)), "conflicts": []}
+        allowed = verdict["level"] != "block"
+        if not allowed:
+            with self.lock:
+                self.stats["blocked_dispenses"] += 1
+        return {"allowed": allowed, **verdict}
+
+    def status(self):
+        with self.lock:
+            levels = {}
+            for entry in self.profiles.values():
+                levels[entry["profile"]["level"]] = levels.get(entry["profile"]["level"], 0) + 1
+            return {"rules_path": self.rules_path, "rules_version": self.rules_version,
+                    "profiles": len(self.profiles), "levels": levels, **self.stats}
+
+def describe_conflict(conflict):
+    if conflict["type"] == "allergy":
+        subject = f"{conflict['drugs'][0]} with allergy to {conflict['allergy']}"
+    elif conflict["type"] == "condition":
+        subject = f"{conflict['drugs'][0]} with {conflict['condition']}"
+    else:
+        subject = " + ".join(conflict["drugs"])
+    return f"{conflict['severity'].upper()} {conflict['type']}: {subject}. {conflict['note']}"
+
+def prompt_block(profile):
+    """Safety section for the LLM prompt; the model explains these findings and adds none of its own"""
+    if profile is None:
+        return ""
+    if not profile["conflicts"]:
+        return "Safety check: no known interaction, allergy or condition conflicts in this user's medications.\n"
+    lines = ["Safety check (from the dispenser's interaction rules; explain these, do not add others):"]
+    lines.extend(f"- {describe_conflict(conflict)}" for conflict in profile["conflicts"])
+    for slot, verdict in sorted(profile["slots"].items()):
+        if verdict["level"] == "block":
+            lines.append(f"- Dispensing {verdict['drug']} from slot {slot} is blocked for this user.")
+    return "\n".join(lines) + "\n"
@@ -1,15 +1,34 @@
 # serverollamamac.py
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response
 import os
 import json
+import hashlib
 import logging
 import time
 from datetime import datetime
 from flask_cors import CORS
 import requests
 import subprocess
+import wire_protocol
+import tracing
+import profiling
+import drug_index
+import safety_rules
+import user_bulk
+import user_model
+import fleet
+import command_queue
+import config
+import re
+import sys
 import threading
+import queue
+import heapq
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
 # Configure logging
 logging.basicConfig(
@@ -24,19 +43,160 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+tracer = tracing.Tracer("serverllm")
+tracing.init_app(app, tracer)
+sampling_profiler = profiling.SamplingProfiler()
+
+def check_model_tiers(tiers):
+    """Errors in a model_tiers setting; the tier names are fixed because routing picks them by name"""
+    errors = []
+    if set(tiers) != {"tool", "templated", "reasoning"}:
+        return ["model_tiers must define exactly the tool, templated and reasoning tiers"]
+    for name, tier in tiers.items():
+        if not isinstance(tier, dict):
+            errors.append(f"model_tiers.{name} must be an object")
+            continue
+        if tier.get("model") is not None and not (isinstance(tier["model"], str) and tier["model"]):
+            errors.append(f"model_tiers.{name}.model must be a model name, or null for ollama_model")
+        if not (isinstance(tier.get("keep_alive"), str) and re.fullmatch(r"\d+[smh]", tier["keep_alive"])):
+            errors.append(f"model_tiers.{name}.keep_alive must look like 30s, 10m or 1h")
+        if not (type(tier.get("max_concurrency")) is int and tier["max_concurrency"] >= 1):
+            errors.append(f"model_tiers.{name}.max_concurrency must be a whole number of at least 1")
+    return errors
+
+# Every knob is declared here once; see config.py for the file/env/--set layers
+# and which settings hot-reload. The module constants below are read from it.
+SERVER_SETTINGS = [
+    config.Setting("data_dir", os.path.join(os.path.expanduser("~"), "zima_data"),
+                   help="User profiles and the device command journal are stored here"),
+    config.Setting("ollama_host", "http://localhost:11434", help="Ollama base URL"),
+    config.Setting("ollama_model", "deepseek-r1:8b", help="Main model; the reasoning tier uses it unless it names its own"),
+    # "keyword" uses detect_function_calls heuristics and a second generation pass,
+    # "native" sends AVAILABLE_FUNCTIONS as tools to /api/chat
+    config.Setting("tool_mode", "keyword", choices=("keyword", "native"), help="Function calling mode"),
+    config.Setting("max_tool_rounds", 3, int, minimum=1, maximum=10, reloadable=True,
+                   help="Upper bound on model -> tool -> model round trips per turn"),
+    config.Setting("include_reasoning", False, bool, reloadable=True,
+                   help="Return stripped <think> traces in a separate reasoning field, for debugging"),
+    config.Setting("ollama_concurrency", 2, int, minimum=1, maximum=64, reloadable=True,
+                   help="Generations running at once"),
+    config.Setting("ollama_max_queue_depth", 16, int, minimum=0, reloadable=True,
+                   help="Waiting requests before new chit-chat gets 503"),
+    config.Setting("ollama_max_pending_per_user", 2, int, minimum=1, reloadable=True,
+                   help="Waiting + running requests per user before 429"),
+    config.Setting("ollama_queue_timeout_s", 60.0, float, minimum=1, reloadable=True,
+                   help="Seconds a request may wait for Ollama, keep well under the Pi's chat timeout"),
+    config.Setting("ollama_connect_timeout_s", 5.0, float, minimum=0.1, reloadable=True),
+    config.Setting("ollama_read_timeout_s", 180.0, float, minimum=1, reloadable=True),
+    config.Setting("model_warmup", True, bool, help="Preload the configured models and keep them resident"),
+    config.Setting("ollama_probe_timeout_s", 3.0, float, minimum=0.1, reloadable=True,
+                   help="Seconds for Ollama health probes, never block on a hung Ollama"),
+    config.Setting("status_refresh_interval_s", 10.0, float, minimum=1, reloadable=True,
+                   help="Seconds between background health probes"),
+    config.Setting("client_probe_timeout_s", 2.0, float, minimum=0.1, reloadable=True,
+                   help="Seconds per registered client probe"),
+    config.Setting("client_inactive_after_s", 600, int, minimum=60, reloadable=True,
+                   help="Registered clients not seen for this long are dropped"),
+    config.Setting("client_cleanup_interval_s", 300, int, minimum=10, reloadable=True),
+    config.Setting("model_routing", True, bool, reloadable=True,
+                   help="Send trivial turns to smaller models instead of ollama_model"),
+    config.Setting("model_tiers", {
+        "tool": {"model": "qwen2.5:1.5b", "keep_alive": "30m", "max_concurrency": 4,
+                 "description": "Device actions where the reply only confirms the function result"},
+        "templated": {"model": "qwen2.5:1.5b", "keep_alive": "30m", "max_concurrency": 4,
+                      "description": "Greetings, thanks and other short small-talk turns"},
+        "reasoning": {"model": None, "keep_alive": "10m", "max_concurrency": 1,
+                      "description": "Medical questions that need the reasoning model"}
+    }, dict, reloadable=True, check=check_model_tiers, help="Model, keep_alive and concurrency per routing tier"),
+    config.Setting("dispense_ack_wait_s", 12.0, float, minimum=0, maximum=60, reloadable=True,
+                   help="How long a dispense request waits for the Pi to confirm before answering pending"),
+    config.Setting("command_ttl_s", command_queue.COMMAND_TTL_S, int, minimum=30, reloadable=True,
+                   help="Queued device commands not delivered within this many seconds are dropped"),
+    config.Setting("fleet_stale_after_s", fleet.STALE_AFTER_S, int, env="ZIMA_FLEET_STALE_S", minimum=1, reloadable=True),
+    config.Setting("fleet_offline_after_s", fleet.OFFLINE_AFTER_S, int, env="ZIMA_FLEET_OFFLINE_S", minimum=1, reloadable=True),
+    config.Setting("profile_hz", profiling.CONTINUOUS_HZ, float, minimum=0, maximum=profiling.MAX_PROFILE_HZ,
+                   reloadable=True, help="Continuous profiler samples per second; 0 pauses it"),
+]
+settings = config.load(SERVER_SETTINGS, os.path.join(os.path.expanduser("~"), "zima_data", "server_config.json"),
+                       sys.argv[1:] if __name__ == "__main__" else [])
+continuous_profiler = profiling.ContinuousProfiler(hz=settings["profile_hz"])
 
 # Ollama configuration
-OLLAMA_HOST = "http://localhost:11434"
-OLLAMA_MODEL = "deepseek-r1:8b"
+OLLAMA_HOST = settings["ollama_host"]
+OLLAMA_MODEL = settings["ollama_model"]
+OLLAMA_TOOL_MODE = settings["tool_mode"]
+MAX_TOOL_ROUNDS = settings["max_tool_rounds"]
+
+# deepseek-r1 <think> traces are stripped before replies leave the server
+INCLUDE_REASONING = settings["include_reasoning"]
+
+# Admission control in front of Ollama
+OLLAMA_MAX_CONCURRENCY = settings["ollama_concurrency"]
+OLLAMA_MAX_QUEUE_DEPTH = settings["ollama_max_queue_depth"]
+OLLAMA_MAX_PENDING_PER_USER = settings["ollama_max_pending_per_user"]
+OLLAMA_QUEUE_TIMEOUT = settings["ollama_queue_timeout_s"]
+OLLAMA_REQUEST_TIMEOUT = (settings["ollama_connect_timeout_s"], settings["ollama_read_timeout_s"])
+
+# Model warm-up and residency
+MODEL_WARMUP_ENABLED = settings["model_warmup"]
+OLLAMA_PROBE_TIMEOUT = settings["ollama_probe_timeout_s"]
+
+# Background health monitor behind /api/system_status
+SERVER_START_TIME = time.time()
+SERVER_VERSION = "1.0"
+STATUS_REFRESH_INTERVAL = settings["status_refresh_interval_s"]
+CLIENT_PROBE_TIMEOUT = settings["client_probe_timeout_s"]
+CLIENT_INACTIVE_AFTER_S = settings["client_inactive_after_s"]
+CLIENT_CLEANUP_INTERVAL_S = settings["client_cleanup_interval_s"]
+
+# Lower number is served first
+INTENT_PRIORITIES = {"emergency": 0, "medication": 1, "chat": 2}
+EMERGENCY_KEYWORDS = ["emergency", "help me", "can't breathe", "cannot breathe", "chest pain", "overdose*", "unconscious", "fell", "bleeding"]
+MEDICATION_KEYWORDS = ["dispens*", "pill*", "medication*", "medicine*", "dose*", "paracetamol", "antibiotic*", "missed", "slot*"]
+
+# Model tiers: trivial turns go to a small model, medical questions to deepseek-r1
+MODEL_ROUTING_ENABLED = settings["model_routing"]
+
+def resolve_model_tiers(tiers):
+    """Tier settings with a null model filled in from OLLAMA_MODEL"""
+    return {name: dict(tier, model=tier.get("model") or OLLAMA_MODEL) for name, tier in tiers.items()}
+
+MODEL_TIERS = resolve_model_tiers(settings["model_tiers"])
+DEFAULT_MODEL_TIER = "reasoning"
+
+def keyword_pattern(keywords):
+    """Regex matching any keyword as whole words; a trailing * matches any ending, as in "allerg*" """
+    alternatives = []
+    for keyword in keywords:
+        stem = keyword.rstrip("*")
+        alternatives.append(r"\s+".join(map(re.escape, stem.split())) + (r"\w*" if keyword.endswith("*") else ""))
+    return re.compile(r"\b(?:" + "|".join(alternatives) + r")\b")
+
+# Any of these sends the turn to the reasoning tier, even if a device action was detected
+MEDICAL_REASONING_KEYWORDS = [
+    "pain", "pains", "painful", "ache", "aches", "aching", "headache*", "stomachache*", "fever*", "symptom*",
+    "side effect*", "interact*", "allerg*", "dose", "doses", "dosage", "overdose*", "dizz*", "nause*", "sick*",
+    "feel*", "pregnan*", "why", "should i", "can i", "is it safe", "instead of"
+]
+SMALL_TALK_KEYWORDS = ["hello", "hi", "hey", "thanks", "thank you", "good morning", "good evening", "good night", "bye"]
+MEDICAL_REASONING_PATTERN = keyword_pattern(MEDICAL_REASONING_KEYWORDS)
+SMALL_TALK_PATTERN = keyword_pattern(SMALL_TALK_KEYWORDS)
+EMERGENCY_PATTERN = keyword_pattern(EMERGENCY_KEYWORDS)
+MEDICATION_PATTERN = keyword_pattern(MEDICATION_KEYWORDS)
 
 # Data storage paths
-DATA_DIR = os.path.join(os.path.expanduser("~"), "zima_data")
+DATA_DIR = settings["data_dir"]
 USERS_DIR = os.path.join(DATA_DIR, "users")
 
 
 
 # Ensure directories exist
 os.makedirs(USERS_DIR, exist_ok=True)
+user_ids = user_bulk.UserIdAllocator(USERS_DIR)
+profile_store = user_model.ProfileStore(USERS_DIR, logger=logger)
+MAX_REPORTED_IMPORT_ERRORS = 100  # Row errors returned when an import is rejected
+COMMAND_JOURNAL = os.path.join(DATA_DIR, "commands.jsonl")
+DISPENSE_ACK_WAIT_S = settings["dispense_ack_wait_s"]
 
 # Client registration tracking
 registered_clients = {}
@@ -72,9 +232,75 @@ AVAILABLE_FUNCTIONS = {
     }
 }
 
+SYSTEM_PROMPT = """You are an assistant for a smart pill dispenser system called Zima Pharma.
+        The system has two medication slots:
+        - Slot 1 contains Paracetamol (500mg) for pain and fever
+        - Slot 2 contains Antibiotics (250mg) that should be taken with food
+        
+        You can perform the following actions:
+        1. Get weather information for any city
+        2. Control servo motors (rotate 90 degrees clockwise or counterclockwise)
+        3. Dispense medication from compartments
+        4. Measure distance to check pill pickup
+        
+        When users ask about weather, servo control, or medication dispensing, I will execute the appropriate functions.
+        Always provide helpful medical information and remind users about proper medication usage.
+        For emergencies or serious medical concerns, advise users to contact a healthcare professional.
+        """
+
+def build_ollama_tools(functions):
+    """Convert AVAILABLE_FUNCTIONS into the JSON-schema tool list used by Ollama /api/chat"""
+    tools = []
+    for name, spec in functions.items():
+        properties = {}
+        required = []
+        for param_name, param in spec.get("parameters", {}).items():
+            properties[param_name] = {
+                "type": param.get("type", "string"),
+                "description": param.get("description", "")
+            }
+            if "default" in param:
+                properties[param_name]["default"] = param["default"]
+            else:
+                required.append(param_name)
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": name,
+                "description": spec.get("description", ""),
+                "parameters": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": required
+                }
+            }
+        })
+    return tools
+
+# Built once, the schema does not change at runtime
+OLLAMA_TOOLS = build_ollama_tools(AVAILABLE_FUNCTIONS)
+
+# Per-tier concurrency limits and latency samples
+tier_semaphores = {name: threading.BoundedSemaphore(tier["max_concurrency"]) for name, tier in MODEL_TIERS.items()}
+tier_stats = {name: {"requests": 0, "errors": 0, "latencies_ms": deque(maxlen=200), "wait_ms": deque(maxlen=200)}
+              for name in MODEL_TIERS}
+tier_stats_lock = threading.Lock()
+
+# Reasoning trace metrics, token counts are per streamed chunk (one chunk is one token in Ollama)
+reasoning_stats = {"responses": 0, "responses_with_reasoning": 0, "reasoning_tokens": 0, "answer_tokens": 0}
+reasoning_stats_lock = threading.Lock()
+
+def configured_models():
+    """Return every distinct model referenced by OLLAMA_MODEL and the tiers"""
+    models = [OLLAMA_MODEL]
+    for tier in MODEL_TIERS.values():
+        if tier["model"] not in models:
+            models.append(tier["model"])
+    return models
+
 # Ensure Ollama is running with deepseek-r1 model
 def setup_ollama():
-    """Check if Ollama is running and the deepseek-r1 model is available"""
+    """Check if Ollama is running and the configured models are available"""
     try:
         # Check if Ollama is running
         response = requests.get(f"{OLLAMA_HOST}/api/tags")
@@ -86,11 +312,14 @@ def setup_ollama():
         models = response.json().get("models", [])
         model_names = [model.get("name") for model in models]
         
-        if OLLAMA_MODEL not in model_names:
-            logger.warning(f"{OLLAMA_MODEL} model not found. Pulling model...")
+        for model_name in configured_models():
+            if model_name in model_names:
+                continue
+            
+            logger.warning(f"{model_name} model not found. Pulling model...")
             # Try to pull the model
             pull_process = subprocess.Popen(
-                ["ollama", "pull", OLLAMA_MODEL],
+                ["ollama", "pull", model_name],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 text=True
@@ -104,17 +333,247 @@ def setup_ollama():
             pull_process.wait()
             
             if pull_process.returncode != 0:
-                logger.error(f"Failed to pull {OLLAMA_MODEL} model")
+                logger.error(f"Failed to pull {model_name} model")
                 return False
             
-            logger.info(f"Successfully pulled {OLLAMA_MODEL} model")
+            logger.info(f"Successfully pulled {model_name} model")
             
-        logger.info(f"Ollama setup complete. {OLLAMA_MODEL} model is available.")
+        logger.info(f"Ollama setup complete. Models available: {configured_models()}")
         return True
     except Exception as e:
         logger.error(f"Error setting up Ollama: {e}")
         return False
 
+def model_keep_alive(model_name):
+    """keep_alive for a model, the longest of the tiers that use it"""
+    durations = [tier["keep_alive"] for tier in MODEL_TIERS.values() if tier["model"] == model_name]
+    if not durations:
+        return "10m"
+    return max(durations, key=lambda value: int(value[:-1]) * {"s": 1, "m": 60, "h": 3600}.get(value[-1], 1))
+
+class ModelLifecycleManager:
+    """Preloads configured models, keeps them resident and re-warms them after Ollama restarts.
+    
+    Warming sends a one-token generation with the system prompt, so the model weights
+    are loaded and the system prompt prefix is already in Ollama's cache.
+    """
+    def __init__(self, models, warmup_enabled=True):
+        self.models = models
+        self.warmup_enabled = warmup_enabled
+        self.lock = threading.Lock()
+        self.ollama_online = None
+        self.states = {model: {"state": "unloaded", "last_warmed": None, "load_ms": None, "warm_count": 0, "error": None}
+                       for model in models}
+    
+    def set_models(self, models):
+        """Track a new model list after the tiers changed; new models warm on the next health check.
+        
+        States of models no longer configured are kept, a warm-up may still be running for them.
+        """
+        with self.lock:
+            for model in models:
+                self.states.setdefault(model, {"state": "unloaded", "last_warmed": None, "load_ms": None,
+                                               "warm_count": 0, "error": None})
+            self.models = models
+    
+    def _set_state(self, model, **fields):
+        with self.lock:
+            self.states[model].update(fields)
+    
+    def warm_model(self, model):
+        """Load a model and prime its system prompt context"""
+        self._set_state(model, state="loading", error=None)
+        start = time.time()
+        try:
+            response = requests.post(f"{OLLAMA_HOST}/api/generate", json={
+                "model": model,
+                "system": SYSTEM_PROMPT,
+                "prompt": "Ready?",
+                "stream": False,
+                "keep_alive": model_keep_alive(model),
+                "options": {"num_predict": 1}
+            }, timeout=OLLAMA_REQUEST_TIMEOUT)
+            if response.status_code != 200:
+                raise RuntimeError(f"Ollama returned status {response.status_code}")
+            
+            load_ms = round((time.time() - start) * 1000, 1)
+            with self.lock:
+                state = self.states[model]
+                state.update(state="loaded", last_warmed=datetime.now().isoformat(), load_ms=load_ms)
+                state["warm_count"] += 1
+            logger.info(f"Model {model} warmed in {load_ms} ms (keep_alive {model_keep_alive(model)})")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to warm model {model}: {e}")
+            self._set_state(model, state="error", error=str(e))
+            return False
+    
+    def warm_all(self):
+        for model in self.models:
+            self.warm_model(model)
+    
+    def _start_warm(self, model):
+        """Warm in the background so a slow model load never stalls the health probe"""
+        self._set_state(model, state="loading")
+        threading.Thread(target=self.warm_model, args=(model,), daemon=True, name=f"Warm-{model}").start()
+    
+    def check_health(self):
+        """Probe Ollama, re-warm after a restart or when a model was unloaded.
+        
+        Returns (online, latency_ms) so other monitors can reuse the probe.
+        """
+        start = time.time()
+        try:
+            response = requests.get(f"{OLLAMA_HOST}/api/ps", timeout=OLLAMA_PROBE_TIMEOUT)
+            response.raise_for_status()
+            loaded = {model.get("name") for model in response.json().get("models", [])}
+            online = True
+        except Exception as e:
+            logger.debug(f"Ollama health probe failed: {e}")
+            loaded = set()
+            online = False
+        latency_ms = round((time.time() - start) * 1000, 1)
+        
+        was_online = self.ollama_online
+        self.ollama_online = online
+        if not online:
+            if was_online:
+                logger.warning("Ollama went offline, models will be re-warmed when it returns")
+            for model in self.models:
+                self._set_state(model, state="unknown")
+            return online, latency_ms
+        
+        if was_online is False:
+            logger.info("Ollama is back online, re-warming models")
+        for model in self.models:
+            with self.lock:
+                state = self.states[model]["state"]
+            if model in loaded:
+                if state != "loaded":
+                    self._set_state(model, state="loaded")
+            elif not self.warmup_enabled:
+                self._set_state(model, state="unloaded")
+            elif state != "loading":
+                if state == "loaded":
+                    logger.info(f"Model {model} is no longer resident, re-warming")
+                self._start_warm(model)
+        return online, latency_ms
+    
+    def status(self):
+        with self.lock:
+            return {
+                "ollama_online": self.ollama_online,
+                "models": {model: dict(self.states[model]) for model in self.models}
+            }
+
+model_lifecycle = ModelLifecycleManager(configured_models(), warmup_enabled=MODEL_WARMUP_ENABLED)
+
+def format_uptime(seconds):
+    days, remainder = divmod(int(seconds), 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if days:
+        return f"{days}d {hours}h {minutes}m"
+    return f"{hours}h {minutes}m {seconds}s"
+
+class SystemHealthMonitor:
+    """Probes Ollama, registered clients and storage on an interval and caches the result.
+    
+    /api/system_status only reads the cached snapshot, so a hung Ollama or an
+    unreachable Pi can never hold a Flask thread.
+    """
+    def __init__(self, interval=STATUS_REFRESH_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = False
+        self.client_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ClientProbe")
+        self.snapshot = {
+            "refreshed_at": None,
+            "refresh_ms": None,
+            "ollama": {"status": "unknown", "latency_ms": None, "checked_at": None},
+            "clients": {},
+            "storage": {"status": "unknown", "users_count": None, "latency_ms": None}
+        }
+    
+    def _probe_ollama(self):
+        online, latency_ms = model_lifecycle.check_health()
+        return {
+            "status": "online" if online else "offline",
+            "latency_ms": latency_ms,
+            "checked_at": datetime.now().isoformat()
+        }
+    
+    def _probe_client(self, client_ip):
+        start = time.time()
+        try:
+            response = requests.get(f"http://{client_ip}:5001/connection_status", timeout=CLIENT_PROBE_TIMEOUT)
+            reachable = response.status_code == 200
+        except requests.exceptions.RequestException:
+            reachable = False
+        return {
+            "status": "online" if reachable else "unreachable",
+            "latency_ms": round((time.time() - start) * 1000, 1),
+            "last_seen": registered_clients.get(client_ip, {}).get("last_seen")
+        }
+    
+    def _probe_clients(self):
+        client_ips = list(registered_clients.keys())
+        results = self.client_pool.map(self._probe_client, client_ips)
+        return dict(zip(client_ips, results))
+    
+    def _probe_storage(self):
+        start = time.time()
+        try:
+            # Count files instead of loading every profile
+            with os.scandir(USERS_DIR) as entries:
+                users_count = sum(1 for entry in entries if entry.name.endswith(".json"))
+            status = "ok" if os.access(USERS_DIR, os.W_OK) else "read_only"
+        except OSError as e:
+            logger.error(f"Storage health probe failed: {e}")
+            users_count = None
+            status = "error"
+        return {
+            "status": status,
+            "users_count": users_count,
+            "latency_ms": round((time.time() - start) * 1000, 2)
+        }
+    
+    def refresh(self):
+        start = time.time()
+        ollama = self._probe_ollama()
+        clients = self._probe_clients()
+        storage = self._probe_storage()
+        with self.lock:
+            self.snapshot = {
+                "refreshed_at": datetime.now().isoformat(),
+                "refresh_ms": round((time.time() - start) * 1000, 1),
+                "ollama": ollama,
+                "clients": clients,
+                "storage": storage
+            }
+    
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing system health: {e}")
+            time.sleep(self.interval)
+    
+    def ensure_started(self):
+        """Start the probe thread once, on first use or at server startup"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.run, daemon=True, name="HealthMonitorThread").start()
+    
+    def get_snapshot(self):
+        with self.lock:
+            return self.snapshot
+
+health_monitor = SystemHealthMonitor()
+
 # Replace the detect_function_calls function (around line 110)
 
 def detect_function_calls(user_input):
@@ -186,67 +645,548 @@ def detect_function_calls(user_input):
     logger.info(f"Detected {len(function_calls)} function calls: {[f['function'] for f in function_calls]}")
     return function_calls
 
-def execute_function_call(function_name, args, client_ip):
-    """Execute a function call on the appropriate client"""
+def select_model_tier(user_message, function_calls=None):
+    """Classify a turn as tool-only, templated or medical reasoning and return the tier name"""
+    if not MODEL_ROUTING_ENABLED:
+        return DEFAULT_MODEL_TIER
+    
+    message_lower = user_message.lower()
+    # Whole-word matches, so "Spain" is not "pain" and "which" is not "hi"
+    if MEDICAL_REASONING_PATTERN.search(message_lower):
+        return "reasoning"
+    if function_calls:
+        return "tool"
+    if len(message_lower.split()) <= 6 and SMALL_TALK_PATTERN.search(message_lower):
+        return "templated"
+    return DEFAULT_MODEL_TIER
+
+@contextmanager
+def model_tier_slot(tier_name):
+    """Hold one of the tier's concurrency slots and record how long the call took"""
+    semaphore = tier_semaphores[tier_name]
+    wait_start = time.time()
+    semaphore.acquire()
+    start = time.time()
+    span = tracer.current()
+    if span is not None:
+        span.set(tier=tier_name, tier_wait_ms=round((start - wait_start) * 1000, 1))
+    failed = False
+    try:
+        yield MODEL_TIERS[tier_name]
+    except Exception:
+        failed = True
+        raise
+    finally:
+        semaphore.release()
+        with tier_stats_lock:
+            stats = tier_stats[tier_name]
+            stats["requests"] += 1
+            stats["errors"] += 1 if failed else 0
+            stats["latencies_ms"].append((time.time() - start) * 1000)
+            stats["wait_ms"].append((start - wait_start) * 1000)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, None when empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[index], 1)
+
+def get_tier_stats():
+    """Snapshot of per-tier configuration and latency"""
+    snapshot = {}
+    with tier_stats_lock:
+        for name, tier in MODEL_TIERS.items():
+            stats = tier_stats[name]
+            latencies = list(stats["latencies_ms"])
+            waits = list(stats["wait_ms"])
+            snapshot[name] = {
+                "model": tier["model"],
+                "keep_alive": tier["keep_alive"],
+                "max_concurrency": tier["max_concurrency"],
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95)},
+                "queue_wait_ms": {"p50": percentile(waits, 50), "p95": percentile(waits, 95)}
+            }
+    return snapshot
+
+class AdmissionRejected(Exception):
+    """Raised when the Ollama admission queue refuses or times out a request"""
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+class OllamaAdmissionQueue:
+    """Bounded priority queue that limits how many generations hit Ollama at once.
+    
+    Waiters are ordered by (intent priority, per-user round, arrival), so a user's
+    second queued request goes behind every other user's first one.
+    """
+    def __init__(self, max_concurrency, max_queue_depth, max_pending_per_user, queue_timeout):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_pending_per_user = max_pending_per_user
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.waiting = []  # Heap of (priority, user_round, seq)
+        self.cancelled = set()
+        self.active = 0
+        self.pending_by_user = {}
+        self.sequence = itertools.count()
+        self.service_ms = deque(maxlen=100)
+        self.wait_ms = deque(maxlen=200)
+        self.counters = {"admitted": 0, "rejected_429": 0, "rejected_503": 0, "timed_out": 0}
+    
+    def reconfigure(self, max_concurrency, max_queue_depth, max_pending_per_user, queue_timeout):
+        """Apply new limits; waiters are woken in case more slots are free now"""
+        with self.condition:
+            self.max_concurrency = max_concurrency
+            self.max_queue_depth = max_queue_depth
+            self.max_pending_per_user = max_pending_per_user
+            self.queue_timeout = queue_timeout
+            self.condition.notify_all()
+    
+    def _retry_after(self):
+        """Rough seconds until a slot frees up, from recent service times"""
+        average_s = (sum(self.service_ms) / len(self.service_ms) / 1000) if self.service_ms else 10
+        backlog = len(self.waiting) + self.active
+        return max(1, int(average_s * backlog / max(1, self.max_concurrency)))
+    
+    def _reject(self, status_code, reason):
+        self.counters[f"rejected_{status_code}"] += 1
+        logger.warning(f"Ollama admission rejected ({status_code}): {reason}")
+        raise AdmissionRejected(status_code, reason, self._retry_after())
+    
+    def _check_capacity(self, user_key, intent):
+        # Emergencies are never turned away, they only jump the queue
+        if intent == "emergency":
+            return
+        if self.pending_by_user.get(user_key, 0) >= self.max_pending_per_user:
+            self._reject(429, f"Too many pending requests for user {user_key}")
+        if len(self.waiting) >= self.max_queue_depth:
+            self._reject(503, "LLM queue is full")
+    
+    def check(self, user_key, intent="chat"):
+        """Raise AdmissionRejected now if acquire would turn this request away outright"""
+        with self.condition:
+            self._check_capacity(user_key, intent)
+    
+    def acquire(self, user_key, intent="chat"):
+        """Block until this request may call Ollama, or raise AdmissionRejected"""
+        priority = INTENT_PRIORITIES.get(intent, INTENT_PRIORITIES["chat"])
+        
+        with self.condition:
+            self._check_capacity(user_key, intent)
+            pending = self.pending_by_user.get(user_key, 0)
+            ticket = (priority, pending, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            self.pending_by_user[user_key] = pending + 1
+            enqueued = time.time()
+            deadline = enqueued + self.queue_timeout
+            
+            while not (self.waiting[0] == ticket and self.active < self.max_concurrency):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    self._release_user(user_key)
+                    self.counters["timed_out"] += 1
+                    self.condition.notify_all()
+                    logger.warning(f"Request from {user_key} timed out after {self.queue_timeout}s in the LLM queue")
+                    raise AdmissionRejected(503, "Timed out waiting for the LLM", self._retry_after())
+                self.condition.wait(remaining)
+            
+            heapq.heappop(self.waiting)
+            self.active += 1
+            self.counters["admitted"] += 1
+            self.wait_ms.append((time.time() - enqueued) * 1000)
+            # The next waiter may also fit if more than one slot is free
+            self.condition.notify_all()
+            return time.time()
+    
+    def _release_user(self, user_key):
+        remaining = self.pending_by_user.get(user_key, 1) - 1
+        if remaining > 0:
+            self.pending_by_user[user_key] = remaining
+        else:
+            self.pending_by_user.pop(user_key, None)
+    
+    def release(self, user_key, started):
+        with self.condition:
+            self.active -= 1
+            self._release_user(user_key)
+            self.service_ms.append((time.time() - started) * 1000)
+            self.condition.notify_all()
+    
+    @contextmanager
+    def slot(self, user_key, intent="chat"):
+        wait_start = time.time()
+        started = self.acquire(user_key, intent)
+        span = tracer.current()
+        if span is not None:
+            span.set(intent=intent, queue_wait_ms=round((time.time() - wait_start) * 1000, 1))
+        try:
+            yield
+        finally:
+            self.release(user_key, started)
+    
+    def status(self):
+        with self.condition:
+            by_priority = {}
+            for intent, priority in INTENT_PRIORITIES.items():
+                by_priority[intent] = sum(1 for ticket in self.waiting if ticket[0] == priority)
+            waits = list(self.wait_ms)
+            services = list(self.service_ms)
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue_depth": self.max_queue_depth,
+                "active": self.active,
+                "depth": len(self.waiting),
+                "depth_by_intent": by_priority,
+                "users_pending": len(self.pending_by_user),
+                "wait_ms": {"p50": percentile(waits, 50), "p95": percentile(waits, 95)},
+                "service_ms": {"p50": percentile(services, 50), "p95": percentile(services, 95)},
+                **self.counters
+            }
+
+ollama_admission = OllamaAdmissionQueue(OLLAMA_MAX_CONCURRENCY, OLLAMA_MAX_QUEUE_DEPTH,
+                                        OLLAMA_MAX_PENDING_PER_USER, OLLAMA_QUEUE_TIMEOUT)
+drug_retriever = drug_index.create_retriever(OLLAMA_HOST)  # None without numpy or with ZIMA_RAG=0
+safety_engine = safety_rules.SafetyEngine(default_slots={1: "Paracetamol", 2: "Antibiotic"})
+fleet_stats = fleet.FleetStats(stale_after=settings["fleet_stale_after_s"], offline_after=settings["fleet_offline_after_s"])
+
+def send_commands(client_ip, commands):
+    """Post a batch of queued commands to a Pi and return its per-command results"""
+    client_data = registered_clients.get(client_ip, {})
+    headers = wire_protocol.request_headers() if "msgpack" in client_data.get("wire_formats", []) else None
+    response = requests.post(f"http://{client_ip}:5001/commands", json={"commands": commands},
+                             headers=tracer.headers(headers), timeout=10)
+    response.raise_for_status()
+    return wire_protocol.decode_response(response)["results"]
+
+device_commands = command_queue.CommandQueue(COMMAND_JOURNAL, send_commands, observer=fleet_stats.record_call,
+                                             ttl=settings["command_ttl_s"])
+
+def apply_settings(changed):
+    """Hot-reload hook: copy reloaded settings into the module constants and the objects built from them"""
+    global MAX_TOOL_ROUNDS, INCLUDE_REASONING, OLLAMA_QUEUE_TIMEOUT, OLLAMA_REQUEST_TIMEOUT, OLLAMA_PROBE_TIMEOUT
+    global STATUS_REFRESH_INTERVAL, CLIENT_PROBE_TIMEOUT, CLIENT_INACTIVE_AFTER_S, CLIENT_CLEANUP_INTERVAL_S
+    global MODEL_ROUTING_ENABLED, MODEL_TIERS, DISPENSE_ACK_WAIT_S
+    MAX_TOOL_ROUNDS = settings["max_tool_rounds"]
+    INCLUDE_REASONING = settings["include_reasoning"]
+    OLLAMA_QUEUE_TIMEOUT = settings["ollama_queue_timeout_s"]
+    OLLAMA_REQUEST_TIMEOUT = (settings["ollama_connect_timeout_s"], settings["ollama_read_timeout_s"])
+    OLLAMA_PROBE_TIMEOUT = settings["ollama_probe_timeout_s"]
+    STATUS_REFRESH_INTERVAL = settings["status_refresh_interval_s"]
+    CLIENT_PROBE_TIMEOUT = settings["client_probe_timeout_s"]
+    CLIENT_INACTIVE_AFTER_S = settings["client_inactive_after_s"]
+    CLIENT_CLEANUP_INTERVAL_S = settings["client_cleanup_interval_s"]
+    MODEL_ROUTING_ENABLED = settings["model_routing"]
+    DISPENSE_ACK_WAIT_S = settings["dispense_ack_wait_s"]
+    
+    ollama_admission.reconfigure(settings["ollama_concurrency"], settings["ollama_max_queue_depth"],
+                                 settings["ollama_max_pending_per_user"], OLLAMA_QUEUE_TIMEOUT)
+    health_monitor.interval = STATUS_REFRESH_INTERVAL
+    fleet_stats.stale_after = settings["fleet_stale_after_s"]
+    fleet_stats.offline_after = settings["fleet_offline_after_s"]
+    device_commands.ttl = settings["command_ttl_s"]  # New commands only; queued ones keep their expiry
+    continuous_profiler.hz = settings["profile_hz"]
+    
+    if "model_tiers" in changed:
+        tiers = resolve_model_tiers(settings["model_tiers"])
+        with tier_stats_lock:
+            for name, tier in tiers.items():
+                if tier["max_concurrency"] != MODEL_TIERS[name]["max_concurrency"]:
+                    # Calls already holding a slot release it on the old semaphore, so for
+                    # a moment both limits apply side by side
+                    tier_semaphores[name] = threading.BoundedSemaphore(tier["max_concurrency"])
+            MODEL_TIERS = tiers
+        model_lifecycle.set_models(configured_models())
+
+settings.on_change(apply_settings)
+
+def classify_intent(user_message):
+    """Coarse intent used for queue priority: emergency, medication or chat"""
+    message_lower = user_message.lower()
+    if EMERGENCY_PATTERN.search(message_lower):
+        return "emergency"
+    if MEDICATION_PATTERN.search(message_lower):
+        return "medication"
+    return "chat"
+
+def admission_rejected_response(error):
+    """Fast 429/503 reply with Retry-After for a rejected chat request"""
+    response = jsonify({
+        "success": False,
+        "error": error.reason,
+        "retry_after": error.retry_after
+    })
+    response.status_code = error.status_code
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+@contextmanager
+def ollama_call_slot(tier_name, admission=None):
+    """Admission and tier slots for one Ollama HTTP call.
+    
+    admission is the route's (user key, intent). Slots are held only while Ollama
+    works, never across tool or device calls, which can wait on a slow Pi.
+    """
+    with (ollama_admission.slot(*admission) if admission else nullcontext()), model_tier_slot(tier_name):
+        yield
+
+def function_results_reply(function_results):
+    """Answer for when the actions ran but the LLM could not be reached to phrase a reply"""
+    outcomes = []
+    for result in function_results:
+        outcome = result["result"]
+        status = "done" if outcome.get("success") else outcome.get("error") or outcome.get("message") or "failed"
+        outcomes.append(f"{result['function']}: {status}")
+
+    return "The assistant is busy, so here is what I did: " + "; ".join(outcomes) + "."
+
+def execute_function_call(function_name, args, client_ip, user_id=None, idempotency_key=None):
+    """Execute a function call on the appropriate client.
+    
+    Dispensing for a known user is refused when their precomputed safety verdict
+    for that slot is "block". Dispenses go through the durable command queue;
+    a repeated idempotency_key returns the first request's command.
+    """
     if client_ip not in registered_clients:
         return {"success": False, "error": "Client not registered"}
     
+    safety = None
+    if function_name == "dispense_pill" and user_id:
+        safety = safety_engine.check_dispense(user_id, args.get("compartment"), loader=load_profile)
+        if not safety["allowed"]:
+            fleet_stats.record_blocked(client_ip, user_id)
+            logger.warning(f"Dispense of {safety['drug']} to user {user_id} blocked: "
+                           + "; ".join(safety_rules.describe_conflict(c) for c in safety["conflicts"]))
+            return {"success": False, "error": "Dispense blocked by safety check",
+                    "message": f"{safety['drug']} was not dispensed because of a safety conflict", "safety": safety}
+    
+    if function_name == "dispense_pill":
+        return queue_dispense(client_ip, args, user_id, idempotency_key, safety)
+    
+    span = tracer.start(f"pi {function_name}", kind="client", client_ip=client_ip)
     try:
         # Make a request to the client to execute the function
         client_data = registered_clients[client_ip]
         client_url = f"http://{client_ip}:5001"
+        # Ask for the compact encoding only from clients that said they can produce it
+        headers = wire_protocol.request_headers() if "msgpack" in client_data.get("wire_formats", []) else None
+        headers = tracer.headers(headers)
         
         if function_name in ["get_weather_data"]:
             # Weather data can be called directly on the client
             response = requests.post(f"{client_url}/function_call", 
                                    json={"function_name": function_name, "args": args}, 
-                                   timeout=10)
+                                   headers=headers, timeout=10)
         elif function_name == "rotate_servo_90_degrees":
             # Servo rotation
             response = requests.post(f"{client_url}/servo_rotate", 
                                    json=args, 
-                                   timeout=10)
-        elif function_name == "dispense_pill":
-            # Pill dispensing
-            response = requests.post(f"{client_url}/dispense/{args['compartment']}", 
-                                   timeout=10)
+                                   headers=headers, timeout=10)
         elif function_name == "measure_distance":
             # Distance measurement
-            response = requests.get(f"{client_url}/distance", timeout=10)
+            response = requests.get(f"{client_url}/distance", headers=headers, timeout=10)
         else:
             return {"success": False, "error": f"Unknown function: {function_name}"}
         
+        span.set(status_code=response.status_code)
+        fleet_stats.record_call(client_ip, function_name, response.status_code == 200, f"HTTP {response.status_code}")
         if response.status_code == 200:
-            return response.json()
+            return wire_protocol.decode_response(response)
         else:
             return {"success": False, "error": f"Client returned status {response.status_code}"}
             
     except requests.exceptions.RequestException as e:
         logger.error(f"Error executing function {function_name} on client {client_ip}: {e}")
+        span.error = str(e)
+        fleet_stats.record_call(client_ip, function_name, False, type(e).__name__)
         return {"success": False, "error": f"Failed to communicate with client: {str(e)}"}
+    finally:
+        tracer.end(span)
 
-## Replace the generate_response function (around line 240)
+def queue_dispense(client_ip, args, user_id=None, idempotency_key=None, safety=None):
+    """Queue a dispense and wait briefly for the Pi to confirm it"""
+    with tracer.span("command dispense_pill", client_ip=client_ip) as span:
+        command, created = device_commands.submit(client_ip, "dispense_pill", {"compartment": args.get("compartment")},
+                                                  idempotency_key=idempotency_key, user_id=user_id)
+        if not created:
+            logger.info(f"Idempotency key {idempotency_key} already maps to command {command['id']}, not queueing it again")
+        command = device_commands.wait(command["id"], DISPENSE_ACK_WAIT_S)
+        span.set(command_id=command["id"], state=command["state"], attempts=command["attempts"])
+    
+    if command["state"] == "acked":
+        result = dict(command["result"] or {})
+    elif command["state"] in command_queue.PENDING_STATES:
+        result = {"success": False, "pending": True, "error": "Dispenser has not confirmed yet",
+                  "message": "The dispense is queued and will happen at most once; check its status before asking again"}
+    else:
+        result = dict(command["result"] or {}, success=False)
+    result["command_id"] = command["id"]
+    result["command_state"] = command["state"]
+    if safety and safety["conflicts"]:
+        result["safety"] = safety  # Dispensed with cautions the reply should mention
+    return result
 
-def generate_response(prompt, system_prompt=None, user_id=None, client_ip=None):
-    """Generate a response using Ollama API with the deepseek-r1 model"""
-    try:
-        # FIXED: Extract just the user message for function detection
-        # Look for "User request:" in the prompt to get the actual user input
-        user_message = prompt
-        if "User request:" in prompt:
-            user_message = prompt.split("User request:")[-1].split("\n\n")[0].strip()
+class ReasoningFilter:
+    """Incrementally split model output into the visible answer and <think> reasoning.
+    
+    Tags may arrive split across streamed chunks, so a partial tag at the end of a
+    chunk is held back until the next chunk decides what it is.
+    """
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+    
+    def __init__(self):
+        self.in_reasoning = False
+        self.pending = ""
+        self.answer_started = False
+        self.answer_parts = []
+        self.reasoning_parts = []
+        self.answer_tokens = 0
+        self.reasoning_tokens = 0
+    
+    def _partial_tag_length(self, text, tag):
+        """Length of the longest suffix of text that is a prefix of tag"""
+        for length in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:length]):
+                return length
+        return 0
+    
+    def _emit(self, text):
+        if not text:
+            return ""
+        if self.in_reasoning:
+            self.reasoning_parts.append(text)
+            return ""
+        if not self.answer_started:
+            # deepseek-r1 puts blank lines between </think> and the answer
+            text = text.lstrip()
+            if not text:
+                return ""
+            self.answer_started = True
+        self.answer_parts.append(text)
+        return text
+    
+    def feed(self, chunk):
+        """Consume one streamed chunk and return the text that may be shown to the user"""
+        if not chunk:
+            return ""
+        was_reasoning = self.in_reasoning
+        text = self.pending + chunk
+        self.pending = ""
+        visible = []
         
-        logger.info(f"Extracted user message for function detection: '{user_message}'")
+        while text:
+            tag = self.CLOSE_TAG if self.in_reasoning else self.OPEN_TAG
+            index = text.find(tag)
+            if index == -1:
+                keep = self._partial_tag_length(text, tag)
+                visible.append(self._emit(text[:len(text) - keep]))
+                self.pending = text[len(text) - keep:]
+                break
+            visible.append(self._emit(text[:index]))
+            text = text[index + len(tag):]
+            self.in_reasoning = not self.in_reasoning
         
+        visible_text = "".join(visible)
+        if visible_text:
+            self.answer_tokens += 1
+        elif was_reasoning or self.in_reasoning:
+            self.reasoning_tokens += 1
+        return visible_text
+    
+    def flush(self):
+        """Release any held-back partial tag at the end of the stream"""
+        text = self.pending
+        self.pending = ""
+        return self._emit(text)
+    
+    @property
+    def answer_text(self):
+        return "".join(self.answer_parts)
+    
+    @property
+    def reasoning_text(self):
+        return "".join(self.reasoning_parts).strip()
+
+def split_reasoning(text):
+    """Strip <think> blocks from a complete (non-streamed) reply, returns the filter"""
+    reasoning_filter = ReasoningFilter()
+    reasoning_filter.feed(text or "")
+    reasoning_filter.flush()
+    # Whole text arrived as one chunk, approximate token counts by words
+    reasoning_filter.answer_tokens = len(reasoning_filter.answer_text.split())
+    reasoning_filter.reasoning_tokens = len(reasoning_filter.reasoning_text.split())
+    return reasoning_filter
+
+def record_reasoning_metrics(reasoning_filter, debug_info=None):
+    """Update reasoning token counters and optionally hand the trace back to the caller"""
+    with reasoning_stats_lock:
+        reasoning_stats["responses"] += 1
+        reasoning_stats["reasoning_tokens"] += reasoning_filter.reasoning_tokens
+        reasoning_stats["answer_tokens"] += reasoning_filter.answer_tokens
+        if reasoning_filter.reasoning_tokens:
+            reasoning_stats["responses_with_reasoning"] += 1
+    
+    if debug_info is not None:
+        debug_info["reasoning"] = reasoning_filter.reasoning_text
+        debug_info["reasoning_tokens"] = reasoning_filter.reasoning_tokens
+
+def get_reasoning_stats():
+    with reasoning_stats_lock:
+        return dict(reasoning_stats)
+
+## Replace the generate_response function (around line 240)
+
+def generate_response(prompt, system_prompt=None, user_id=None, client_ip=None, debug_info=None, on_text=None,
+                      admission=None):
+    """Generate a response using Ollama API, routed to the model tier that fits the request.
+    
+    Reasoning traces are stripped from the returned text. Pass a dict as debug_info
+    to receive the trace and its token count, and a callable as on_text to receive
+    visible text pieces as they are generated. With admission, a (user key, intent)
+    pair, each Ollama call waits in the admission queue; AdmissionRejected is raised
+    only if no device action has run yet.
+    """
+    # FIXED: Extract just the user message for function detection
+    # Look for "User request:" in the prompt to get the actual user input
+    user_message = prompt
+    if "User request:" in prompt:
+        user_message = prompt.split("User request:")[-1].split("\n\n")[0].strip()
+    
+    logger.info(f"Extracted user message for function detection: '{user_message}'")
+    
+    if OLLAMA_TOOL_MODE == "native":
+        # Keyword detection is only a routing hint here, the tier model picks the tools
+        tier_name = select_model_tier(user_message, detect_function_calls(user_message))
+        logger.info(f"Routing request to '{tier_name}' tier ({MODEL_TIERS[tier_name]['model']})")
+        text = generate_response_native(prompt, system_prompt=system_prompt, client_ip=client_ip,
+                                        tier_name=tier_name, debug_info=debug_info, user_id=user_id,
+                                        admission=admission)
+        if on_text:
+            on_text(text)  # Native tool calling is not streamed, the answer arrives in one piece
+        return text
+    
+    try:
         # Detect function calls in the user input ONLY
         function_calls = detect_function_calls(user_message)
+        tier_name = select_model_tier(user_message, function_calls)
+        logger.info(f"Routing request to '{tier_name}' tier ({MODEL_TIERS[tier_name]['model']})")
         function_results = []
         
         # Execute detected function calls
         if function_calls and client_ip:
             logger.info(f"Executing {len(function_calls)} function calls on client {client_ip}")
             for func_call in function_calls:
-                result = execute_function_call(func_call["function"], func_call["args"], client_ip)
+                result = execute_function_call(func_call["function"], func_call["args"], client_ip, user_id=user_id)
                 function_results.append({
                     "function": func_call["function"],
                     "args": func_call["args"],
@@ -256,33 +1196,17 @@ def generate_response(prompt, system_prompt=None, user_id=None, client_ip=None):
         
         # Build the request data
         data = {
-            "model": OLLAMA_MODEL,
+            "model": MODEL_TIERS[tier_name]["model"],
             "prompt": prompt,
-            "stream": False
+            "stream": True,
+            "keep_alive": MODEL_TIERS[tier_name]["keep_alive"]
         }
         
-        # Enhanced system prompt for medical context with function calling
-        enhanced_system_prompt = """You are an assistant for a smart pill dispenser system called Zima Pharma.
-        The system has two medication slots:
-        - Slot 1 contains Paracetamol (500mg) for pain and fever
-        - Slot 2 contains Antibiotics (250mg) that should be taken with food
-        
-        You can perform the following actions:
-        1. Get weather information for any city
-        2. Control servo motors (rotate 90 degrees clockwise or counterclockwise)
-        3. Dispense medication from compartments
-        4. Measure distance to check pill pickup
-        
-        When users ask about weather, servo control, or medication dispensing, I will execute the appropriate functions.
-        Always provide helpful medical information and remind users about proper medication usage.
-        For emergencies or serious medical concerns, advise users to contact a healthcare professional.
-        """
-        
         # Add system prompt
         if system_prompt:
             data["system"] = system_prompt
         else:
-            data["system"] = enhanced_system_prompt
+            data["system"] = SYSTEM_PROMPT
         
         # If we have function results, include them in the context
         if function_results:
@@ -293,83 +1217,195 @@ def generate_response(prompt, system_prompt=None, user_id=None, client_ip=None):
         
         # Make the API call to Ollama
         logger.debug(f"Sending request to Ollama: {prompt[:50]}...")
-        response = requests.post(f"{OLLAMA_HOST}/api/generate", json=data)
+        # Stream tokens so <think> segments are dropped as they arrive
+        reasoning_filter = ReasoningFilter()
+        try:
+            with tracer.span("ollama generate", kind="client", model=data["model"]) as span, \
+                    ollama_call_slot(tier_name, admission):
+                request_start = time.time()
+                with requests.post(f"{OLLAMA_HOST}/api/generate", json=data, stream=True,
+                                   timeout=OLLAMA_REQUEST_TIMEOUT) as response:
+                    if response.status_code != 200:
+                        logger.error(f"Ollama API error: {response.status_code}")
+                        span.set(status_code=response.status_code)
+                        return "I'm having trouble processing your request. Please try again later."
+            
+                    visible_parts = []
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        if not visible_parts:
+                            span.set(first_token_ms=round((time.time() - request_start) * 1000, 1))
+                        chunk = json.loads(line)
+                        visible_parts.append(reasoning_filter.feed(chunk.get("response", "")))
+                        if on_text and visible_parts[-1]:
+                            on_text(visible_parts[-1])
+                        if chunk.get("done"):
+                            break
+                    visible_parts.append(reasoning_filter.flush())
+                    if on_text and visible_parts[-1]:
+                        on_text(visible_parts[-1])
+                    span.set(answer_tokens=reasoning_filter.answer_tokens, reasoning_tokens=reasoning_filter.reasoning_tokens)
+        except AdmissionRejected:
+            if function_results:
+                return function_results_reply(function_results)  # The device actions already ran
+            raise
         
-        if response.status_code == 200:
-            result = response.json()
-            generated_text = result.get("response", "")
-            logger.debug(f"Ollama response: {generated_text[:50]}...")
-            return generated_text
-        else:
-            logger.error(f"Ollama API error: {response.status_code}")
-            return "I'm having trouble processing your request. Please try again later."
+        generated_text = "".join(visible_parts)
+        record_reasoning_metrics(reasoning_filter, debug_info)
+        logger.debug(f"Ollama response: {generated_text[:50]}... ({reasoning_filter.reasoning_tokens} reasoning tokens stripped)")
+        return generated_text
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Error generating response: {e}")
         return "Sorry, I encountered an error. Please try again."
-# User data management
-def load_users():
-    """Load all users from the users directory"""
-    users = []
+
+def request_ollama_chat(messages, tools=None, tier_name=DEFAULT_MODEL_TIER, admission=None):
+    """Send one /api/chat round to Ollama and return the assistant message"""
+    data = {
+        "model": MODEL_TIERS[tier_name]["model"],
+        "messages": messages,
+        "stream": False,
+        "keep_alive": MODEL_TIERS[tier_name]["keep_alive"]
+    }
+    if tools:
+        data["tools"] = tools
+    
+    with tracer.span("ollama chat", kind="client", model=data["model"], tools=bool(tools)) as span, \
+            ollama_call_slot(tier_name, admission):
+        with requests.post(f"{OLLAMA_HOST}/api/chat", json=data, timeout=OLLAMA_REQUEST_TIMEOUT) as response:
+            span.set(status_code=response.status_code)
+            if response.status_code != 200:
+                logger.error(f"Ollama chat API error: {response.status_code}")
+                return None
+            return response.json().get("message", {})
+
+def parse_tool_calls(message):
+    """Normalize tool calls from an Ollama chat message into detect_function_calls format"""
+    function_calls = []
+    for tool_call in (message or {}).get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        name = function.get("name")
+        args = function.get("arguments") or {}
+        if isinstance(args, str):
+            # Some models return arguments as a JSON string instead of an object
+            try:
+                args = json.loads(args)
+            except json.JSONDecodeError:
+                args = {}
+        if name in AVAILABLE_FUNCTIONS:
+            function_calls.append({"function": name, "args": args})
+        else:
+            logger.warning(f"Model requested unknown tool: {name}")
+    return function_calls
+
+def generate_response_native(prompt, system_prompt=None, client_ip=None, tier_name=DEFAULT_MODEL_TIER, debug_info=None,
+                             user_id=None, admission=None):
+    """Generate a response letting the model choose tools through Ollama native tool calling.
+    
+    Tool results are appended to the same message list, so Ollama can reuse the
+    cached prompt prefix and only prefill the new tool messages on each round.
+    """
     try:
-        if not os.path.exists(USERS_DIR):
-            return {"users": []}
+        messages = [
+            {"role": "system", "content": system_prompt or SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+        tools = OLLAMA_TOOLS if client_ip else None
+        function_results = []
+        
+        for _ in range(MAX_TOOL_ROUNDS):
+            try:
+                message = request_ollama_chat(messages, tools=tools, tier_name=tier_name, admission=admission)
+            except AdmissionRejected:
+                if function_results:
+                    return function_results_reply(function_results)  # The device actions already ran
+                raise
+            if message is None:
+                return "I'm having trouble processing your request. Please try again later."
+            
+            function_calls = parse_tool_calls(message)
+            if not function_calls:
+                reasoning_filter = split_reasoning(message.get("content", ""))
+                record_reasoning_metrics(reasoning_filter, debug_info)
+                return reasoning_filter.answer_text
             
-        for filename in os.listdir(USERS_DIR):
-            if filename.endswith(".json"):
-                user_id = filename.split(".")[0]
-                user_data = load_user_data(user_id)
-                if user_data:
-                    users.append(user_data)
-        return {"users": users}
+            logger.info(f"Model requested {len(function_calls)} tool calls: {[f['function'] for f in function_calls]}")
+            messages.append(message)
+            for func_call in function_calls:
+                result = execute_function_call(func_call["function"], func_call["args"], client_ip, user_id=user_id)
+                logger.info(f"Function {func_call['function']} result: {result}")
+                function_results.append({"function": func_call["function"], "args": func_call["args"], "result": result})
+                messages.append({
+                    "role": "tool",
+                    "tool_name": func_call["function"],
+                    "content": json.dumps(result)
+                })
+        
+        # Out of tool rounds, ask for a final answer without offering tools again
+        try:
+            message = request_ollama_chat(messages, tier_name=tier_name, admission=admission)
+        except AdmissionRejected:
+            if function_results:
+                return function_results_reply(function_results)
+            raise
+        if message is None:
+            return "I'm having trouble processing your request. Please try again later."
+        reasoning_filter = split_reasoning(message.get("content", ""))
+        record_reasoning_metrics(reasoning_filter, debug_info)
+        return reasoning_filter.answer_text
+    except AdmissionRejected:
+        raise
     except Exception as e:
-        logger.error(f"Error loading users: {e}")
-        return {"users": []}
+        logger.error(f"Error generating native tool-calling response: {e}")
+        return "Sorry, I encountered an error. Please try again."
 
-def load_user_data(user_id):
-    """Load a specific user's data"""
+# User data management
+def load_profile(user_id):
+    """A user's validated UserProfile, or None"""
     try:
-        user_file = os.path.join(USERS_DIR, f"{user_id}.json")
-        if os.path.exists(user_file):
-            with open(user_file, 'r') as f:
-                return json.load(f)
-        return None
+        return profile_store.get(user_id)
     except Exception as e:
         logger.error(f"Error loading user {user_id}: {e}")
         return None
 
 def save_user_data(user_id, user_data):
-    """Save a user's data to file"""
+    """Save a user's data (a UserProfile or a profile dict) to file"""
     try:
-        user_file = os.path.join(USERS_DIR, f"{user_id}.json")
-        with open(user_file, 'w') as f:
-            json.dump(user_data, f, indent=2)
+        if not isinstance(user_data, user_model.UserProfile):
+            user_data = user_model.UserProfile.from_dict(user_data)
+        profile = user_data.with_id(user_id)
+        profile_store.save(profile)
+        user_ids.observe(user_id)
+        safety_engine.update_user(user_id, profile)
         return True
     except Exception as e:
         logger.error(f"Error saving user {user_id}: {e}")
         return False
 
 def get_next_user_id():
-    """Generate the next available user ID"""
+    """Reserve the next available user ID"""
     try:
-        user_ids = []
-        for filename in os.listdir(USERS_DIR):
-            if filename.endswith(".json"):
-                user_id = filename.split(".")[0]
-                try:
-                    user_ids.append(int(user_id))
-                except ValueError:
-                    pass
-        return str(max(user_ids) + 1 if user_ids else 1)
+        return user_ids.reserve(1)[0]
     except Exception as e:
         logger.error(f"Error generating next user ID: {e}")
         return "1"
 
 # Flask routes for client-server communication
-@app.route('/api/heartbeat', methods=['GET'])
+@app.route('/api/heartbeat', methods=['GET', 'POST'])
 def heartbeat():
-    """Simple heartbeat endpoint to check if server is alive"""
+    """Check the server is alive; a Pi POSTs its device report for the fleet dashboard"""
     client_ip = request.remote_addr
     logger.debug(f"Heartbeat request from {client_ip}")
+    if request.method == 'POST':
+        try:
+            fleet_stats.heartbeat(client_ip, request.get_json(silent=True))
+        except ValueError as e:
+            logger.warning(f"Rejected heartbeat report from {client_ip}: {e}")
+            return jsonify({"status": "error", "error": str(e)}), 400
+        if client_ip in registered_clients:
+            registered_clients[client_ip]['last_seen'] = datetime.now().isoformat()
     return jsonify({
         "status": "ok", 
         "server_time": datetime.now().isoformat(),
@@ -387,6 +1423,7 @@ def register_client():
         return jsonify({"success": False, "error": "No client data provided"}), 400
     
     client_data['last_seen'] = datetime.now().isoformat()
+    client_data['device_id'] = fleet_stats.register(client_ip, client_data)
     registered_clients[client_ip] = client_data
     
     logger.info(f"Client registered: {client_ip} ({client_data.get('client_type', 'unknown')})")
@@ -396,7 +1433,8 @@ def register_client():
         "success": True, 
         "message": "Client registered successfully",
         "client_ip": client_ip,
-        "server_time": datetime.now().isoformat()
+        "server_time": datetime.now().isoformat(),
+        "wire_formats": wire_protocol.supported_formats()
     })
 
 @app.route('/api/clients', methods=['GET'])
@@ -430,31 +1468,50 @@ def chat():
     client_ip = request.remote_addr
     
     logger.info(f"Chat request from {client_ip}: User {user_id} - '{user_input}'")
+    full_prompt, target_client = build_chat_prompt(user_input, user_id, client_ip)
     
-    # Get user data for context
-    user_data = load_user_data(user_id)
-    
-    # Build context for the LLM
-    context = ""
-    if user_data:
-        name = user_data.get("personal", {}).get("name", "Unknown")
-        age = user_data.get("personal", {}).get("age", "Unknown")
-        conditions = user_data.get("medical_history", {}).get("conditions", [])
-        allergies = user_data.get("medical_history", {}).get("allergies", [])
-        medications = user_data.get("medications", [])
-        
-        context = f"User: {name}, Age: {age}\n"
-        if conditions:
-            context += f"Medical conditions: {', '.join(conditions)}\n"
-        if allergies:
-            context += f"Allergies: {', '.join(allergies)}\n"
-        if medications:
-            context += "Current medications:\n"
-            for med in medications:
-                context += f"- {med.get('name', 'Unknown')} ({med.get('dosage', 'Unknown')}) in slot {med.get('slot', 'Unknown')}\n"
+    # Generate response from Ollama with function calling support
+    debug_info = {} if INCLUDE_REASONING else None
+    intent = classify_intent(user_input)
+    try:
+        response = generate_response(full_prompt, user_id=user_id, client_ip=target_client, debug_info=debug_info,
+                                     admission=(user_id or client_ip, intent))
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    
+    logger.info(f"Response to {client_ip}: '{response[:50]}...'")
+    
+    result = {
+        "success": True,
+        "response": response
+    }
+    if debug_info is not None:
+        result["reasoning"] = debug_info.get("reasoning", "")
+    return jsonify(result)
+
+def build_chat_prompt(user_input, user_id, client_ip):
+    """Return (prompt with the user's medical context, client to run functions on)"""
+    # Build context for the LLM; the profile caches its context block
+    profile = load_profile(user_id)
+    context = profile.prompt_context if profile else ""
+    
+    # Ground the answer in monograph passages for the medications this user takes
+    passages = []
+    if drug_retriever:
+        medication_names = [med.name for med in profile.medications] if profile else []
+        with tracer.span("retrieval", drugs=len(medication_names)) as span:
+            passages = drug_retriever.retrieve(user_input, drugs=medication_names or None)
+            span.set(passages=len(passages))
+    if profile:
+        context += "\n" + safety_rules.prompt_block(safety_engine.safety_profile(user_id, profile))
+    
+    if passages:
+        context += "\nReference information from drug monographs:\n" + drug_index.format_passages(passages) + "\n"
     
     # Create a prompt with context
     full_prompt = f"{context}\n\nUser request: {user_input}\n\nPlease respond to the user's request considering their medical information above."
+    if passages:
+        full_prompt += " Base medication facts on the reference information and say so when it does not cover the question."
     
     # FIXED: Find a registered client for function calling
     target_client = None
@@ -467,16 +1524,59 @@ def chat():
         logger.info(f"Using target client: {target_client} for function calls")
     else:
         logger.warning("No registered clients available for function calling")
+    return full_prompt, target_client
+
+@app.route('/api/chat_stream', methods=['POST'])
+def chat_stream():
+    """Like /api/chat, but streams the visible answer as NDJSON {"text": ...} lines
+    so the Pi can start speaking before generation finishes"""
+    data = request.get_json()
+    user_input = data.get('message', '')
+    user_id = data.get('user_id', '1')
+    client_ip = request.remote_addr
     
-    # Generate response from Ollama with function calling support
-    response = generate_response(full_prompt, user_id=user_id, client_ip=target_client)
+    logger.info(f"Streaming chat request from {client_ip}: User {user_id} - '{user_input}'")
+    full_prompt, target_client = build_chat_prompt(user_input, user_id, client_ip)
+    intent = classify_intent(user_input)
     
-    logger.info(f"Response to {client_ip}: '{response[:50]}...'")
+    # A full queue is still a plain 429/503 response; the slot itself is taken per Ollama call
+    user_key = user_id or client_ip
+    try:
+        ollama_admission.check(user_key, intent)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    
+    pieces = queue.Queue()
+    traceparent = tracer.current().traceparent if tracer.current() else None
+    
+    def produce():
+        span = tracer.start("chat stream generation", traceparent=traceparent)
+        streamed = []
+        def on_text(piece):
+            streamed.append(piece)
+            pieces.put(piece)
+        try:
+            text = generate_response(full_prompt, user_id=user_id, client_ip=target_client, on_text=on_text,
+                                     admission=(user_key, intent))
+            if not streamed and text:
+                pieces.put(text)  # Error replies are returned without being streamed
+        except AdmissionRejected as e:
+            pieces.put(f"The assistant is busy right now. Please try again in {e.retry_after} seconds.")
+        finally:
+            tracer.end(span)
+            pieces.put(None)
+    
+    threading.Thread(target=produce, daemon=True, name="ChatStreamThread").start()
+    
+    def generate():
+        while True:
+            piece = pieces.get()
+            if piece is None:
+                break
+            yield json.dumps({"text": piece}) + "\n"
+        yield json.dumps({"done": True}) + "\n"
     
-    return jsonify({
-        "success": True,
-        "response": response
-    })
+    return Response(generate(), mimetype='application/x-ndjson')
 
 # ADDED: Manual servo control endpoints
 @app.route('/api/servo_rotate', methods=['POST'])
@@ -553,9 +1653,11 @@ def get_servo_position(servo_num):
         })
 
 @app.route('/api/dispense/<int:slot>', methods=['POST'])
-def dispense_pill_manual():
-    """Manual pill dispensing endpoint"""
+def dispense_pill_manual(slot):
+    """Manual pill dispensing endpoint; JSON {"user_id": ...} applies that user's safety check"""
     client_ip = request.remote_addr
+    data = request.get_json(silent=True) or {}
+    user_id = data.get('user_id') or request.args.get('user_id')
     
     if slot not in [1, 2]:
         return jsonify({
@@ -576,7 +1678,17 @@ def dispense_pill_manual():
     # Use the first available client or the requesting client if registered
     target_client = client_ip if client_ip in registered_clients else list(registered_clients.keys())[0]
     
-    result = execute_function_call("dispense_pill", {"compartment": slot}, target_client)
+    if user_id and data.get('override'):
+        logger.warning(f"Safety check overridden by {client_ip} for user {user_id}, slot {slot}")
+        user_id = None
+    # A retried request with the same key gets the first request's command instead of a second dispense
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    result = execute_function_call("dispense_pill", {"compartment": slot}, target_client, user_id=user_id,
+                                   idempotency_key=idempotency_key)
+    if result.get("error") == "Dispense blocked by safety check":
+        return jsonify(result), 409
+    if result.get("pending"):
+        return jsonify(result), 202
     return jsonify(result)
 
 @app.route('/api/check_pill_pickup', methods=['GET'])
@@ -651,13 +1763,9 @@ def get_users():
     logger.debug(f"Users list request from {client_ip}")
     
     try:
-        users_data = load_users()
-        users = users_data.get('users', [])
-        
-        return jsonify({
-            "success": True,
-            "users": users
-        })
+        # Each profile keeps its own encoded JSON, so the list is joined rather than re-serialized
+        body = '{"success":true,"users":[' + ",".join(p.to_json() for p in profile_store.iter_all()) + ']}'
+        return Response(body, mimetype='application/json')
     except Exception as e:
         logger.error(f"Error listing users: {e}")
         return jsonify({
@@ -679,8 +1787,16 @@ def save_user():
             "error": "Missing user_id or user_data"
         }), 400
     
+    if not user_model.USER_ID_RE.fullmatch(str(user_id)):
+        return jsonify({"success": False, "error": "Invalid user_id"}), 400
+    try:
+        profile = user_model.UserProfile.from_dict(user_data)
+    except user_model.ProfileError as e:
+        logger.warning(f"Rejected user {user_id} from {client_ip}: {e}")
+        return jsonify({"success": False, "error": "Invalid user data", "errors": e.errors}), 400
+    
     logger.info(f"Saving user {user_id} data from {client_ip}")
-    success = save_user_data(user_id, user_data)
+    success = save_user_data(user_id, profile)
     
     if success:
         return jsonify({
@@ -698,13 +1814,10 @@ def select_user():
     client_ip = request.remote_addr
     
     logger.debug(f"User selection request from {client_ip}: User ID {user_id}")
-    user_data = load_user_data(user_id)
+    profile = load_profile(user_id)
     
-    if user_data:
-        return jsonify({
-            "success": True,
-            "user": user_data
-        })
+    if profile:
+        return Response('{"success":true,"user":' + profile.to_json() + '}', mimetype='application/json')
     else:
         logger.warning(f"User not found for {client_ip}: User ID {user_id}")
         return jsonify({
@@ -717,19 +1830,22 @@ def add_user():
     client_ip = request.remote_addr
     
     try:
-        # Get new user data from request
-        new_user_data = request.json
+        # Validate before an ID is spent on it
+        new_user_data = dict(request.get_json(silent=True) or {})
+        new_user_data.pop('id', None)
+        try:
+            profile = user_model.UserProfile.from_dict(new_user_data)
+        except user_model.ProfileError as e:
+            return jsonify({"success": False, "error": "Invalid user data", "errors": e.errors}), 400
         
         # Generate new user ID
         new_id = get_next_user_id()
+        profile = profile.with_id(new_id)
         
-        # Add ID to new user data
-        new_user_data['id'] = new_id
-        
-        logger.info(f"Adding new user from {client_ip}: ID {new_id}, Name: {new_user_data.get('personal', {}).get('name', 'Unknown')}")
+        logger.info(f"Adding new user from {client_ip}: ID {new_id}, Name: {profile.display_name}")
         
         # Save to file
-        if not save_user_data(new_id, new_user_data):
+        if not save_user_data(new_id, profile):
             return jsonify({
                 "success": False,
                 "error": "Could not save user data"
@@ -746,6 +1862,165 @@ def add_user():
             "error": str(e)
         }), 500
 
+@app.route('/api/users/import', methods=['POST'])
+def import_users():
+    """Bulk create or upsert profiles from NDJSON or CSV.
+    
+    The whole upload is validated before anything is written and rejected with
+    400 if any row is invalid. Rows are then committed in transactional batches
+    and progress streams back as NDJSON. ?mode=upsert replaces existing ids,
+    ?dry_run=1 only validates.
+    """
+    client_ip = request.remote_addr
+    fmt = user_bulk.detect_format(request.content_type, request.args.get('format'))
+    mode = request.args.get('mode', 'create')
+    dry_run = request.args.get('dry_run') == '1'
+    try:
+        batch_size = max(1, min(int(request.args.get('batch_size', user_bulk.DEFAULT_BATCH_SIZE)), user_bulk.MAX_IMPORT_ROWS))
+    except ValueError:
+        return jsonify({"success": False, "error": "batch_size must be a number"}), 400
+    if mode not in ("create", "upsert"):
+        return jsonify({"success": False, "error": "mode must be create or upsert"}), 400
+    
+    start = time.time()
+    records = user_bulk.parse_records(request.get_data(as_text=True), fmt)
+    if not records:
+        return jsonify({"success": False, "error": "No rows to import"}), 400
+    if len(records) > user_bulk.MAX_IMPORT_ROWS:
+        return jsonify({"success": False, "error": f"At most {user_bulk.MAX_IMPORT_ROWS} rows per import"}), 413
+    
+    # One validation pass over the whole upload, with a single directory listing for id checks
+    with os.scandir(USERS_DIR) as entries:
+        existing = {entry.name[:-5] for entry in entries if entry.name.endswith(".json")}
+    errors = []
+    seen = set()
+    profiles = []
+    for line, record, error in records:
+        problems = [error] if error else []
+        profile = None
+        if not problems:
+            try:
+                profile = user_model.UserProfile.from_dict(record)
+            except user_model.ProfileError as e:
+                problems = e.errors
+        if profile and profile.id is not None:
+            if profile.id in seen:
+                problems.append(f"id {profile.id} appears more than once")
+            elif mode == "create" and profile.id in existing:
+                problems.append(f"user {profile.id} already exists, use mode=upsert to replace it")
+            seen.add(profile.id)
+        if problems:
+            errors.append({"line": line, "errors": problems})
+        else:
+            profiles.append(profile)
+    validate_ms = round((time.time() - start) * 1000, 1)
+    if errors:
+        logger.warning(f"User import from {client_ip} rejected: {len(errors)} of {len(records)} rows invalid")
+        return jsonify({"success": False, "error": "Validation failed, nothing was imported", "rows": len(records),
+                        "invalid": len(errors), "errors": errors[:MAX_REPORTED_IMPORT_ERRORS]}), 400
+    
+    replaced = sum(1 for p in profiles if p.id in existing)
+    if dry_run:
+        return jsonify({"success": True, "dry_run": True, "rows": len(profiles), "created": len(profiles) - replaced,
+                        "replaced": replaced, "validate_ms": validate_ms})
+    
+    new_ids = iter(user_ids.reserve(sum(1 for p in profiles if p.id is None)))
+    for i, profile in enumerate(profiles):
+        if profile.id is not None:
+            user_ids.observe(profile.id)
+        else:
+            profiles[i] = profile.with_id(next(new_ids))
+    logger.info(f"Importing {len(profiles)} users from {client_ip} ({fmt}, {mode}, batches of {batch_size})")
+    
+    def generate():
+        yield json.dumps({"phase": "validated", "rows": len(profiles), "validate_ms": validate_ms}) + "\n"
+        written = 0
+        for offset in range(0, len(profiles), batch_size):
+            batch = {p.id: p for p in profiles[offset:offset + batch_size]}
+            try:
+                user_bulk.commit_batch(USERS_DIR, batch)
+            except OSError as e:
+                logger.error(f"User import batch at row {offset} failed and was rolled back: {e}")
+                yield json.dumps({"done": True, "success": False, "error": f"Batch at row {offset} failed: {e}",
+                                  "written": written, "total": len(profiles)}) + "\n"
+                return
+            for user_id, profile in batch.items():
+                profile_store.prime(profile)
+                safety_engine.update_user(user_id, profile)
+            written += len(batch)
+            yield json.dumps({"phase": "committed", "written": written, "total": len(profiles),
+                              "elapsed_ms": round((time.time() - start) * 1000, 1)}) + "\n"
+        seconds = round(time.time() - start, 2)
+        logger.info(f"Imported {written} users in {seconds}s")
+        yield json.dumps({"done": True, "success": True, "created": written - replaced, "replaced": replaced,
+                          "seconds": seconds}) + "\n"
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/users/export', methods=['GET'])
+def export_users():
+    """Stream every profile as NDJSON (lossless) or CSV"""
+    fmt = request.args.get('format', 'ndjson').lower()
+    if fmt not in ("ndjson", "csv"):
+        return jsonify({"success": False, "error": "format must be ndjson or csv"}), 400
+    logger.info(f"User export ({fmt}) requested by {request.remote_addr}")
+    return Response(user_bulk.export_lines(profile_store.iter_all(), fmt),
+                    mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+                    headers={"Content-Disposition": f"attachment; filename=users.{fmt}"})
+
+@app.route('/api/users/batch_update', methods=['POST'])
+def batch_update_users():
+    """Apply JSON merge patches to many profiles in one transaction.
+    
+    Body: {"updates": [{"id": "3", "patch": {"personal": {"age": 81}}}, ...]}
+    """
+    updates = (request.get_json(silent=True) or {}).get("updates")
+    if not isinstance(updates, list) or not updates:
+        return jsonify({"success": False, "error": "Body must be {\"updates\": [{\"id\": ..., \"patch\": {...}}]}"}), 400
+    
+    merged = {}
+    errors = []
+    for index, update in enumerate(updates):
+        user_id = str(update.get("id", "")) if isinstance(update, dict) else ""
+        if not user_model.USER_ID_RE.fullmatch(user_id):
+            errors.append({"index": index, "errors": ["id is required"]})
+            continue
+        if user_id in merged:
+            errors.append({"index": index, "errors": [f"id {user_id} appears more than once"]})
+            continue
+        current = load_profile(user_id)
+        if current is None:
+            errors.append({"index": index, "errors": [f"user {user_id} not found"]})
+            continue
+        patched = user_bulk.merge_patch(current.to_dict(), update.get("patch") or {})
+        patched["id"] = user_id
+        try:
+            merged[user_id] = user_model.UserProfile.from_dict(patched)
+        except user_model.ProfileError as e:
+            errors.append({"index": index, "errors": e.errors})
+    if errors:
+        return jsonify({"success": False, "error": "Validation failed, nothing was updated",
+                        "invalid": len(errors), "errors": errors[:MAX_REPORTED_IMPORT_ERRORS]}), 400
+    
+    try:
+        user_bulk.commit_batch(USERS_DIR, merged)
+    except OSError as e:
+        logger.error(f"Batch update failed and was rolled back: {e}")
+        return jsonify({"success": False, "error": f"Could not write profiles: {e}"}), 500
+    for user_id, profile in merged.items():
+        profile_store.prime(profile)
+        safety_engine.update_user(user_id, profile)
+    logger.info(f"Batch updated {len(merged)} users from {request.remote_addr}")
+    return jsonify({"success": True, "updated": len(merged)})
+
+@app.route('/api/users/<user_id>/safety', methods=['GET'])
+def user_safety(user_id):
+    """Precomputed interaction, allergy and condition conflicts and per-slot dispense verdicts"""
+    profile = safety_engine.safety_profile(user_id, loader=load_profile)
+    if profile is None:
+        return jsonify({"success": False, "error": "User not found"}), 404
+    return jsonify({"success": True, "safety": profile})
+
 @app.route('/api/get_medication_info/<int:slot>', methods=['GET'])
 def get_medication_info(slot):
     client_ip = request.remote_addr
@@ -835,9 +2110,28 @@ def execute_function():
             "error": "Target client not registered"
         }), 404
     
-    result = execute_function_call(function_name, args, target_client)
+    result = execute_function_call(function_name, args, target_client, user_id=data.get('user_id'),
+                                   idempotency_key=request.headers.get('Idempotency-Key') or data.get('idempotency_key'))
     return jsonify(result)
 
+@app.route('/api/commands', methods=['GET'])
+def list_commands():
+    """Recent device commands, newest first; ?client_ip=, ?state=queued|sent|acked|expired|unknown, ?limit="""
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)
+    except ValueError:
+        return jsonify({"success": False, "error": "limit must be a number"}), 400
+    commands = device_commands.list(address=request.args.get('client_ip'), state=request.args.get('state'), limit=limit)
+    return jsonify({"success": True, "commands": commands, "status": device_commands.status()})
+
+@app.route('/api/commands/<command_id>', methods=['GET'])
+def get_command(command_id):
+    """Delivery state and result of one command"""
+    command = device_commands.get(command_id)
+    if command is None:
+        return jsonify({"success": False, "error": "Command not found"}), 404
+    return jsonify({"success": True, "command": command})
+
 @app.route('/api/weather', methods=['GET'])
 def get_weather_proxy():
     """Proxy weather requests to the appropriate client"""
@@ -858,67 +2152,165 @@ def get_weather_proxy():
     result = execute_function_call("get_weather_data", {"city": city, "units": units}, target_client)
     return jsonify(result)
 
+@app.route('/api/model_tiers', methods=['GET'])
+def model_tiers():
+    """Return model tier configuration and per-tier latency"""
+    return jsonify({
+        "success": True,
+        "routing_enabled": MODEL_ROUTING_ENABLED,
+        "default_tier": DEFAULT_MODEL_TIER,
+        "tiers": get_tier_stats()
+    })
+
+@app.route('/api/retrieval/status', methods=['GET'])
+def retrieval_status():
+    """Drug monograph index generation, size and query latency"""
+    if not drug_retriever:
+        return jsonify({"success": False, "error": "Retrieval disabled",
+                        "message": "Install numpy and leave ZIMA_RAG unset or 1"}), 404
+    return jsonify({"success": True, "retrieval": drug_retriever.status()})
+
+def page_args():
+    """(offset, limit) from the query string; ValueError when they are not numbers"""
+    return int(request.args.get('offset', 0)), int(request.args.get('limit', fleet.DEFAULT_PAGE_SIZE))
+
+@app.route('/api/fleet/devices', methods=['GET'])
+def fleet_devices():
+    """One page of dispensers with their counters, plus fleet-wide totals.
+    
+    Filters: ?status=online|stale|offline, ?health=ok|degraded|failed|unknown,
+    ?user_id=, ?q= (device id or address). Paging: ?sort=-missed_doses_today&offset=0&limit=50
+    """
+    try:
+        offset, limit = page_args()
+        result = fleet_stats.list_devices(status=request.args.get('status'), health=request.args.get('health'),
+                                          user_id=request.args.get('user_id'), q=request.args.get('q'),
+                                          sort=request.args.get('sort', 'device_id'), offset=offset, limit=limit)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    result["summary"]["server_queue"] = ollama_admission.status()
+    return jsonify({"success": True, **result})
+
+@app.route('/api/fleet/devices/<device_id>', methods=['GET'])
+def fleet_device(device_id):
+    device = fleet_stats.device(device_id)
+    if device is None:
+        return jsonify({"success": False, "error": "Device not found"}), 404
+    return jsonify({"success": True, "device": device})
+
+@app.route('/api/fleet/users', methods=['GET'])
+def fleet_users():
+    """Per-user dispenses, missed doses and safety blocks today; ?device_id=, ?min_missed=, paging as devices"""
+    try:
+        offset, limit = page_args()
+        result = fleet_stats.list_users(device_id=request.args.get('device_id'),
+                                        min_missed=int(request.args.get('min_missed', 0)),
+                                        sort=request.args.get('sort', 'user_id'), offset=offset, limit=limit)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify({"success": True, **result})
+
+@app.route('/api/queue_status', methods=['GET'])
+def queue_status():
+    """Return Ollama admission queue depth and counters"""
+    return jsonify({
+        "success": True,
+        "queue": ollama_admission.status()
+    })
+
+@app.route('/api/debug/traces', methods=['GET'])
+def debug_traces():
+    """Recent request traces, merged with the Pi's spans when ?clients=1"""
+    trace_id = request.args.get('trace_id')
+    limit = request.args.get('limit', 20, type=int)
+    min_duration_ms = request.args.get('min_ms', 0, type=float)
+    
+    client_spans = []
+    if request.args.get('clients') == '1':
+        for client_ip in list(registered_clients.keys()):
+            try:
+                response = requests.get(f"http://{client_ip}:5001/debug/traces",
+                                        params={"trace_id": trace_id} if trace_id else None,
+                                        timeout=CLIENT_PROBE_TIMEOUT)
+                client_spans.extend(response.json().get("spans", []))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warning(f"Could not fetch traces from client {client_ip}: {e}")
+    
+    return jsonify({
+        "success": True,
+        "traces": tracer.traces(limit=limit, trace_id=trace_id, min_duration_ms=min_duration_ms,
+                                extra_spans=client_spans)
+    })
+
 @app.route('/api/system_status', methods=['GET'])
 def system_status():
-    """Return system status information"""
+    """Return system status information from the cached health snapshot"""
     client_ip = request.remote_addr
     logger.debug(f"System status request from {client_ip}")
     
-    # Check Ollama status
-    ollama_status = "offline"
-    try:
-        response = requests.get(f"{OLLAMA_HOST}/api/tags")
-        if response.status_code == 200:
-            ollama_status = "online"
-    except:
-        pass
+    health_monitor.ensure_started()
+    snapshot = health_monitor.get_snapshot()
+    uptime_seconds = time.time() - SERVER_START_TIME
     
-    # Basic system info - could be expanded with more details
     return jsonify({
         "success": True,
         "server": {
             "status": "online",
-            "uptime": "unknown",  # Would need to track server start time
-            "version": "1.0",
-            "registered_clients": len(registered_clients)
+            "uptime": format_uptime(uptime_seconds),
+            "uptime_seconds": int(uptime_seconds),
+            "started_at": datetime.fromtimestamp(SERVER_START_TIME).isoformat(),
+            "version": SERVER_VERSION,
+            "registered_clients": len(registered_clients),
+            "health_refreshed_at": snapshot["refreshed_at"],
+            "health_refresh_ms": snapshot["refresh_ms"]
         },
         "llm": {
-            "status": ollama_status,
-            "model": OLLAMA_MODEL
+            "status": snapshot["ollama"]["status"],
+            "latency_ms": snapshot["ollama"]["latency_ms"],
+            "checked_at": snapshot["ollama"]["checked_at"],
+            "model": OLLAMA_MODEL,
+            "tool_mode": OLLAMA_TOOL_MODE,
+            "routing_enabled": MODEL_ROUTING_ENABLED,
+            "tiers": get_tier_stats(),
+            "reasoning": get_reasoning_stats(),
+            "queue": ollama_admission.status(),
+            "lifecycle": model_lifecycle.status()
         },
+        "clients": snapshot["clients"],
         "storage": {
-            "users_count": len(load_users().get("users", [])),
-            "data_dir": DATA_DIR
+            **snapshot["storage"],
+            "data_dir": DATA_DIR,
+            "profiles": profile_store.status()
         },
+        "commands": device_commands.status(),
         "functions": {
             "available": list(AVAILABLE_FUNCTIONS.keys()),
             "count": len(AVAILABLE_FUNCTIONS)
         }
     })
 
+@app.route('/api/config', methods=['GET'])
+def get_config():
+    """Effective settings and where each came from; read-only, edit the config file to change them"""
+    return jsonify({"success": True, **settings.snapshot()})
+
 # ADDED: Main web interface route
 @app.route('/')
 def index():
     """Serve the main web interface"""
     try:
         # Load users for the dropdown
-        users_data = load_users()
-        users = users_data.get('users', [])
+        profiles = list(profile_store.iter_all())
         
         # For demo purposes, select first user if available
-        current_user_id = users[0]['id'] if users else None
-        current_user_data = load_user_data(current_user_id) if current_user_id else {}
+        current_profile = profiles[0] if profiles else None
+        current_user_id = current_profile.id if current_profile else None
         
         # Prepare user options for the select dropdown
-        user_options = []
-        for user in users:
-            user_options.append({
-                'id': user['id'],
-                'name': user.get('personal', {}).get('name', 'Unknown User')
-            })
+        user_options = [profile.summary() for profile in profiles]
         
         return render_template('index.html',
-                             user_data=current_user_data,
+                             profile=current_profile,
                              current_user=current_user_id,
                              user_options=user_options,
                              chat_history=[])  # Empty for now, could load from file
@@ -962,6 +2354,40 @@ def debug_routes():
         "chat_routes": [r for r in routes if "chat" in r["rule"].lower()]
     })
 
+@app.route('/api/debug/profile', methods=['GET'])
+def debug_profile():
+    """Sample all thread stacks for ?seconds at ?hz and return collapsed stacks"""
+    allowed, status_code, message = profiling.check_token(request)
+    if not allowed:
+        return jsonify({"success": False, "error": message}), status_code
+    
+    result = sampling_profiler.profile(request.args.get('seconds', 10, type=float),
+                                       request.args.get('hz', 100, type=float),
+                                       include_idle=request.args.get('idle') == '1')
+    if result is None:
+        return jsonify({"success": False, "error": "A profile is already running"}), 409
+    stacks, samples = result
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            "success": True,
+            "samples": samples,
+            "stacks": [{"stack": stack, "count": count} for stack, count in stacks.most_common()]
+        })
+    return Response(profiling.collapsed_text(stacks), mimetype='text/plain')
+
+@app.route('/api/debug/profile/hot', methods=['GET'])
+def debug_profile_hot():
+    """Hottest functions seen by the continuous profiler over the last ?minutes"""
+    allowed, status_code, message = profiling.check_token(request)
+    if not allowed:
+        return jsonify({"success": False, "error": message}), status_code
+    return jsonify({
+        "success": True,
+        "profile": continuous_profiler.hot_functions(request.args.get('minutes', 60, type=int),
+                                                     request.args.get('top', 30, type=int))
+    })
+
 # Add this after the debug_routes function (around line 930)
 
 @app.route('/simple_chat', methods=['POST'])
@@ -987,7 +2413,11 @@ def simple_chat_fallback():
             target_client = client_ip if client_ip in registered_clients else list(registered_clients.keys())[0]
         
         # Generate response using the same function as main chat
-        response_text = generate_response(user_input, user_id=user_id, client_ip=target_client)
+        try:
+            response_text = generate_response(user_input, user_id=user_id, client_ip=target_client,
+                                              admission=(user_id or client_ip, classify_intent(user_input)))
+        except AdmissionRejected as e:
+            return admission_rejected_response(e)
         
         return jsonify({
             "success": True,
@@ -1014,11 +2444,45 @@ def log_request_info():
     if request.method == 'POST' and 'chat' in request.path:
         logger.info(f"Chat request: {request.method} {request.path} from {request.remote_addr}")
 
+# Read endpoints the Pi caches; they answer If-None-Match with 304
+ETAG_ENDPOINTS = {"get_users", "select_user", "get_medication_info", "get_schedule", "user_safety",
+                  "fleet_devices", "fleet_users"}
+
+@app.after_request
+def add_etag(response):
+    """Attach a content ETag to cacheable responses and short-circuit unchanged ones"""
+    if request.endpoint not in ETAG_ENDPOINTS or response.status_code != 200 or response.direct_passthrough:
+        return response
+    
+    etag = hashlib.sha1(response.get_data()).hexdigest()
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        response.set_data(b"")
+    return response
+
+# Message schema used when a peer negotiates the compact wire encoding
+WIRE_MESSAGE_TYPES = {
+    "heartbeat": "heartbeat",
+    "register_client": "registration",
+    "execute_function": "result",
+    "servo_rotate": "result",
+    "check_pill_pickup": "sensor_event"
+}
+
+@app.after_request
+def encode_wire_response(response):
+    """Send msgpack to peers that asked for it and compress large bodies.
+    
+    Registered after add_etag so it runs first and the ETag covers the bytes sent.
+    """
+    return wire_protocol.encode_flask_response(response, request, WIRE_MESSAGE_TYPES.get(request.endpoint, "raw"))
+
 # Periodic cleanup of inactive clients
 def cleanup_inactive_clients():
-    """Remove clients that haven't been seen for more than 10 minutes"""
+    """Remove clients that haven't been seen for CLIENT_INACTIVE_AFTER_S"""
     now = datetime.now()
-    inactive_threshold = 600  # 10 minutes in seconds
+    inactive_threshold = CLIENT_INACTIVE_AFTER_S
     
     to_remove = []
     for client_ip, client_data in registered_clients.items():
@@ -1048,7 +2512,11 @@ if __name__ == '__main__':
     logger.info("=" * 50)
     logger.info(f"Starting Enhanced LLM server on Mac (IP: {server_ip})")
     logger.info(f"Data directory: {DATA_DIR}")
+    logger.info(f"Config file: {settings.path} ({'loaded' if settings.file_version else 'not found, using defaults'})")
     logger.info(f"Ollama model: {OLLAMA_MODEL}")
+    logger.info(f"Function calling mode: {OLLAMA_TOOL_MODE}")
+    logger.info(f"Model routing: {'enabled' if MODEL_ROUTING_ENABLED else 'disabled'} - " +
+                ", ".join(f"{name}={tier['model']}" for name, tier in MODEL_TIERS.items()))
     logger.info(f"Available functions: {list(AVAILABLE_FUNCTIONS.keys())}")
     logger.info(f"Server accessible at: http://{server_ip}:5000/")
     logger.info("=" * 50)
@@ -1057,14 +2525,29 @@ if __name__ == '__main__':
     if not setup_ollama():
         logger.warning("Continuing without Ollama LLM integration. Responses will be generic.")
     
+    # Health monitor probes Ollama, clients and storage; its first Ollama check
+    # also preloads the models and keeps them resident
+    health_monitor.ensure_started()
+    if profiling.CONTINUOUS_PROFILING:
+        continuous_profiler.ensure_started()
+    
     # Set up background task for client cleanup
     def run_periodic_cleanup():
         while True:
-            time.sleep(300)  # Check every 5 minutes
+            time.sleep(CLIENT_CLEANUP_INTERVAL_S)
             cleanup_inactive_clients()
     
     cleanup_thread = threading.Thread(target=run_periodic_cleanup, daemon=True)
     cleanup_thread.start()
     
+    # Tuning knobs in the config file apply without a restart
+    settings.watch()
+    
+    # Deliver queued device commands, including any recovered from the journal
+    device_commands.start()
+    
+    # Precompute every user's safety verdicts so the first dispense is a lookup too
+    threading.Thread(target=lambda: safety_engine.rebuild(profile_store.iter_all()), daemon=True, name="SafetyPrecompute").start()
+    
     # Start the Flask app
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,199 @@
+# speech.py - On-device speech recognition for the Pi client
+#
+# Audio arrives as 16 kHz mono 16-bit PCM or as Opus packets, each prefixed
+# with a 2-byte big-endian length (audio/opus). PCM is audio/pcm (little-endian,
+# what the engines take) or audio/L16, which RFC 2586 defines as big-endian and
+# is byte-swapped on the way in. Streams are decoded incrementally and report
+# partial hypotheses as they go.
+#
+# Engines, both CPU only and optional:
+#   vosk       - true streaming recogniser, best latency on a Pi
+#                pip install vosk; ZIMA_ASR_MODEL=/path/to/vosk-model-small-en-us
+#   whispercpp - whisper.cpp via pywhispercpp; partials come from re-decoding the
+#                growing buffer every ASR_PARTIAL_INTERVAL_S of new audio
+#                pip install pywhispercpp numpy; ZIMA_ASR_MODEL=base.en (or a ggml path)
+
+import json
+import logging
+import os
+import struct
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+try:
+    import vosk
+except ImportError:
+    vosk = None
+
+try:
+    import numpy
+    from pywhispercpp.model import Model as WhisperModel
+except ImportError:
+    numpy = None
+    WhisperModel = None
+
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 2
+ASR_ENGINE = os.environ.get("ZIMA_ASR_ENGINE", "vosk")
+ASR_MODEL = os.environ.get("ZIMA_ASR_MODEL", "")
+ASR_THREADS = int(os.environ.get("ZIMA_ASR_THREADS", "4"))
+ASR_PARTIAL_INTERVAL_S = 0.5   # whispercpp: new audio needed before re-decoding
+ASR_MAX_WINDOW_S = 15          # whispercpp: only the last N seconds are re-decoded
+OPUS_MAX_FRAME_SAMPLES = 1920  # 120 ms at 16 kHz, the longest Opus frame
+
+class ASRUnavailable(Exception):
+    """No local engine or model is installed"""
+
+class VoskStream:
+    def __init__(self, model):
+        self.recognizer = vosk.KaldiRecognizer(model, SAMPLE_RATE)
+        self.segments = []
+
+    def accept(self, pcm):
+        """Feed PCM bytes, return the current full hypothesis"""
+        if self.recognizer.AcceptWaveform(pcm):
+            text = json.loads(self.recognizer.Result()).get("text", "")
+            if text:
+                self.segments.append(text)
+            return " ".join(self.segments)
+        partial = json.loads(self.recognizer.PartialResult()).get("partial", "")
+        return " ".join(self.segments + ([partial] if partial else []))
+
+    def finish(self):
+        text = json.loads(self.recognizer.FinalResult()).get("text", "")
+        return " ".join(self.segments + ([text] if text else []))
+
+class VoskEngine:
+    name = "vosk"
+
+    def __init__(self, model_path):
+        if vosk is None:
+            raise ASRUnavailable("vosk is not installed")
+        if not model_path or not os.path.isdir(model_path):
+            raise ASRUnavailable("Set ZIMA_ASR_MODEL to a Vosk model directory")
+        vosk.SetLogLevel(-1)
+        self.model = vosk.Model(model_path)
+
+    def stream(self):
+        return VoskStream(self.model)
+
+class WhisperStream:
+    def __init__(self, engine):
+        self.engine = engine
+        self.buffer = bytearray()
+        self.decoded_bytes = 0
+        self.hypothesis = ""
+
+    def _decode(self):
+        window = self.buffer[-ASR_MAX_WINDOW_S * SAMPLE_RATE * BYTES_PER_SAMPLE:]
+        audio = numpy.frombuffer(bytes(window), dtype=numpy.int16).astype(numpy.float32) / 32768.0
+        with self.engine.lock:  # One whisper.cpp context, decodes cannot overlap
+            segments = self.engine.model.transcribe(audio)
+        self.decoded_bytes = len(self.buffer)
+        self.hypothesis = " ".join(segment.text.strip() for segment in segments).strip()
+        return self.hypothesis
+
+    def accept(self, pcm):
+        self.buffer.extend(pcm)
+        if len(self.buffer) - self.decoded_bytes >= ASR_PARTIAL_INTERVAL_S * SAMPLE_RATE * BYTES_PER_SAMPLE:
+            return self._decode()
+        return self.hypothesis
+
+    def finish(self):
+        if len(self.buffer) > self.decoded_bytes:
+            return self._decode()
+        return self.hypothesis
+
+class WhisperCppEngine:
+    name = "whispercpp"
+
+    def __init__(self, model_name):
+        if WhisperModel is None:
+            raise ASRUnavailable("pywhispercpp and numpy are not installed")
+        self.model = WhisperModel(model_name or "base.en", n_threads=ASR_THREADS, print_progress=False)
+        self.lock = threading.Lock()
+
+    def stream(self):
+        return WhisperStream(self)
+
+ENGINES = {"vosk": VoskEngine, "whispercpp": WhisperCppEngine}
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Load the configured engine once; raises ASRUnavailable when it cannot be used"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            if ASR_ENGINE not in ENGINES:
+                raise ASRUnavailable(f"Unknown ASR engine '{ASR_ENGINE}'")
+            _engine = ENGINES[ASR_ENGINE](ASR_MODEL)
+            logger.info(f"Loaded {_engine.name} speech recognition engine")
+        return _engine
+
+class OpusFrameDecoder:
+    """Turns a byte stream of length-prefixed Opus packets into PCM"""
+
+    def __init__(self):
+        if opuslib is None:
+            raise ASRUnavailable("opuslib is not installed, send audio/L16 instead")
+        self.decoder = opuslib.Decoder(SAMPLE_RATE, 1)
+        self.pending = b""
+
+    def decode(self, data):
+        self.pending += data
+        pcm = []
+        while len(self.pending) >= 2:
+            (length,) = struct.unpack(">H", self.pending[:2])
+            if len(self.pending) < 2 + length:
+                break
+            packet, self.pending = self.pending[2:2 + length], self.pending[2 + length:]
+            pcm.append(self.decoder.decode(packet, OPUS_MAX_FRAME_SAMPLES))
+        return b"".join(pcm)
+
+class PcmDecoder:
+    """Passes PCM through as little-endian, holding back an odd trailing byte until the next chunk"""
+
+    def __init__(self, big_endian=False):
+        self.big_endian = big_endian
+        self.pending = b""
+
+    def decode(self, data):
+        data = self.pending + data
+        cut = len(data) - len(data) % BYTES_PER_SAMPLE
+        self.pending = data[cut:]
+        if not self.big_endian or not cut:
+            return data[:cut]
+        samples = array("h", data[:cut])
+        samples.byteswap()
+        return samples.tobytes()
+
+def decoder_for(content_type):
+    """Decoder for a request Content-Type, or raise ValueError if it is not supported"""
+    mimetype, _, params = (content_type or "").partition(";")
+    mimetype = mimetype.strip().lower()
+    options = dict(p.strip().split("=", 1) for p in params.split(";") if "=" in p)
+    if mimetype in ("audio/l16", "audio/pcm", "application/octet-stream"):
+        if int(options.get("rate", SAMPLE_RATE)) != SAMPLE_RATE or int(options.get("channels", 1)) != 1:
+            raise ValueError(f"PCM audio must be {SAMPLE_RATE} Hz mono")
+        # L16 is network byte order unless the sender says otherwise
+        big_endian = mimetype == "audio/l16" and options.get("endianness", "big-endian").lower() != "little-endian"
+        return PcmDecoder(big_endian)
+    if mimetype == "audio/opus":
+        return OpusFrameDecoder()
+    raise ValueError(f"Unsupported audio type '{mimetype}', send audio/pcm;rate={SAMPLE_RATE} (little-endian), "
+                     f"audio/L16;rate={SAMPLE_RATE} (big-endian) or audio/opus")
+
+def status():
+    return {
+        "engine": ASR_ENGINE,
+        "loaded": _engine is not None,
+        "available": {"vosk": vosk is not None, "whispercpp": WhisperModel is not None, "opus": opuslib is not None}
+    }
@@ -0,0 +1,211 @@
+# tracing.py - W3C traceparent propagation and span timing for the server and the Pi
+#
+# Every request handled by either Flask app gets a server span. An incoming
+# "traceparent: 00-<trace id>-<parent span id>-01" header joins that span to
+# the caller's trace. Outgoing calls wrapped in tracer.span() carry the header
+# on to the next hop. Finished spans go to an in-memory ring buffer and,
+# when ZIMA_TRACE_FILE is set, to a JSON-lines file.
+
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+TRACE_BUFFER_SIZE = int(os.environ.get("ZIMA_TRACE_BUFFER", "2000"))  # Spans kept in memory
+TRACE_FILE = os.environ.get("ZIMA_TRACE_FILE")
+
+def new_trace_id():
+    return secrets.token_hex(16)
+
+def new_span_id():
+    return secrets.token_hex(8)
+
+def parse_traceparent(header):
+    """(trace_id, parent_span_id) from a traceparent header, or (None, None)"""
+    match = TRACEPARENT_RE.match((header or "").strip().lower())
+    if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None, None
+    return match.group(1), match.group(2)
+
+class Span:
+    def __init__(self, tracer, name, trace_id, parent_id, kind, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, error=None):
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = round((time.perf_counter() - self._start) * 1000, 2)
+        if error is not None:
+            self.error = str(error)
+        self.tracer._record(self)
+
+    def to_dict(self):
+        return {
+            "service": self.tracer.service,
+            "name": self.name,
+            "kind": self.kind,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start_time, 6),
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+class Tracer:
+    """Creates spans, tracks the current one per thread and keeps the finished ones"""
+
+    def __init__(self, service, buffer_size=TRACE_BUFFER_SIZE, trace_file=TRACE_FILE):
+        self.service = service
+        self.spans = deque(maxlen=buffer_size)
+        self.trace_file = trace_file
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def start(self, name, traceparent=None, kind="internal", **attributes):
+        """Start a span and make it current. Parent is the traceparent header if given, else the current span."""
+        trace_id, parent_id = parse_traceparent(traceparent)
+        if trace_id is None:
+            parent = self.current()
+            trace_id = parent.trace_id if parent else new_trace_id()
+            parent_id = parent.span_id if parent else None
+        span = Span(self, name, trace_id, parent_id, kind, attributes)
+        self._stack().append(span)
+        return span
+
+    def end(self, span, error=None):
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+        span.finish(error)
+
+    @contextmanager
+    def span(self, name, kind="internal", **attributes):
+        span = self.start(name, kind=kind, **attributes)
+        try:
+            yield span
+        except Exception as e:
+            self.end(span, error=e)
+            raise
+        self.end(span)
+
+    def headers(self, headers=None):
+        """Copy of headers with the current span's traceparent added"""
+        headers = dict(headers or {})
+        span = self.current()
+        if span is not None:
+            headers["traceparent"] = span.traceparent
+        return headers
+
+    def _record(self, span):
+        record = span.to_dict()
+        with self.lock:
+            self.spans.append(record)
+            if self.trace_file:
+                try:
+                    with open(self.trace_file, "a") as f:
+                        f.write(json.dumps(record) + "\n")
+                except OSError as e:
+                    logger.error(f"Could not write span to {self.trace_file}: {e}")
+
+    def recent_spans(self, trace_id=None):
+        with self.lock:
+            spans = list(self.spans)
+        return [span for span in spans if not trace_id or span["trace_id"] == trace_id]
+
+    def traces(self, limit=20, trace_id=None, min_duration_ms=0, extra_spans=()):
+        """Most recent traces first, each with its spans in start order.
+
+        extra_spans are finished spans from other services (e.g. the Pi) to merge in.
+        """
+        spans = self.recent_spans() + list(extra_spans)
+        spans.sort(key=lambda s: s["start"])
+        grouped = OrderedDict()
+        for span in spans:
+            if trace_id and span["trace_id"] != trace_id:
+                continue
+            grouped.setdefault(span["trace_id"], []).append(span)
+
+        traces = []
+        for tid, trace_spans in reversed(grouped.items()):
+            trace_spans.sort(key=lambda s: s["start"])
+            start = trace_spans[0]["start"]
+            end = max(s["start"] + s["duration_ms"] / 1000 for s in trace_spans)
+            duration_ms = round((end - start) * 1000, 2)
+            if duration_ms < min_duration_ms:
+                continue
+            span_ids = {s["span_id"] for s in trace_spans}
+            root = next((s for s in trace_spans if s["parent_id"] not in span_ids), trace_spans[0])
+            traces.append({
+                "trace_id": tid,
+                "root": f"{root['service']} {root['name']}",
+                "services": sorted({s["service"] for s in trace_spans}),
+                "start": start,
+                "duration_ms": duration_ms,
+                "span_count": len(trace_spans),
+                "spans": trace_spans
+            })
+            if len(traces) >= limit:
+                break
+        return traces
+
+def init_app(app, tracer, skip_paths=("/static/", "/events", "/debug/", "/api/debug/")):
+    """Open a server span for every request and echo its traceparent back"""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_span():
+        if request.path.startswith(skip_paths):
+            return
+        g.trace_span = tracer.start(f"{request.method} {request.path}",
+                                    traceparent=request.headers.get("traceparent"),
+                                    kind="server", remote_addr=request.remote_addr)
+
+    @app.after_request
+    def tag_request_span(response):
+        span = g.get("trace_span")
+        if span is not None:
+            span.set(status_code=response.status_code)
+            response.headers["traceparent"] = span.traceparent
+        return response
+
+    @app.teardown_request
+    def end_request_span(error=None):
+        span = g.pop("trace_span", None)
+        if span is not None:
+            tracer.end(span, error=error)
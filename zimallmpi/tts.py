@@ -0,0 +1,316 @@
+# tts.py - Local text-to-speech for assistant replies on the Pi
+#
+# Text is split into sentences as it streams in. Each sentence is synthesised
+# by a local CPU engine while the previous one plays, so speech starts as soon
+# as the first sentence of a reply is complete. Audio for every sentence is
+# cached in memory and on disk, so recurring phrases ("Dispensing Paracetamol
+# from compartment 1.") play without synthesis.
+#
+# Engines (command line tools, found on PATH):
+#   piper    - natural voice, needs ZIMA_TTS_VOICE=/path/to/voice.onnx
+#   espeak-ng / espeak - robotic but tiny: sudo apt install espeak-ng
+# Playback goes through aplay (alsa-utils).
+
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
+import time
+import wave
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+TTS_ENABLED = os.environ.get("ZIMA_TTS", "1") == "1"
+TTS_ENGINE = os.environ.get("ZIMA_TTS_ENGINE", "auto")
+TTS_VOICE = os.environ.get("ZIMA_TTS_VOICE", "")
+TTS_RATE = int(os.environ.get("ZIMA_TTS_RATE", "140"))  # espeak words per minute, slower is clearer
+TTS_CACHE_DIR = os.environ.get("ZIMA_TTS_CACHE", os.path.join(os.path.expanduser("~"), "zima_data", "tts_cache"))
+TTS_CACHE_MAX_FILES = 500
+TTS_MEMORY_CACHE_SIZE = 64
+MAX_SENTENCE_CHARS = 200  # Longer runs without punctuation are cut at a comma or space
+PLAYER_COMMAND = ["aplay", "-q", "-"]
+
+# Phrases synthesised ahead of time so the first use is instant
+COMMON_PHRASES = [
+    "Dispensing Paracetamol from compartment 1.",
+    "Dispensing Antibiotic from compartment 2.",
+    "Emergency alert triggered. Help has been notified.",
+    "Time to take your medication."
+]
+
+SENTENCE_END_RE = re.compile(r"[.!?](?=\s)|\n")
+
+def pcm_to_wav(pcm, sample_rate):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+class EspeakEngine:
+    def __init__(self, binary):
+        self.binary = binary
+        self.name = os.path.basename(binary)
+        self.voice = TTS_VOICE or "en"
+
+    def synthesize(self, text):
+        """WAV bytes for text"""
+        return subprocess.run([self.binary, "--stdout", "-s", str(TTS_RATE), "-v", self.voice, text],
+                              capture_output=True, check=True, timeout=30).stdout
+
+class PiperEngine:
+    name = "piper"
+
+    def __init__(self, binary, voice):
+        self.binary = binary
+        self.voice = voice
+        with open(f"{voice}.json") as f:
+            self.sample_rate = json.load(f).get("audio", {}).get("sample_rate", 22050)
+
+    def synthesize(self, text):
+        pcm = subprocess.run([self.binary, "--model", self.voice, "--output_raw"], input=text.encode(),
+                             capture_output=True, check=True, timeout=30).stdout
+        return pcm_to_wav(pcm, self.sample_rate)
+
+def create_engine():
+    """First available engine for ZIMA_TTS_ENGINE, or None"""
+    wanted = TTS_ENGINE.lower()
+    piper = shutil.which("piper")
+    if wanted in ("auto", "piper") and piper and TTS_VOICE.endswith(".onnx") and os.path.exists(f"{TTS_VOICE}.json"):
+        return PiperEngine(piper, TTS_VOICE)
+    if wanted in ("auto", "espeak"):
+        for binary in ("espeak-ng", "espeak"):
+            path = shutil.which(binary)
+            if path:
+                return EspeakEngine(path)
+    return None
+
+class SentenceSplitter:
+    """Accumulates streamed text and hands back complete sentences"""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        sentences = []
+        while True:
+            match = SENTENCE_END_RE.search(self.buffer)
+            if match:
+                cut = match.end()
+            elif len(self.buffer) > MAX_SENTENCE_CHARS:
+                cut = max(self.buffer.rfind(",", 0, MAX_SENTENCE_CHARS), self.buffer.rfind(" ", 0, MAX_SENTENCE_CHARS)) + 1
+                cut = cut or MAX_SENTENCE_CHARS
+            else:
+                break
+            sentence, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if sentence:
+                sentences.append(sentence)
+        return sentences
+
+    def flush(self):
+        sentence, self.buffer = self.buffer.strip(), ""
+        return [sentence] if sentence else []
+
+class PhraseCache:
+    """Sentence audio keyed by engine, voice and normalised text; memory LRU in front of a disk cache"""
+
+    def __init__(self, engine, directory=TTS_CACHE_DIR, memory_size=TTS_MEMORY_CACHE_SIZE, max_files=TTS_CACHE_MAX_FILES):
+        self.engine = engine
+        self.directory = directory
+        self.memory_size = memory_size
+        self.max_files = max_files
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _key(self, text):
+        normalized = " ".join(text.lower().split())
+        return hashlib.sha1(f"{self.engine.name}|{getattr(self.engine, 'voice', '')}|{normalized}".encode()).hexdigest()
+
+    def _remember(self, key, audio):
+        self.memory[key] = audio
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, text):
+        key = self._key(text)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.memory[key]
+        path = os.path.join(self.directory, f"{key}.wav")
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+        except OSError:
+            with self.lock:
+                self.stats["misses"] += 1
+            return None
+        os.utime(path)  # Keeps the disk cache least-recently-used
+        with self.lock:
+            self.stats["disk_hits"] += 1
+            self._remember(key, audio)
+        return audio
+
+    def put(self, text, audio):
+        key = self._key(text)
+        with self.lock:
+            self._remember(key, audio)
+        try:
+            with open(os.path.join(self.directory, f"{key}.wav"), "wb") as f:
+                f.write(audio)
+            self._trim()
+        except OSError as e:
+            logger.warning(f"Could not write TTS cache entry: {e}")
+
+    def _trim(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".wav")]
+        if len(files) <= self.max_files:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_files]:
+            os.remove(path)
+
+    def status(self):
+        with self.lock:
+            return {"memory_entries": len(self.memory), **self.stats}
+
+class SpeechSession:
+    """One reply: feed text as it is generated, close when it is complete"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.splitter = SentenceSplitter()
+        self.sentences = queue.Queue()
+        self.started_at = time.time()
+        self.first_audio_ms = None
+        threading.Thread(target=self._synthesize_loop, daemon=True, name="TTSSynthThread").start()
+
+    def feed(self, text):
+        for sentence in self.splitter.feed(text):
+            self.sentences.put(sentence)
+
+    def close(self):
+        for sentence in self.splitter.flush():
+            self.sentences.put(sentence)
+        self.sentences.put(None)
+
+    def _synthesize_loop(self):
+        while True:
+            sentence = self.sentences.get()
+            if sentence is None:
+                return
+            audio = self.pipeline.synthesize(sentence)
+            if audio:
+                self.pipeline.playback.put((self, audio))
+
+class TTSPipeline:
+    """Synthesises per session and plays everything through one speaker, in order"""
+
+    def __init__(self, engine, player_command=PLAYER_COMMAND):
+        self.engine = engine
+        self.cache = PhraseCache(engine)
+        self.player_command = player_command
+        self.playback = queue.Queue()
+        self.lock = threading.Lock()
+        self.first_audio_ms = deque(maxlen=100)
+        self.synth_ms = deque(maxlen=200)
+        self.stats = {"sessions": 0, "sentences": 0, "synth_errors": 0, "playback_errors": 0}
+        threading.Thread(target=self._playback_loop, daemon=True, name="TTSPlaybackThread").start()
+
+    def session(self):
+        with self.lock:
+            self.stats["sessions"] += 1
+        return SpeechSession(self)
+
+    def say(self, text):
+        """Speak a complete piece of text without waiting for it to finish"""
+        session = self.session()
+        session.feed(text)
+        session.close()
+        return session
+
+    def synthesize(self, sentence):
+        audio = self.cache.get(sentence)
+        if audio is not None:
+            return audio
+        start = time.time()
+        try:
+            audio = self.engine.synthesize(sentence)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f"TTS synthesis failed for '{sentence[:40]}': {e}")
+            with self.lock:
+                self.stats["synth_errors"] += 1
+            return None
+        with self.lock:
+            self.synth_ms.append((time.time() - start) * 1000)
+        self.cache.put(sentence, audio)
+        return audio
+
+    def prewarm(self, phrases=COMMON_PHRASES):
+        for phrase in phrases:
+            splitter = SentenceSplitter()
+            for sentence in splitter.feed(phrase) + splitter.flush():
+                if self.cache.get(sentence) is None:
+                    self.synthesize(sentence)
+
+    def _playback_loop(self):
+        while True:
+            session, audio = self.playback.get()
+            if session.first_audio_ms is None:
+                session.first_audio_ms = round((time.time() - session.started_at) * 1000, 1)
+                with self.lock:
+                    self.first_audio_ms.append(session.first_audio_ms)
+                logger.info(f"Time to first audio: {session.first_audio_ms} ms")
+            with self.lock:
+                self.stats["sentences"] += 1
+            try:
+                subprocess.run(self.player_command, input=audio, check=True, timeout=120,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            except (OSError, subprocess.SubprocessError) as e:
+                with self.lock:
+                    self.stats["playback_errors"] += 1
+                logger.error(f"TTS playback failed: {e}")
+
+    def status(self):
+        def pct(values, p):
+            if not values:
+                return None
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))], 1)
+        with self.lock:
+            first_audio = list(self.first_audio_ms)
+            synth = list(self.synth_ms)
+            stats = dict(self.stats)
+        return {
+            "engine": self.engine.name,
+            "time_to_first_audio_ms": {"last": first_audio[-1] if first_audio else None,
+                                       "p50": pct(first_audio, 50), "p95": pct(first_audio, 95)},
+            "synth_ms": {"p50": pct(synth, 50), "p95": pct(synth, 95)},
+            "cache": self.cache.status(),
+            **stats
+        }
+
+def create_pipeline():
+    """TTS pipeline for the first available engine, None when disabled or nothing is installed"""
+    if not TTS_ENABLED:
+        return None
+    engine = create_engine()
+    if engine is None:
+        logger.warning("No local TTS engine found (install espeak-ng or piper), replies will not be spoken")
+        return None
+    logger.info(f"Speaking replies with {engine.name}")
+    return TTSPipeline(engine)
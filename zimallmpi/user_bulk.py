@@ -0,0 +1,172 @@
+# user_bulk.py - Bulk import, export and batch updates of user profiles
+#
+# Profiles stay one JSON file per user in USERS_DIR. A batch is first parsed
+# and validated as a whole, then written as a transaction: every file is
+# staged in a hidden directory inside USERS_DIR and moved into place with
+# os.replace. If any move fails, the files already replaced are restored, so
+# a batch is written completely or not at all.
+#
+# CSV columns (lists are ";"-separated, a medication is name|dosage|schedule|slot):
+#   id,name,age,gender,conditions,allergies,medications
+#   ,Ann Smith,82,Female,Hypertension;Arthritis,Penicillin,Paracetamol|500mg|As needed|1
+# NDJSON is one full profile object per line and round-trips every field.
+
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+CSV_COLUMNS = ["id", "name", "age", "gender", "conditions", "allergies", "medications"]
+MAX_IMPORT_ROWS = 50000
+DEFAULT_BATCH_SIZE = 1000
+
+def detect_format(content_type, requested=None):
+    """'ndjson' or 'csv' from ?format= or the Content-Type header"""
+    if requested:
+        return requested.lower()
+    mimetype = (content_type or "").split(";")[0].strip().lower()
+    return "csv" if mimetype in ("text/csv", "application/csv") else "ndjson"
+
+def split_list(value):
+    return [item.strip() for item in (value or "").split(";") if item.strip()]
+
+def csv_row_to_profile(row):
+    medications = []
+    for entry in split_list(row.get("medications")):
+        parts = [part.strip() for part in entry.split("|")] + ["", "", ""]
+        medication = {"name": parts[0], "dosage": parts[1], "schedule": parts[2]}
+        if parts[3]:
+            medication["slot"] = int(parts[3]) if parts[3].isdigit() else parts[3]
+        medications.append(medication)
+    age = (row.get("age") or "").strip()
+    profile = {
+        "personal": {"name": (row.get("name") or "").strip(), "age": int(age) if age.isdigit() else (age or None),
+                     "gender": (row.get("gender") or "").strip() or "Unknown"},
+        "medical_history": {"conditions": split_list(row.get("conditions")), "allergies": split_list(row.get("allergies"))},
+        "medications": medications
+    }
+    if (row.get("id") or "").strip():
+        profile["id"] = row["id"].strip()
+    return profile
+
+def profile_to_csv_row(profile):
+    medications = ";".join(
+        "|".join([m.name, m.dosage, m.schedule, str(m.slot) if m.slot is not None else ""]).rstrip("|")
+        for m in profile.medications)
+    return [profile.id or "", profile.personal.name, profile.personal.age if profile.personal.age is not None else "",
+            profile.personal.gender, ";".join(profile.conditions), ";".join(profile.allergies), medications]
+
+def parse_records(body, fmt):
+    """[(line_number, profile or None, error or None)] for an NDJSON or CSV body"""
+    records = []
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(body))
+        missing = [column for column in ("name",) if column not in (reader.fieldnames or [])]
+        if missing:
+            return [(1, None, f"CSV header must include: {', '.join(missing)}")]
+        for row in reader:
+            try:
+                records.append((reader.line_num, csv_row_to_profile(row), None))
+            except (ValueError, AttributeError) as e:
+                records.append((reader.line_num, None, str(e)))
+    elif fmt == "ndjson":
+        for line_number, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                records.append((line_number, json.loads(line), None))
+            except ValueError as e:
+                records.append((line_number, None, f"Invalid JSON: {e}"))
+    else:
+        return [(0, None, f"Unsupported format '{fmt}', use ndjson or csv")]
+    return records
+
+def merge_patch(target, patch):
+    """JSON Merge Patch (RFC 7386): objects merge recursively, null removes a key, anything else replaces"""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+class UserIdAllocator:
+    """Hands out numeric user ids; scans the directory once instead of on every insert"""
+
+    def __init__(self, users_dir):
+        self.users_dir = users_dir
+        self.lock = threading.Lock()
+        self.next_id = None
+
+    def _scan(self):
+        highest = 0
+        with os.scandir(self.users_dir) as entries:
+            for entry in entries:
+                stem = entry.name[:-5] if entry.name.endswith(".json") else ""
+                if stem.isdigit():
+                    highest = max(highest, int(stem))
+        return highest + 1
+
+    def reserve(self, count=1):
+        with self.lock:
+            if self.next_id is None:
+                self.next_id = self._scan()
+            first = self.next_id
+            self.next_id += count
+        return [str(i) for i in range(first, first + count)]
+
+    def observe(self, user_id):
+        """Account for an id written outside reserve(), e.g. an upsert with an explicit id"""
+        if str(user_id).isdigit():
+            with self.lock:
+                if self.next_id is not None and int(user_id) >= self.next_id:
+                    self.next_id = int(user_id) + 1
+
+def commit_batch(users_dir, profiles):
+    """Write {user_id: UserProfile} all-or-nothing; raises OSError after rolling back"""
+    staging = tempfile.mkdtemp(prefix=".batch-", dir=users_dir)
+    replaced = []
+    try:
+        for user_id, profile in profiles.items():
+            with open(os.path.join(staging, f"{user_id}.json"), "w") as f:
+                f.write(profile.to_json())
+        try:
+            for user_id in profiles:
+                target = os.path.join(users_dir, f"{user_id}.json")
+                backup = None
+                if os.path.exists(target):
+                    backup = os.path.join(staging, f"{user_id}.json.bak")
+                    os.link(target, backup)  # Old version stays reachable without a moment where the file is missing
+                os.replace(os.path.join(staging, f"{user_id}.json"), target)
+                replaced.append((target, backup))
+        except OSError:
+            for target, backup in reversed(replaced):
+                if backup:
+                    os.replace(backup, target)
+                else:
+                    os.remove(target)
+            raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+def export_lines(profiles, fmt):
+    """Streamed export body, one line per UserProfile"""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+        yield buffer.getvalue()
+        for profile in profiles:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(profile_to_csv_row(profile))
+            yield buffer.getvalue()
+    else:
+        for profile in profiles:
+            yield profile.to_json() + "\n"
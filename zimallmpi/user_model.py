@@ -0,0 +1,281 @@
+# user_model.py - Typed user profiles, validated once where they enter or leave storage
+#
+# Profiles are still stored as one JSON file per user, in the same layout as
+# before:
+#   {"id", "personal": {"name", "age", "gender"},
+#    "medical_history": {"conditions", "allergies"},
+#    "medications": [{"name", "dosage", "schedule", "slot"}]}
+# UserProfile is built from that dict once. It coerces ages and slots to
+# integers, and keeps the normalised dict and its JSON encoding so responses
+# do not rebuild them. Derived values (display name, medications by slot,
+# prompt context) are computed once per profile.
+#
+# Treat profiles as immutable: with_id() and from_dict() make new ones, and the
+# dict returned by to_dict() must not be modified in place.
+
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+USER_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+class ProfileError(ValueError):
+    """Profile does not match the schema; .errors lists every problem"""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+def coerce_int(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+def _string_tuple(value):
+    return tuple(item for item in value if isinstance(item, str)) if isinstance(value, list) else ()
+
+def _string_list(value, field, errors):
+    if value is None:
+        return
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        errors.append(f"{field} must be a list of strings")
+
+def validate_profile(data):
+    """List of schema errors, empty when the profile can be stored"""
+    if not isinstance(data, dict):
+        return ["profile must be a JSON object"]
+    errors = []
+    if "id" in data and not (isinstance(data["id"], (str, int)) and USER_ID_RE.fullmatch(str(data["id"]))):
+        errors.append("id must be 1-64 letters, digits, '-' or '_'")
+    personal = data.get("personal")
+    if not isinstance(personal, dict):
+        errors.append("personal must be an object")
+    else:
+        if not isinstance(personal.get("name"), str) or not personal["name"].strip():
+            errors.append("personal.name is required")
+        age = personal.get("age")
+        if age not in (None, "", "Unknown") and not (coerce_int(age) is not None and 0 <= coerce_int(age) <= 130):
+            errors.append("personal.age must be a whole number between 0 and 130")
+    medical = data.get("medical_history", {})
+    if not isinstance(medical, dict):
+        errors.append("medical_history must be an object")
+    else:
+        _string_list(medical.get("conditions"), "medical_history.conditions", errors)
+        _string_list(medical.get("allergies"), "medical_history.allergies", errors)
+    medications = data.get("medications", [])
+    if not isinstance(medications, list):
+        errors.append("medications must be a list")
+    else:
+        for i, medication in enumerate(medications):
+            if not isinstance(medication, dict) or not isinstance(medication.get("name"), str) or not medication["name"].strip():
+                errors.append(f"medications[{i}].name is required")
+            elif medication.get("slot") not in (None, "") and not (coerce_int(medication["slot"]) or 0) >= 1:
+                errors.append(f"medications[{i}].slot must be a positive whole number")
+    return errors
+
+@dataclass
+class Personal:
+    __slots__ = ("name", "age", "gender")
+    name: str
+    age: int
+    gender: str
+
+@dataclass
+class Medication:
+    __slots__ = ("name", "dosage", "schedule", "slot")
+    name: str
+    dosage: str
+    schedule: str
+    slot: int
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(str(data.get("name") or "").strip(), str(data.get("dosage") or ""),
+                   str(data.get("schedule") or ""), coerce_int(data.get("slot")))
+
+    def to_dict(self, extra=None):
+        result = dict(extra or {}, name=self.name, dosage=self.dosage, schedule=self.schedule)
+        if self.slot is not None:
+            result["slot"] = self.slot
+        else:
+            result.pop("slot", None)
+        return result
+
+@dataclass
+class UserProfile:
+    __slots__ = ("id", "personal", "conditions", "allergies", "medications",
+                 "display_name", "meds_by_slot", "_data", "_json", "_prompt_context")
+    id: str
+    personal: Personal
+    conditions: tuple
+    allergies: tuple
+    medications: tuple
+
+    def __post_init__(self):
+        self.display_name = self.personal.name or "Unknown User"
+        # Lowest position wins when two medications claim a slot, as the UI always showed the first
+        self.meds_by_slot = {}
+        for medication in self.medications:
+            if medication.slot is not None and medication.name:
+                self.meds_by_slot.setdefault(medication.slot, medication)
+        self._data = None
+        self._json = None
+        self._prompt_context = None
+
+    @classmethod
+    def from_dict(cls, data, strict=True):
+        """Validated profile; strict=False repairs what it can instead of raising (for files already on disk)"""
+        if strict:
+            errors = validate_profile(data)
+            if errors:
+                raise ProfileError(errors)
+        if not isinstance(data, dict):
+            data = {}
+        personal_data = data.get("personal") if isinstance(data.get("personal"), dict) else {}
+        medical_data = data.get("medical_history") if isinstance(data.get("medical_history"), dict) else {}
+        raw_medications = data.get("medications") if isinstance(data.get("medications"), list) else []
+        raw_medications = [m for m in raw_medications if isinstance(m, dict) and str(m.get("name") or "").strip()]
+
+        personal = Personal(str(personal_data.get("name") or "").strip() or "Unknown",
+                            coerce_int(personal_data.get("age")), str(personal_data.get("gender") or "Unknown"))
+        conditions = _string_tuple(medical_data.get("conditions"))
+        allergies = _string_tuple(medical_data.get("allergies"))
+        medications = tuple(Medication.from_dict(m) for m in raw_medications)
+        user_id = str(data["id"]) if data.get("id") not in (None, "") else None
+        profile = cls(user_id, personal, conditions, allergies, medications)
+
+        # Normalised dict: same layout as the input, unknown keys kept, coerced values written back
+        normalized = dict(data)
+        if user_id is not None:
+            normalized["id"] = user_id
+        normalized["personal"] = dict(personal_data, name=personal.name, age=personal.age, gender=personal.gender)
+        normalized["medical_history"] = dict(medical_data, conditions=list(conditions), allergies=list(allergies))
+        normalized["medications"] = [m.to_dict(raw) for m, raw in zip(medications, raw_medications)]
+        profile._data = normalized
+        return profile
+
+    def with_id(self, user_id):
+        """Same profile stored under user_id"""
+        if self.id == str(user_id):
+            return self
+        profile = UserProfile(str(user_id), self.personal, self.conditions, self.allergies, self.medications)
+        profile._data = dict(self._data, id=str(user_id))
+        return profile
+
+    def to_dict(self):
+        return self._data
+
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self._data, separators=(",", ":"))
+        return self._json
+
+    @property
+    def prompt_context(self):
+        """User section of the LLM prompt"""
+        if self._prompt_context is None:
+            age = self.personal.age if self.personal.age is not None else "Unknown"
+            context = f"User: {self.display_name}, Age: {age}\n"
+            if self.conditions:
+                context += f"Medical conditions: {', '.join(self.conditions)}\n"
+            if self.allergies:
+                context += f"Allergies: {', '.join(self.allergies)}\n"
+            if self.medications:
+                context += "Current medications:\n"
+                for medication in self.medications:
+                    slot = medication.slot if medication.slot is not None else "Unknown"
+                    context += f"- {medication.name} ({medication.dosage or 'Unknown'}) in slot {slot}\n"
+            self._prompt_context = context
+        return self._prompt_context
+
+    def summary(self):
+        return {"id": self.id, "name": self.display_name}
+
+class ProfileStore:
+    """UserProfile per file in a users directory, parsed and validated once per file version.
+
+    A lookup is an os.stat; the file is only read again when its mtime or size changes.
+    """
+
+    def __init__(self, users_dir, logger=None):
+        self.users_dir = users_dir
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.entries = {}  # user_id -> ((mtime_ns, size), UserProfile)
+        self.stats = {"hits": 0, "loads": 0, "repaired": 0}
+
+    def path(self, user_id):
+        return os.path.join(self.users_dir, f"{user_id}.json")
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        if not USER_ID_RE.fullmatch(user_id):
+            return None
+        try:
+            stat = os.stat(self.path(user_id))
+        except OSError:
+            with self.lock:
+                self.entries.pop(user_id, None)
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry[0] == version:
+                self.stats["hits"] += 1
+                return entry[1]
+        with open(self.path(user_id)) as f:
+            data = json.load(f)
+        errors = validate_profile(data)
+        if errors and self.logger:
+            self.logger.warning(f"Stored profile {user_id} does not match the schema ({'; '.join(errors)}), loading what is usable")
+        profile = UserProfile.from_dict(data, strict=False).with_id(user_id)
+        with self.lock:
+            self.entries[user_id] = (version, profile)
+            self.stats["loads"] += 1
+            if errors:
+                self.stats["repaired"] += 1
+        return profile
+
+    def prime(self, profile):
+        """Cache a profile that was just written so the next get() does not re-read it"""
+        try:
+            stat = os.stat(self.path(profile.id))
+        except OSError:
+            return
+        with self.lock:
+            self.entries[profile.id] = ((stat.st_mtime_ns, stat.st_size), profile)
+
+    def save(self, profile):
+        """Write atomically and cache"""
+        temp_path = self.path(profile.id) + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(profile.to_json())
+        os.replace(temp_path, self.path(profile.id))
+        self.prime(profile)
+
+    def ids(self):
+        with os.scandir(self.users_dir) as entries:
+            stems = [entry.name[:-5] for entry in entries if entry.name.endswith(".json") and entry.is_file()]
+        return sorted(stems, key=lambda stem: (0, int(stem), "") if stem.isdigit() else (1, 0, stem))
+
+    def iter_all(self):
+        """Every readable profile in id order"""
+        for user_id in self.ids():
+            try:
+                profile = self.get(user_id)
+            except (OSError, ValueError) as e:
+                if self.logger:
+                    self.logger.error(f"Error loading user {user_id}: {e}")
+                continue
+            if profile is not None:
+                yield profile
+
+    def status(self):
+        with self.lock:
+            return {"cached": len(self.entries), **self.stats}
@@ -0,0 +1,174 @@
+# wire_protocol.py - Optional compact encoding for server <-> Pi traffic
+#
+# JSON stays the default. When msgpack is installed and a caller sends
+# "Accept: application/x-zima-msgpack", replies are encoded as versioned
+# MessagePack frames instead. Known message types (heartbeats, function calls,
+# sensor events, results) drop their keys and send ISO timestamps as epoch
+# floats. Large bodies are compressed with zstd or gzip.
+#
+# Install on both machines to enable: pip install msgpack zstandard
+
+import gzip
+import io
+import json
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_CONTENT_TYPE = "application/x-zima-msgpack"
+WIRE_VERSION = 1
+COMPRESSION_THRESHOLD = 1024  # Bytes, smaller bodies are not worth compressing
+
+# Field order per message type and schema version. Append new fields at the end
+# and bump WIRE_VERSION when removing or reordering fields.
+MESSAGE_SCHEMAS = {
+    1: {
+        "raw": (),
+        "heartbeat": ("status", "server_time", "clients_count"),
+        "registration": ("success", "message", "client_ip", "server_time"),
+        "function_call": ("function_name", "args"),
+        "sensor_event": ("distance_cm", "status", "pill_taken"),
+        "result": ("success", "error", "message", "status")
+    }
+}
+MESSAGE_TYPE_IDS = {"raw": 0, "heartbeat": 1, "registration": 2, "function_call": 3, "sensor_event": 4, "result": 5}
+MESSAGE_TYPE_NAMES = {type_id: name for name, type_id in MESSAGE_TYPE_IDS.items()}
+TIMESTAMP_FIELDS = {"server_time", "timestamp", "last_seen"}
+
+def msgpack_available():
+    return msgpack is not None
+
+def supported_formats():
+    """Formats this side can decode, advertised at registration"""
+    return ["msgpack", "json"] if msgpack else ["json"]
+
+def supported_encodings():
+    return ["zstd", "gzip"] if zstandard else ["gzip"]
+
+def request_headers():
+    """Accept headers asking the peer for the compact encoding when we can decode it"""
+    if not msgpack:
+        return {}
+    return {
+        "Accept": f"{MSGPACK_CONTENT_TYPE}, application/json;q=0.9",
+        "Accept-Encoding": ", ".join(supported_encodings())
+    }
+
+def wants_msgpack(accept_header):
+    return bool(msgpack) and MSGPACK_CONTENT_TYPE in (accept_header or "")
+
+def _pack_value(name, value):
+    if name in TIMESTAMP_FIELDS and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return value
+    return value
+
+def _unpack_value(name, value):
+    if name in TIMESTAMP_FIELDS and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value).isoformat()
+    return value
+
+def encode(payload, message_type="raw"):
+    """Encode a dict as [version, type_id, present_mask, values, extras]"""
+    if not msgpack:
+        raise RuntimeError("msgpack is not installed")
+    if message_type not in MESSAGE_SCHEMAS[WIRE_VERSION] or not isinstance(payload, dict):
+        message_type = "raw"
+
+    fields = MESSAGE_SCHEMAS[WIRE_VERSION][message_type]
+    present_mask = 0
+    values = []
+    for index, name in enumerate(fields):
+        if name in payload:
+            present_mask |= 1 << index
+            values.append(_pack_value(name, payload[name]))
+    extras = {key: _pack_value(key, value) for key, value in payload.items() if key not in fields} \
+        if isinstance(payload, dict) else payload
+    frame = [WIRE_VERSION, MESSAGE_TYPE_IDS[message_type], present_mask, values, extras]
+    return msgpack.packb(frame, use_bin_type=True)
+
+def decode(data):
+    """Decode a frame produced by encode back into the original dict"""
+    if not msgpack:
+        raise RuntimeError("msgpack is not installed")
+    version, type_id, present_mask, values, extras = msgpack.unpackb(data, raw=False, strict_map_key=False)
+    if version not in MESSAGE_SCHEMAS:
+        raise ValueError(f"Unsupported wire protocol version {version}")
+
+    fields = MESSAGE_SCHEMAS[version][MESSAGE_TYPE_NAMES.get(type_id, "raw")]
+    if not isinstance(extras, dict):
+        return extras
+    payload = {}
+    value_iter = iter(values)
+    for index, name in enumerate(fields):
+        if present_mask & (1 << index):
+            payload[name] = _unpack_value(name, next(value_iter))
+    for key, value in extras.items():
+        payload[key] = _unpack_value(key, value)
+    return payload
+
+def accepted_encodings(accept):
+    """Codings we can produce that the peer accepts, best first.
+
+    accept is Werkzeug's parsed request.accept_encodings, so q=0 refuses a coding
+    and * covers the ones not named. Equal qualities keep our own preference.
+    """
+    qualities = [(accept[coding], -index, coding) for index, coding in enumerate(supported_encodings())]
+    return [coding for quality, _, coding in sorted(qualities, reverse=True) if quality > 0]
+
+def compress(body, accepted):
+    """Compress a body if it is large and the peer accepts it; accepted lists codings best first. Returns (body, encoding)."""
+    if len(body) < COMPRESSION_THRESHOLD:
+        return body, None
+    for coding in accepted or ():
+        if coding == "zstd" and zstandard:
+            return zstandard.ZstdCompressor(level=3).compress(body), "zstd"
+        if coding == "gzip":
+            # mtime=0 keeps the output byte-identical for the same body, so ETags over it stay stable
+            buffer = io.BytesIO()
+            with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6, mtime=0) as f:
+                f.write(body)
+            return buffer.getvalue(), "gzip"
+    return body, None
+
+def encode_flask_response(response, request, message_type="raw"):
+    """Re-encode a jsonify() response for peers that asked for msgpack, then compress it"""
+    if response.is_streamed or response.direct_passthrough or response.status_code == 304 \
+            or response.headers.get("Content-Encoding"):
+        return response
+
+    if response.mimetype == "application/json" and wants_msgpack(request.headers.get("Accept")):
+        try:
+            payload = json.loads(response.get_data())
+            response.set_data(encode(payload, message_type))
+            response.mimetype = MSGPACK_CONTENT_TYPE
+        except Exception as e:
+            logger.error(f"Failed to encode response as msgpack, sending JSON: {e}")
+
+    if response.mimetype in ("application/json", MSGPACK_CONTENT_TYPE):
+        body, encoding = compress(response.get_data(), accepted_encodings(request.accept_encodings))
+        if encoding:
+            response.set_data(body)
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept")
+        response.vary.add("Accept-Encoding")
+    return response
+
+def decode_response(response):
+    """Body of a requests.Response as a dict, whichever format the peer chose"""
+    if MSGPACK_CONTENT_TYPE in response.headers.get("Content-Type", ""):
+        return decode(response.content)
+    return response.json()